@@ -26,11 +26,11 @@ from veloce_reduction.veloce_reduction.calibration import correct_for_bias_and_d
 make_ronmask, make_master_dark, make_master_darks, crop_overscan_region
 from veloce_reduction.veloce_reduction.order_tracing import find_stripes, make_P_id, make_mask_dict, extract_stripes, make_order_traces_from_fibparms
 # from veloce_reduction.veloce_reduction.spatial_profiles import fit_profiles, fit_profiles_from_indices
-from veloce_reduction.veloce_reduction.flat_fielding import onedim_pixtopix_variations_spline
+from veloce_reduction.veloce_reduction.flat_fielding import onedim_pixtopix_variations_spline_batched
 from veloce_reduction.veloce_reduction.profile_tests import fit_multiple_profiles_from_indices
 from veloce_reduction.veloce_reduction.get_profile_parameters import make_real_fibparms_by_ord, combine_fibparms
-from veloce_reduction.veloce_reduction.chipmasks import make_chipmask
-from veloce_reduction.veloce_reduction.extraction import extract_spectrum_from_indices
+from veloce_reduction.veloce_reduction.chipmasks import make_chipmask, load_chipmask
+from veloce_reduction.veloce_reduction.extraction import extract_spectrum_from_indices, make_extracted_arrays
 from veloce_reduction.veloce_reduction.wavelength_solution import make_master_fibth, make_arc_dispsols
 from process_scripts import process_whites, process_science_images
 
@@ -222,11 +222,11 @@ else:
 
 ### (5) CREATE CHIPMASKS, FINAL ORDER TRACES, AND DETERMINE SLIT HEIGHTS FOR OPTIMAL EXTRACTION #####################################################
 choice = 'r'
-if os.path.isfile(pathdict['cm'] + 'chipmask_' + date + '.npy'):
+if os.path.isfile(pathdict['cm'] + 'chipmask_' + date + '.npz') or os.path.isfile(pathdict['cm'] + 'chipmask_' + date + '.npy'):
     choice = raw_input("CHIPMASK for " + date + " already exists! Do you want to skip this step or recreate it? ['s' / 'r']")
 if choice.lower() == 's':
     print('Loading chipmask for ' + date + '...')
-    chipmask = np.load(pathdict['cm'] + 'chipmask_' + date + '.npy').item()
+    chipmask = load_chipmask(pathdict['cm'] + 'chipmask_' + date)
 else:
     chipmask = make_chipmask(date, pathdict=pathdict, combined_fibparms=False, savefile=True, timit=True)   # use combined_fibparms=True if you trust the simThXe and especially LFC traces (not for now!!!)
 
@@ -268,8 +268,9 @@ pix_q,flux_q,err_q = extract_spectrum_from_indices(MW, err_MW, indices, method='
 pix,flux,err = extract_spectrum_from_indices(MW, err_MW, indices, method='optimal', slit_height=slit_height, fibs='all', slope=True, offset=True, date=date,
                                              individual_fibres=True, ronmask=ronmask, savefile=True, filetype='fits', obsname=date+'_master_white', pathdict=pathdict, timit=True)
 
-# # get a smoothed Master White and a pixel-to-pixel sensitivity map (no, need to do that to 1-dim spectrum)
-# smoothed_flat, pix_sens = onedim_pixtopix_variations_spline(MW, knots=9, savefits=True, path=pathdict['raw'], debug_level=1)
+# get a smoothed Master White and the pixel-to-pixel sensitivities from the extracted (1-dim) Master White (all orders and fibres at once)
+smoothed_flat, pix_sens = onedim_pixtopix_variations_spline_batched(make_extracted_arrays(flux, err)[0], knots=9, date=date, savefits=True,
+                                                                    path=pathdict['raw'], debug_level=1)
 
 
 # (6c) MAKE MASTER FRAMES FOR EACH OF THE SIMULTANEOUS CALIBRATION SOURCES AND EXTRACT THEM
@@ -8,6 +8,7 @@ import matplotlib.pyplot as plt
 from veloce_reduction.readcol import readcol
 from veloce_reduction.veloce_reduction.calibration import correct_orientation, crop_overscan_region
 from veloce_reduction.veloce_reduction.helper_functions import laser_on, thxe_on, get_datestring
+from veloce_reduction.veloce_reduction.chipmasks import load_chipmask
 
 
 
@@ -756,7 +757,7 @@ def update_redobs(starname, starpath=None, pattern=None, overwrite=False):
         utdate = pyfits.getval(file, 'UTDATE')
         date = utdate[:4] + utdate[5:7] + utdate[8:]
         print('Processing file ' + str(i+1) + '/' + str(len(all_files)) + '   (' + obsname + ')')
-        chipmask = np.load(chipmask_path + 'chipmask_' + date + '.npy').item()
+        chipmask = load_chipmask(chipmask_path + 'chipmask_' + date)
         img = crop_overscan_region(correct_orientation(pyfits.getdata(rawpath + date + '/' + obsname + '.fits')))
         lc = laser_on(img, chipmask)
         thxe = thxe_on(img, chipmask)
@@ -9,15 +9,19 @@ import numpy as np
 import time
 import os
 import glob
+import shutil
+import tempfile
 
-from veloce_reduction.veloce_reduction.helper_functions import binary_indices, laser_on, thxe_on
-from veloce_reduction.veloce_reduction.calibration import correct_for_bias_and_dark_from_filename
+from veloce_reduction.veloce_reduction.helper_functions import binary_indices, laser_on, thxe_on, stack_median_and_min
+from veloce_reduction.veloce_reduction.calibration import correct_for_bias_and_dark_from_filename, make_calibrated_stack, get_calibration_hash
 from veloce_reduction.veloce_reduction.cosmic_ray_removal import remove_cosmics, median_remove_cosmics
-from veloce_reduction.veloce_reduction.background import extract_background, extract_background_pid, fit_background
-from veloce_reduction.veloce_reduction.order_tracing import extract_stripes
+from veloce_reduction.veloce_reduction.background import extract_background, extract_background_pid, fit_background, make_background_image
+from veloce_reduction.veloce_reduction.background import get_background_model_key, cache_background_model, get_cached_background_model
+from veloce_reduction.veloce_reduction.order_tracing import extract_stripes, measure_trace_drift
 from veloce_reduction.veloce_reduction.extraction import extract_spectrum, extract_spectrum_from_indices
 from veloce_reduction.veloce_reduction.relative_intensities import get_relints, get_relints_from_indices, append_relints_to_FITS
 from veloce_reduction.veloce_reduction.barycentric_correction import get_barycentric_correction
+from veloce_reduction.veloce_reduction.chipmasks import get_chipmask_plane
 
 
 
@@ -188,7 +192,7 @@ def process_whites(white_list, MB=None, ronmask=None, MD=None, gain=None, P_id=N
         # identify and extract background
         bg = extract_background_pid(master, P_id, slit_height=30, exclude_top_and_bottom=True, timit=timit)
         # fit background
-        bg_coeffs, bg_img = fit_background(bg, clip=10, return_full=True, timit=timit)
+        bg_coeffs, bg_img = fit_background(bg, clip=10, binsize=32, return_full=True, timit=timit)
         # subtract background
         master = master - bg_img
 
@@ -225,7 +229,8 @@ def process_whites(white_list, MB=None, ronmask=None, MD=None, gain=None, P_id=N
 def process_science_images(imglist, P_id, chipmask, mask=None, stripe_indices=None, quick_indices=None,
                            sampling_size=25, slit_height=32, qsh=23, gain=[1., 1., 1., 1.], MB=None, ronmask=None,
                            MD=None, scalable=False, saveall=False, pathdict=None, ext_method='optimal',
-                           from_indices=True, slope=True, offset=True, fibs='all', date=None, timit=False):
+                           from_indices=True, slope=True, offset=True, fibs='all', date=None, drift_ref=None, scratch_dir=None,
+                           nthreads=4, timit=False):
     """
     Process all science / calibration lamp images. This includes:
 
@@ -239,6 +244,17 @@ def process_science_images(imglist, P_id, chipmask, mask=None, stripe_indices=No
     (7) get relative intensities of different fibres
     (8) wavelength solution
     (9) barycentric correction (for stellar observations only)
+
+    If 'drift_ref' (as returned by "order_tracing.make_trace_drift_reference" for the master white) is provided, the spatial drift
+    of the spectrum with respect to the master white is measured for each exposure, and the fibre profiles are shifted accordingly
+    in the optimal extraction.
+
+    The bias- & dark-corrected exposures of each epoch (or, for calibration lamp images, of the whole list) are stored as
+    memory-mapped stacks in a private subdirectory of 'scratch_dir' (default: the system's temporary directory). If that is a
+    RAM-backed filesystem (eg a tmpfs /tmp), 'scratch_dir' should point to a directory on disk instead. The subdirectory is
+    removed at the end, also if the reduction fails.
+
+    The cosmic-ray identification for single exposures is run on 'nthreads' parallel workers (see "remove_cosmics").
     """
 
     print('WARNING: I commented out BARCYRORR')
@@ -255,6 +271,9 @@ def process_science_images(imglist, P_id, chipmask, mask=None, stripe_indices=No
     # sort image list, just in case
     imglist.sort()
 
+    # boolean background mask (the chipmask can either be bit-packed or a dictionary of masks)
+    bgmask = get_chipmask_plane(chipmask, 'bg')
+
     # get a list with the object names
     object_list = [pyfits.getval(file, 'OBJECT').split('+')[0] for file in imglist]
     if object_list[0][:3] == 'ARC':
@@ -313,362 +332,351 @@ def process_science_images(imglist, P_id, chipmask, mask=None, stripe_indices=No
         ron_stripes = extract_stripes(ronmask, P_id, return_indices=False, slit_height=slit_height, savefiles=False,
                                       timit=True)
 
-    # loop over all files
-    for i, filename in enumerate(imglist):
-
-        # (0) do some housekeeping with filenames, and check if there are multiple exposures for a given epoch of a star
-        dum = filename.split('/')
-        dum2 = dum[-1].split('.')
-        obsname = dum2[0]
-        obsnum = int(obsname[-5:])
-        object = pyfits.getval(filename, 'OBJECT').split('+')[0]
-        object_indices = np.where(object == np.array(object_list))[0]
-        texp = pyfits.getval(filename, 'ELAPSED')
-        # check if this exposure belongs to the same epoch as the previous one
-        if obstype in ['stellar', 'ARC']:
-
-            # list of all the observations belonging to this epoch
-            epoch_ix = [sublist for sublist in all_epoch_list if
-                        i in sublist]  # different from object_indices, as epoch_ix contains only indices for this particular epoch if there are multiple epochs of a target in a given night
-            epoch_list = list(np.array(imglist)[epoch_ix])
-            # make sublists according to the four possible calibration lamp configurations
-            epoch_sublists = {'lfc': [], 'thxe': [], 'both': [], 'neither': []}
-
-            if i > 0:
-                if filename in epoch_list:
-                    new_epoch = False
+    # private scratch directory for the calibrated image stacks of each epoch (each image is only calibrated once per epoch, and the
+    # stacks are memory-mapped, so epochs with lots of exposures don't require lots of memory); cached background models are spilled here too
+    scratch_dir = tempfile.mkdtemp(prefix='veloce_stacks_', dir=scratch_dir)
+    epoch_stacks = {}
+    # background models are cached under keys made from the epoch's exposures, the lamp configuration, the calibrations, the
+    # background mask, and the parameters of the background fit
+    calib_hash = get_calibration_hash(MB, MD, gain=gain, scalable=scalable)
+    bg_fitpars = {'deg':5, 'clip':10, 'binsize':32}
+
+    try:
+        # loop over all files
+        for i, filename in enumerate(imglist):
+
+            # (0) do some housekeeping with filenames, and check if there are multiple exposures for a given epoch of a star
+            dum = filename.split('/')
+            dum2 = dum[-1].split('.')
+            obsname = dum2[0]
+            obsnum = int(obsname[-5:])
+            object = pyfits.getval(filename, 'OBJECT').split('+')[0]
+            object_indices = np.where(object == np.array(object_list))[0]
+            texp = pyfits.getval(filename, 'ELAPSED')
+            # check if this exposure belongs to the same epoch as the previous one
+            if obstype in ['stellar', 'ARC']:
+
+                # list of all the observations belonging to this epoch
+                epoch_ix = [sublist for sublist in all_epoch_list if
+                            i in sublist]  # different from object_indices, as epoch_ix contains only indices for this particular epoch if there are multiple epochs of a target in a given night
+                epoch_list = list(np.array(imglist)[epoch_ix])
+                # make sublists according to the four possible calibration lamp configurations
+                epoch_sublists = {'lfc': [], 'thxe': [], 'both': [], 'neither': []}
+
+                # delete the calibrated image stacks of the previous epoch
+                for sublist in [sublist for sublist in epoch_stacks.keys() if sublist[0] not in epoch_list]:
+                    os.remove(epoch_stacks.pop(sublist).filename)
+
+            print('Extracting ' + obstype + ' spectrum ' + str(i + 1) + '/' + str(len(imglist)) + ': ' + obsname)
+
+            if obstype in ['stellar', 'ARC']:
+
+                # nasty temp fix to make sure we are always looking at the 2D images until the header keywords are reliable
+                checkdate = '1' + date[1:]
+
+                if int(checkdate) < 20190503:
+                    # look at the actual 2D image (using chipmasks for LFC and simThXe) to determine which calibration lamps fired
+                    for file in epoch_list:
+                        img = correct_for_bias_and_dark_from_filename(file, MB, MD, gain=gain, scalable=scalable,
+                                                                      savefile=saveall, path=path)
+                        lc = laser_on(img, chipmask)
+                        thxe = thxe_on(img, chipmask)
+                        if (not lc) and (not thxe):
+                            epoch_sublists['neither'].append(file)
+                        elif (lc) and (thxe):
+                            epoch_sublists['both'].append(file)
+                        else:
+                            if lc:
+                                epoch_sublists['lfc'].append(file)
+                            elif thxe:
+                                epoch_sublists['thxe'].append(file)
+                    # now check the calibration lamp configuration for the main observation in question
+                    img = correct_for_bias_and_dark_from_filename(filename, MB, MD, gain=gain, scalable=scalable,
+                                                                  savefile=saveall, path=path)
+                    lc = laser_on(img, chipmask)
+                    thxe = thxe_on(img, chipmask)
+                    if (not lc) and (not thxe):
+                        lamp_config = 'neither'
+                    elif (lc) and (thxe):
+                        lamp_config = 'both'
+                    else:
+                        if lc:
+                            lamp_config = 'lfc'
+                        elif thxe:
+                            lamp_config = 'thxe'
                 else:
-                    new_epoch = True
-                    # delete existing temp bg files so we don't accidentally load them for a wrong epoch
-                    if os.path.isfile(path + 'temp_bg_lfc.fits'):
-                        os.remove(path + 'temp_bg_lfc.fits')
-                    if os.path.isfile(path + 'temp_bg_thxe.fits'):
-                        os.remove(path + 'temp_bg_thxe.fits')
-                    if os.path.isfile(path + 'temp_bg_both.fits'):
-                        os.remove(path + 'temp_bg_both.fits')
-                    if os.path.isfile(path + 'temp_bg_neither.fits'):
-                        os.remove(path + 'temp_bg_neither.fits')
-            else:
-                new_epoch = True
-                # delete existing temp bg files so we don't accidentally load them for a wrong epoch
-                if os.path.isfile(path + 'temp_bg_lfc.fits'):
-                    os.remove(path + 'temp_bg_lfc.fits')
-                if os.path.isfile(path + 'temp_bg_thxe.fits'):
-                    os.remove(path + 'temp_bg_thxe.fits')
-                if os.path.isfile(path + 'temp_bg_both.fits'):
-                    os.remove(path + 'temp_bg_both.fits')
-                if os.path.isfile(path + 'temp_bg_neither.fits'):
-                    os.remove(path + 'temp_bg_neither.fits')
-        else:
-            if i == 0:
-                new_epoch = True
+                    # since May 2019 the header keywords are (mostly) correct, so could just check for LFC / ThXe in header, as that is MUCH faster
+                    for file in epoch_list:
+                        lc = 0
+                        thxe = 0
+                        h = pyfits.getheader(file)
+                        if 'LCNEXP' in h.keys():  # this indicates the latest version of the FITS headers (from May 2019 onwards)
+                            if ('LCEXP' in h.keys()) or (
+                                    'LCMNEXP' in h.keys()):  # this indicates the LFC actually was actually exposed (either automatically or manually)
+                                lc = 1
+                        else:  # if not, just go with the OBJECT field
+                            if ('LC' in pyfits.getval(filename, 'OBJECT').split('+')) or (
+                                    'LFC' in pyfits.getval(filename, 'OBJECT').split('+')):
+                                lc = 1
+                        if (h['SIMCALTT'] > 0) and (h['SIMCALN'] > 0) and (h['SIMCALSE'] > 0):
+                            thxe = 1
+                        assert lc + thxe in [0, 1,
+                                             2], 'ERROR: could not establish status of LFC and simultaneous ThXe for ' + obsname + '.fits !!!'
+                        if lc + thxe == 0:
+                            epoch_sublists['neither'].append(file)
+                        elif lc + thxe == 1:
+                            if lc == 1:
+                                epoch_sublists['lfc'].append(file)
+                            else:
+                                epoch_sublists['thxe'].append(file)
+                        elif lc + thxe == 2:
+                            epoch_sublists['both'].append(file)
+                    # now check the calibration lamp configuration for the main observation in question
+                    lc = 0
+                    thxe = 0
+                    h = pyfits.getheader(filename)
+                    if 'LCNEXP' in h.keys():  # this indicates the latest version of the FITS headers (from May 2019 onwards)
+                        if ('LCEXP' in h.keys()) or (
+                                'LCMNEXP' in h.keys()):  # this indicates the LFC actually was actually exposed (either automatically or manually)
+                            lc = 1
+                    else:  # if not latest header version, just go with the OBJECT field
+                        if ('LC' in pyfits.getval(filename, 'OBJECT').split('+')) or (
+                                'LFC' in pyfits.getval(filename, 'OBJECT').split('+')):
+                            lc = 1
+                    if h['SIMCALTT'] > 0:
+                        thxe = 1
+                    if lc + thxe == 0:
+                        lamp_config = 'neither'
+                    elif lc + thxe == 1:
+                        if lc == 1:
+                            lamp_config = 'lfc'
+                        else:
+                            lamp_config = 'thxe'
+                    elif lc + thxe == 2:
+                        lamp_config = 'both'
             else:
-                new_epoch = False
-
-        print('Extracting ' + obstype + ' spectrum ' + str(i + 1) + '/' + str(len(imglist)) + ': ' + obsname)
+                # for sim. calibration images we don't need to check for the calibration lamp configuration for all exposures (done external to this function)!
+                # just for the file in question and then create a dummy copy of the image list so that it is in the same format that is expected for stellar observations
 
-        if obstype in ['stellar', 'ARC']:
+                # nasty temp fix to make sure we are always looking at the 2D images until the header keywords are reliable
+                checkdate = '1' + date[1:]
 
-            # nasty temp fix to make sure we are always looking at the 2D images until the header keywords are reliable
-            checkdate = '1' + date[1:]
-
-            if int(checkdate) < 20190503:
-                # look at the actual 2D image (using chipmasks for LFC and simThXe) to determine which calibration lamps fired
-                for file in epoch_list:
-                    img = correct_for_bias_and_dark_from_filename(file, MB, MD, gain=gain, scalable=scalable,
+                if int(checkdate) < 20190503:
+                    # now check the calibration lamp configuration for the main observation in question
+                    img = correct_for_bias_and_dark_from_filename(filename, MB, MD, gain=gain, scalable=scalable,
                                                                   savefile=saveall, path=path)
                     lc = laser_on(img, chipmask)
                     thxe = thxe_on(img, chipmask)
                     if (not lc) and (not thxe):
-                        epoch_sublists['neither'].append(file)
+                        lamp_config = 'neither'
                     elif (lc) and (thxe):
-                        epoch_sublists['both'].append(file)
+                        lamp_config = 'both'
                     else:
                         if lc:
-                            epoch_sublists['lfc'].append(file)
+                            lamp_config = 'lfc'
                         elif thxe:
-                            epoch_sublists['thxe'].append(file)
-                # now check the calibration lamp configuration for the main observation in question
-                img = correct_for_bias_and_dark_from_filename(filename, MB, MD, gain=gain, scalable=scalable,
-                                                              savefile=saveall, path=path)
-                lc = laser_on(img, chipmask)
-                thxe = thxe_on(img, chipmask)
-                if (not lc) and (not thxe):
-                    lamp_config = 'neither'
-                elif (lc) and (thxe):
-                    lamp_config = 'both'
+                            lamp_config = 'thxe'
                 else:
-                    if lc:
-                        lamp_config = 'lfc'
-                    elif thxe:
-                        lamp_config = 'thxe'
-            else:
-                # since May 2019 the header keywords are (mostly) correct, so could just check for LFC / ThXe in header, as that is MUCH faster
-                for file in epoch_list:
+                    # now check the calibration lamp configuration for the main observation in question
                     lc = 0
                     thxe = 0
-                    h = pyfits.getheader(file)
+                    h = pyfits.getheader(filename)
                     if 'LCNEXP' in h.keys():  # this indicates the latest version of the FITS headers (from May 2019 onwards)
                         if ('LCEXP' in h.keys()) or (
                                 'LCMNEXP' in h.keys()):  # this indicates the LFC actually was actually exposed (either automatically or manually)
                             lc = 1
-                    else:  # if not, just go with the OBJECT field
+                    else:  # if not latest header version, just go with the OBJECT field
                         if ('LC' in pyfits.getval(filename, 'OBJECT').split('+')) or (
                                 'LFC' in pyfits.getval(filename, 'OBJECT').split('+')):
                             lc = 1
-                    if (h['SIMCALTT'] > 0) and (h['SIMCALN'] > 0) and (h['SIMCALSE'] > 0):
+                    if h['SIMCALTT'] > 0:
                         thxe = 1
-                    assert lc + thxe in [0, 1,
-                                         2], 'ERROR: could not establish status of LFC and simultaneous ThXe for ' + obsname + '.fits !!!'
                     if lc + thxe == 0:
-                        epoch_sublists['neither'].append(file)
+                        lamp_config = 'neither'
                     elif lc + thxe == 1:
                         if lc == 1:
-                            epoch_sublists['lfc'].append(file)
+                            lamp_config = 'lfc'
                         else:
-                            epoch_sublists['thxe'].append(file)
+                            lamp_config = 'thxe'
                     elif lc + thxe == 2:
-                        epoch_sublists['both'].append(file)
-                # now check the calibration lamp configuration for the main observation in question
-                lc = 0
-                thxe = 0
-                h = pyfits.getheader(filename)
-                if 'LCNEXP' in h.keys():  # this indicates the latest version of the FITS headers (from May 2019 onwards)
-                    if ('LCEXP' in h.keys()) or (
-                            'LCMNEXP' in h.keys()):  # this indicates the LFC actually was actually exposed (either automatically or manually)
-                        lc = 1
-                else:  # if not latest header version, just go with the OBJECT field
-                    if ('LC' in pyfits.getval(filename, 'OBJECT').split('+')) or (
-                            'LFC' in pyfits.getval(filename, 'OBJECT').split('+')):
-                        lc = 1
-                if h['SIMCALTT'] > 0:
-                    thxe = 1
-                if lc + thxe == 0:
-                    lamp_config = 'neither'
-                elif lc + thxe == 1:
-                    if lc == 1:
-                        lamp_config = 'lfc'
-                    else:
-                        lamp_config = 'thxe'
-                elif lc + thxe == 2:
-                    lamp_config = 'both'
-        else:
-            # for sim. calibration images we don't need to check for the calibration lamp configuration for all exposures (done external to this function)!
-            # just for the file in question and then create a dummy copy of the image list so that it is in the same format that is expected for stellar observations
+                        lamp_config = 'both'
+
+                epoch_sublists = {}
+                epoch_sublists[lamp_config] = imglist[:]
 
-            # nasty temp fix to make sure we are always looking at the 2D images until the header keywords are reliable
-            checkdate = '1' + date[1:]
+            # for epochs with multiple exposures, calibrate all exposures of this epoch and lamp configuration once, and re-use them for
+            # every exposure of the epoch
+            sublist = tuple(epoch_sublists[lamp_config])
+            if len(sublist) > 1 and sublist not in epoch_stacks:
+                epoch_stacks[sublist] = make_calibrated_stack(sublist, MB, MD, gain=gain, scalable=scalable,
+                                                              scratch_dir=scratch_dir, timit=timit)
 
-            if int(checkdate) < 20190503:
-                # now check the calibration lamp configuration for the main observation in question
+            # (1) call routine that does all the overscan-, bias- & dark-correction stuff and proper error treatment
+            if sublist in epoch_stacks and not saveall:
+                img = np.array(epoch_stacks[sublist][sublist.index(filename)], dtype='float64')  # [e-]
+            else:
                 img = correct_for_bias_and_dark_from_filename(filename, MB, MD, gain=gain, scalable=scalable,
-                                                              savefile=saveall, path=path)
-                lc = laser_on(img, chipmask)
-                thxe = thxe_on(img, chipmask)
-                if (not lc) and (not thxe):
-                    lamp_config = 'neither'
-                elif (lc) and (thxe):
-                    lamp_config = 'both'
+                                                              savefile=saveall, path=path)  # [e-]
+            # err = np.sqrt(img + ronmask*ronmask)   # [e-]
+            # TEMPFIX: (how should I be doing this properly???)
+            err_img = np.sqrt(np.clip(img, 0, None) + ronmask * ronmask)  # [e-]
+
+            ## (2) remove cosmic rays from background, then fit and remove background
+            ## check if there are multiple exposures for this epoch (if yes, we can do the much simpler "median_remove_cosmics")
+            if len(epoch_sublists[lamp_config]) == 1:
+                # do it the hard way using LACosmic
+                # remove cosmics, but only from background (only the tiles containing background pixels are processed)
+                cosmic_cleaned_img = remove_cosmics(img, ronmask, obsname, path, Flim=3.0, siglim=5.0, maxiter=1,
+                                                    regmask=bgmask, nthreads=nthreads, savemask=False, savefile=False, save_err=False,
+                                                    verbose=True, timit=True)  # [e-]
+                # identify and extract background from cosmic-cleaned image
+                bg = extract_background(cosmic_cleaned_img, bgmask, timit=timit)
+                #             bg = extract_background_pid(cosmic_cleaned_img, P_id, slit_height=30, exclude_top_and_bottom=True, timit=timit)
+                # fit background
+                bg_coeffs, bg_img = fit_background(bg, return_full=True, timit=timit, **bg_fitpars)
+            elif len(epoch_sublists[lamp_config]) == 2:
+                bg_key = get_background_model_key(sublist, lamp_config, calib_hash=calib_hash, bgmask=bgmask, **bg_fitpars)
+                bg_coeffs = get_cached_background_model(bg_key, spill_dir=scratch_dir)
+                if bg_coeffs is None:
+                    # list of individual exposure times for this epoch
+                    subepoch_texp_list = [pyfits.getval(file, 'ELAPSED') for file in epoch_sublists[lamp_config]]
+                    tscale = np.array(subepoch_texp_list) / texp
+                    # get background from the element-wise minimum-image of the two images
+                    min_img = stack_median_and_min(epoch_stacks[sublist], scales=tscale, median=False, minimum=True)
+                    # identify and extract background from the minimum-image
+                    bg = extract_background(min_img, bgmask, timit=timit)
+                    #             bg = extract_background_pid(min_img, P_id, slit_height=30, exclude_top_and_bottom=True, timit=timit)
+                    del min_img
+                    # fit background
+                    bg_coeffs = fit_background(bg, return_full=False, timit=timit, **bg_fitpars)
+                    # cache the background model for re-use later (when reducing the next file of this sublist)
+                    cache_background_model(bg_key, bg_coeffs, spill_dir=scratch_dir)
                 else:
-                    if lc:
-                        lamp_config = 'lfc'
-                    elif thxe:
-                        lamp_config = 'thxe'
+                    # no need to re-compute background, just re-use the cached model
+                    print('Using cached background model for this epoch and lamp configuration...')
+                bg_img = make_background_image(bg_coeffs, img.shape)
             else:
-                # now check the calibration lamp configuration for the main observation in question
-                lc = 0
-                thxe = 0
-                h = pyfits.getheader(filename)
-                if 'LCNEXP' in h.keys():  # this indicates the latest version of the FITS headers (from May 2019 onwards)
-                    if ('LCEXP' in h.keys()) or (
-                            'LCMNEXP' in h.keys()):  # this indicates the LFC actually was actually exposed (either automatically or manually)
-                        lc = 1
-                else:  # if not latest header version, just go with the OBJECT field
-                    if ('LC' in pyfits.getval(filename, 'OBJECT').split('+')) or (
-                            'LFC' in pyfits.getval(filename, 'OBJECT').split('+')):
-                        lc = 1
-                if h['SIMCALTT'] > 0:
-                    thxe = 1
-                if lc + thxe == 0:
-                    lamp_config = 'neither'
-                elif lc + thxe == 1:
-                    if lc == 1:
-                        lamp_config = 'lfc'
-                    else:
-                        lamp_config = 'thxe'
-                elif lc + thxe == 2:
-                    lamp_config = 'both'
-
-            epoch_sublists = {}
-            epoch_sublists[lamp_config] = imglist[:]
-
-        # (1) call routine that does all the overscan-, bias- & dark-correction stuff and proper error treatment
-        img = correct_for_bias_and_dark_from_filename(filename, MB, MD, gain=gain, scalable=scalable, savefile=saveall,
-                                                      path=path)  # [e-]
-        # err = np.sqrt(img + ronmask*ronmask)   # [e-]
-        # TEMPFIX: (how should I be doing this properly???)
-        err_img = np.sqrt(np.clip(img, 0, None) + ronmask * ronmask)  # [e-]
-
-        ## (2) remove cosmic rays from background, then fit and remove background
-        ## check if there are multiple exposures for this epoch (if yes, we can do the much simpler "median_remove_cosmics")
-        if len(epoch_sublists[lamp_config]) == 1:
-            # do it the hard way using LACosmic
-            # identify and extract background
-            bg_raw = extract_background(img, chipmask['bg'], timit=timit)
-            # remove cosmics, but only from background
-            cosmic_cleaned_img = remove_cosmics(bg_raw.todense(), ronmask, obsname, path, Flim=3.0, siglim=5.0,
-                                                maxiter=1, savemask=False, savefile=False, save_err=False, verbose=True,
-                                                timit=True)  # [e-]
-            # identify and extract background from cosmic-cleaned image
-            bg = extract_background(cosmic_cleaned_img, chipmask['bg'], timit=timit)
-            #             bg = extract_background_pid(cosmic_cleaned_img, P_id, slit_height=30, exclude_top_and_bottom=True, timit=timit)
-            # fit background
-            bg_coeffs, bg_img = fit_background(bg, clip=10, return_full=True, timit=timit)
-        elif len(epoch_sublists[lamp_config]) == 2:
-            if new_epoch or not os.path.isfile(path + 'temp_bg_' + lamp_config + '.fits'):
-                # list of individual exposure times for this epoch
-                subepoch_texp_list = [pyfits.getval(file, 'ELAPSED') for file in epoch_sublists[lamp_config]]
-                tscale = np.array(subepoch_texp_list) / texp
-                # get background from the element-wise minimum-image of the two images
-                img1 = correct_for_bias_and_dark_from_filename(epoch_sublists[lamp_config][0], MB, MD, gain=gain,
-                                                               scalable=scalable, savefile=False)
-                img2 = correct_for_bias_and_dark_from_filename(epoch_sublists[lamp_config][1], MB, MD, gain=gain,
-                                                               scalable=scalable, savefile=False)
-                min_img = np.minimum(img1 / tscale[0], img2 / tscale[1])
-                # identify and extract background from the minimum-image
-                bg = extract_background(min_img, chipmask['bg'], timit=timit)
-                #             bg = extract_background_pid(min_img, P_id, slit_height=30, exclude_top_and_bottom=True, timit=timit)
-                del min_img
-                # fit background
-                bg_coeffs, bg_img = fit_background(bg, clip=10, return_full=True, timit=timit)
-                # save background image to temporary file for re-use later (when reducing the next file of this sublist)
-                pyfits.writeto(path + 'temp_bg_' + lamp_config + '.fits', np.float32(bg_img), overwrite=True)
+                bg_key = get_background_model_key(sublist, lamp_config, calib_hash=calib_hash, bgmask=bgmask, **bg_fitpars)
+                bg_coeffs = get_cached_background_model(bg_key, spill_dir=scratch_dir)
+                if bg_coeffs is None:
+                    # list of individual exposure times for this epoch
+                    subepoch_texp_list = [pyfits.getval(file, 'ELAPSED') for file in epoch_sublists[lamp_config]]
+                    tscale = np.array(subepoch_texp_list) / texp
+                    #             # index indicating which one of the files in the epoch list is the "main" one
+                    #             main_index = np.where(np.array(epoch_ix) == i)[0][0]
+                    # take median after scaling to same exposure time as main exposure (this is done in bands of rows, so
+                    # there is no need to limit the number of exposures to keep the memory usage in check)
+                    med_img = stack_median_and_min(epoch_stacks[sublist], scales=tscale)
+                    # identify and extract background from the median image
+                    bg = extract_background(med_img, bgmask, timit=timit)
+                    #             bg = extract_background_pid(med_img, P_id, slit_height=30, exclude_top_and_bottom=True, timit=timit)
+                    del med_img
+                    # fit background
+                    bg_coeffs = fit_background(bg, return_full=False, timit=timit, **bg_fitpars)
+                    # cache the background model for re-use later (when reducing the next file of this sublist)
+                    cache_background_model(bg_key, bg_coeffs, spill_dir=scratch_dir)
+                else:
+                    # no need to re-compute background, just re-use the cached model
+                    print('Using cached background model for this epoch and lamp configuration...')
+                bg_img = make_background_image(bg_coeffs, img.shape)
+
+            # now actually subtract the background model
+            bg_corrected_img = img - bg_img
+
+            # # save background model to file (or APPEND TO RAW FILE???)
+            # bg_fn= path + obsname + '_BG_model.fits'
+            # pyfits.writeto(bg_fn, bg_img)
+
+            #       cosmic_cleaned_img = median_remove_cosmics(img_list, main_index=main_index, scales=scaled_texp, ronmask=ronmask, debug_level=1, timit=True)
+
+            # (3) fit and remove background (ERRORS REMAIN UNCHANGED)
+            # bg_corrected_img = remove_background(cosmic_cleaned_img, P_id, obsname, path, degpol=5, slit_height=slit_height, save_bg=True, savefile=True, save_err=False,
+            #                                      exclude_top_and_bottom=True, verbose=True, timit=True)   # [e-]
+            # bg_corrected_img = remove_background(img, P_id, obsname, path, degpol=5, slit_height=slit_height, save_bg=False, savefile=True, save_err=False,
+            #                                      exclude_top_and_bottom=True, verbose=True, timit=True)   # [e-]
+            # adjust errors?
+
+            # (4) remove pixel-to-pixel sensitivity variations (2-dim)
+            # XXXXXXXXXXXXXXXXXXXXXXXXXXX
+            # TEMPFIX
+            final_img = bg_corrected_img.copy()  # [e-]
+            #         final_img = img.copy()   # [e-]
+            # adjust errors?
+
+            # measure the spatial drift of the spectrum with respect to the master white (the fibre profiles are then shifted accordingly)
+            if drift_ref is not None:
+                drift, global_drift = measure_trace_drift(final_img, drift_ref, timit=timit)
+                print('Spatial drift with respect to the master white: ' + str(np.round(global_drift, 3)) + ' pixels')
             else:
-                # no need to re-compute background, just load it from file
-                print('Loading background image for this epoch and lamp configuration...')
-                bg_img = pyfits.getdata(path + 'temp_bg_' + lamp_config + '.fits')
-        else:
-            if new_epoch or not os.path.isfile(path + 'temp_bg_' + lamp_config + '.fits'):
-                # make sure this sublist is not too long (otherwise we might run out of memory in this step)
-                if len(epoch_sublists[lamp_config]) > 10:
-                    mainix = epoch_sublists[lamp_config].index(filename)
-                    if mainix < 5:
-                        epoch_sublists[lamp_config] = epoch_sublists[lamp_config][:11]
-                    elif mainix > len(epoch_sublists[lamp_config]) - 6:
-                        epoch_sublists[lamp_config] = epoch_sublists[lamp_config][-11:]
-                    else:
-                        epoch_sublists[lamp_config] = epoch_sublists[lamp_config][mainix - 5:mainix + 6]
-                # list of individual exposure times for this epoch
-                subepoch_texp_list = [pyfits.getval(file, 'ELAPSED') for file in epoch_sublists[lamp_config]]
-                tscale = np.array(subepoch_texp_list) / texp
-                # make list of actual images
-                img_list = []
-                for file in epoch_sublists[lamp_config]:
-                    img_list.append(correct_for_bias_and_dark_from_filename(file, MB, MD, gain=gain, scalable=scalable,
-                                                                            savefile=False))
-                #             # index indicating which one of the files in the epoch list is the "main" one
-                #             main_index = np.where(np.array(epoch_ix) == i)[0][0]
-                # take median after scaling to same exposure time as main exposure
-                med_img = np.median(np.array(img_list) / tscale.reshape(len(img_list), 1, 1), axis=0)
-                del img_list
-                # identify and extract background from the median image
-                bg = extract_background(med_img, chipmask['bg'], timit=timit)
-                #             bg = extract_background_pid(med_img, P_id, slit_height=30, exclude_top_and_bottom=True, timit=timit)
-                del med_img
-                # fit background
-                bg_coeffs, bg_img = fit_background(bg, clip=10, return_full=True, timit=timit)
-                # save background image to temporary file for re-use later (when reducing the next file of this sublist)
-                pyfits.writeto(path + 'temp_bg_' + lamp_config + '.fits', np.float32(bg_img), overwrite=True)
+                drift = None
+
+            # (5) extract stripes
+            if not from_indices:
+                stripes, stripe_indices = extract_stripes(final_img, P_id, return_indices=True, slit_height=slit_height,
+                                                          savefiles=saveall, obsname=obsname, path=path, timit=True)
+                err_stripes = extract_stripes(err_img, P_id, return_indices=False, slit_height=slit_height,
+                                              savefiles=saveall, obsname=obsname + '_err', path=path, timit=True)
+            if stripe_indices is None:
+                # this is just to get the stripe indices in case we forgot to provide them (DONE ONLY ONCE, if at all...)
+                stripes, stripe_indices = extract_stripes(final_img, P_id, return_indices=True, slit_height=slit_height,
+                                                          savefiles=False, obsname=obsname, path=path, timit=True)
+
+            # (6) perform extraction of 1-dim spectrum
+            if from_indices:
+                pix, flux, err = extract_spectrum_from_indices(final_img, err_img, quick_indices, method='quick',
+                                                               slit_height=qsh, ronmask=ronmask, savefile=True,
+                                                               filetype='fits', obsname=obsname, date=date,
+                                                               pathdict=pathdict, lamp_config=lamp_config, timit=True)
+                pix, flux, err = extract_spectrum_from_indices(final_img, err_img, stripe_indices, method=ext_method,
+                                                               slope=slope, offset=offset, fibs=fibs,
+                                                               slit_height=slit_height,
+                                                               ronmask=ronmask, savefile=True, filetype='fits',
+                                                               obsname=obsname, date=date, pathdict=pathdict,
+                                                               lamp_config=lamp_config, drift=drift, timit=True)
             else:
-                # no need to re-compute background, just load it from file
-                print('Loading background image for this epoch and lamp configuration...')
-                bg_img = pyfits.getdata(path + 'temp_bg_' + lamp_config + '.fits')
-
-        # now actually subtract the background model
-        bg_corrected_img = img - bg_img
-
-        # # save background model to file (or APPEND TO RAW FILE???)
-        # bg_fn= path + obsname + '_BG_model.fits'
-        # pyfits.writeto(bg_fn, bg_img)
-
-        #       cosmic_cleaned_img = median_remove_cosmics(img_list, main_index=main_index, scales=scaled_texp, ronmask=ronmask, debug_level=1, timit=True)
-
-        # (3) fit and remove background (ERRORS REMAIN UNCHANGED)
-        # bg_corrected_img = remove_background(cosmic_cleaned_img, P_id, obsname, path, degpol=5, slit_height=slit_height, save_bg=True, savefile=True, save_err=False,
-        #                                      exclude_top_and_bottom=True, verbose=True, timit=True)   # [e-]
-        # bg_corrected_img = remove_background(img, P_id, obsname, path, degpol=5, slit_height=slit_height, save_bg=False, savefile=True, save_err=False,
-        #                                      exclude_top_and_bottom=True, verbose=True, timit=True)   # [e-]
-        # adjust errors?
-
-        # (4) remove pixel-to-pixel sensitivity variations (2-dim)
-        # XXXXXXXXXXXXXXXXXXXXXXXXXXX
-        # TEMPFIX
-        final_img = bg_corrected_img.copy()  # [e-]
-        #         final_img = img.copy()   # [e-]
-        # adjust errors?
-
-        # (5) extract stripes
-        if not from_indices:
-            stripes, stripe_indices = extract_stripes(final_img, P_id, return_indices=True, slit_height=slit_height,
-                                                      savefiles=saveall, obsname=obsname, path=path, timit=True)
-            err_stripes = extract_stripes(err_img, P_id, return_indices=False, slit_height=slit_height,
-                                          savefiles=saveall, obsname=obsname + '_err', path=path, timit=True)
-        if stripe_indices is None:
-            # this is just to get the stripe indices in case we forgot to provide them (DONE ONLY ONCE, if at all...)
-            stripes, stripe_indices = extract_stripes(final_img, P_id, return_indices=True, slit_height=slit_height,
-                                                      savefiles=False, obsname=obsname, path=path, timit=True)
-
-        # (6) perform extraction of 1-dim spectrum
-        if from_indices:
-            pix, flux, err = extract_spectrum_from_indices(final_img, err_img, quick_indices, method='quick',
-                                                           slit_height=qsh, ronmask=ronmask, savefile=True,
-                                                           filetype='fits', obsname=obsname, date=date,
-                                                           pathdict=pathdict, lamp_config=lamp_config, timit=True)
-            pix, flux, err = extract_spectrum_from_indices(final_img, err_img, stripe_indices, method=ext_method,
-                                                           slope=slope, offset=offset, fibs=fibs,
-                                                           slit_height=slit_height,
-                                                           ronmask=ronmask, savefile=True, filetype='fits',
-                                                           obsname=obsname, date=date, pathdict=pathdict,
-                                                           lamp_config=lamp_config, timit=True)
-        else:
-            pix, flux, err = extract_spectrum(stripes, err_stripes=err_stripes, ron_stripes=ron_stripes, method='quick',
-                                              slit_height=qsh, ronmask=ronmask, savefile=True,
-                                              filetype='fits', obsname=obsname, date=date, pathdict=pathdict,
-                                              lamp_config=lamp_config, timit=True)
-            pix, flux, err = extract_spectrum(stripes, err_stripes=err_stripes, ron_stripes=ron_stripes,
-                                              method=ext_method, slope=slope, offset=offset, fibs=fibs,
-                                              slit_height=slit_height, ronmask=ronmask, savefile=True, filetype='fits',
-                                              obsname=obsname, date=date, pathdict=pathdict, lamp_config=lamp_config,
-                                              timit=True)
-
-    #         # (7) get relative intensities of different fibres
-    #         if from_indices:
-    #             relints = get_relints_from_indices(P_id, final_img, err_img, stripe_indices, mask=mask, sampling_size=sampling_size, slit_height=slit_height, return_full=False, timit=True)
-    #         else:
-    #             relints = get_relints(P_id, stripes, err_stripes, mask=mask, sampling_size=sampling_size, slit_height=slit_height, return_full=False, timit=True)
-    #
-    #
-    #         # (8) get wavelength solution
-    #         #XXXXX
-
-    # # (9) get barycentric correction
-    # if obstype == 'stellar':
-    #     bc = get_barycentric_correction(filename)
-    #     bc = np.round(bc,2)
-    #     if np.isnan(bc):
-    #         bc = ''
-    #     # write the barycentric correction into the FITS header of both the quick-extracted and the optimal-extracted reduced spectrum files
-    #     outfn_list = glob.glob(path + '*' + obsname + '*extracted*')
-    #     for outfn in outfn_list:
-    #         pyfits.setval(outfn, 'BARYCORR', value=bc, comment='barycentric velocity correction [m/s]')
-
-    #         #now append relints, wl-solution, and barycorr to extracted FITS file header
-    #         outfn = path + obsname + '_extracted.fits'
-    #         if os.path.isfile(outfn):
-    #             #relative fibre intensities
-    #             dum = append_relints_to_FITS(relints, outfn, nfib=19)
-    #             #wavelength solution
-    #             #pyfits.setval(fn, 'RELINT' + str(i + 1).zfill(2), value=relints[i], comment='fibre #' + str(fibnums[i]) + ' - ' + fibinfo[i] + ' fibre')
+                pix, flux, err = extract_spectrum(stripes, err_stripes=err_stripes, ron_stripes=ron_stripes, method='quick',
+                                                  slit_height=qsh, ronmask=ronmask, savefile=True,
+                                                  filetype='fits', obsname=obsname, date=date, pathdict=pathdict,
+                                                  lamp_config=lamp_config, timit=True)
+                pix, flux, err = extract_spectrum(stripes, err_stripes=err_stripes, ron_stripes=ron_stripes,
+                                                  method=ext_method, slope=slope, offset=offset, fibs=fibs,
+                                                  slit_height=slit_height, ronmask=ronmask, savefile=True, filetype='fits',
+                                                  obsname=obsname, date=date, pathdict=pathdict, lamp_config=lamp_config,
+                                                  drift=drift, timit=True)
+
+        #         # (7) get relative intensities of different fibres
+        #         if from_indices:
+        #             relints = get_relints_from_indices(P_id, final_img, err_img, stripe_indices, mask=mask, sampling_size=sampling_size, slit_height=slit_height, return_full=False, timit=True)
+        #         else:
+        #             relints = get_relints(P_id, stripes, err_stripes, mask=mask, sampling_size=sampling_size, slit_height=slit_height, return_full=False, timit=True)
+        #
+        #
+        #         # (8) get wavelength solution
+        #         #XXXXX
+
+        # # (9) get barycentric correction
+        # if obstype == 'stellar':
+        #     bc = get_barycentric_correction(filename)
+        #     bc = np.round(bc,2)
+        #     if np.isnan(bc):
+        #         bc = ''
+        #     # write the barycentric correction into the FITS header of both the quick-extracted and the optimal-extracted reduced spectrum files
+        #     outfn_list = glob.glob(path + '*' + obsname + '*extracted*')
+        #     for outfn in outfn_list:
+        #         pyfits.setval(outfn, 'BARYCORR', value=bc, comment='barycentric velocity correction [m/s]')
+
+        #         #now append relints, wl-solution, and barycorr to extracted FITS file header
+        #         outfn = path + obsname + '_extracted.fits'
+        #         if os.path.isfile(outfn):
+        #             #relative fibre intensities
+        #             dum = append_relints_to_FITS(relints, outfn, nfib=19)
+        #             #wavelength solution
+        #             #pyfits.setval(fn, 'RELINT' + str(i + 1).zfill(2), value=relints[i], comment='fibre #' + str(fibnums[i]) + ' - ' + fibinfo[i] + ' fibre')
+
+    finally:
+        # clean up the calibrated image stacks (also if the reduction failed)
+        del epoch_stacks
+        shutil.rmtree(scratch_dir, ignore_errors=True)
 
     if timit:
         print('Total time elapsed: ' + str(np.round(time.time() - start_time, 1)) + ' seconds')
@@ -14,7 +14,7 @@ import barycorrpy
 
 from veloce_reduction.veloce_reduction.barycentric_correction import get_bc_from_gaia
 from veloce_reduction.veloce_reduction.wavelength_solution import interpolate_dispsols
-from veloce_reduction.veloce_reduction.cosmic_ray_removal import onedim_medfilt_cosmic_ray_removal
+from veloce_reduction.veloce_reduction.cosmic_ray_removal import batched_onedim_medfilt_cosmic_ray_removal
 
 
 
@@ -291,68 +291,39 @@ def combine_exposures(f_list, err_list, wl_list, osf=5, remove_cosmics=True, thr
     cleaned_f_arr = f_arr.copy()
     
     if remove_cosmics:
-        # LOOP OVER ORDERS
-        for ord in range(f_list[0].shape[0]):
-            if debug_level > 0:
-                if ord == 0:
-                    print('Cleaning cosmics from order ' + str(ord+1).zfill(2)),
-                elif ord == f_list[0].shape[0]-1:
-                    print(' ' + str(ord+1).zfill(2))
-                else:
-                    print(' ' + str(ord+1).zfill(2)),
-            if n_exp == 1:
-                # we have to do it the hard way...
-                print('coffee???')
-            elif n_exp == 2:
-                scales = np.nanmedian(f_arr[:,ord,1000:3000]/f_arr[0,ord,1000:3000], axis=1)
-                # take minimum image after scaling 
-                min_spec = np.minimum(f_arr[0,ord,:]/scales[0], f_arr[1,ord,:]/scales[1])
-                # make sure we don't have negative values for the SQRT (can happen eg b/c of bad pixels in bias subtraction)
-                min_spec = np.clip(min_spec, 0, None)
-                # "expected" STDEV for the minimum image (NOT the proper error of the median); (from LB Eq 2.1)
-                min_sig_arr = np.sqrt(min_spec + 20**2)   # 20 ~ sqrt(19)*4.5 is the equivalent of read noise here, but that's really random; we just dont want to clean noise
-                # get array containing deviations from the minimum spectrum for each exposure
-                diff_spec_arr = f_arr[:,ord,:] / scales.reshape(n_exp, 1) - min_spec
-                # identify cosmic-ray affected pixels
-                cosmics = diff_spec_arr > thresh * min_sig_arr
-                # replace cosmic-ray affected pixels by the (scaled) pixel values in the median image
-                ord_cleaned_f_arr = f_arr[:,ord,:].copy()
-                min_spec_arr = np.vstack([min_spec] * n_exp)
-                ord_cleaned_f_arr[cosmics] = (min_spec_arr * scales.reshape(n_exp, 1))[cosmics]
-                # "grow" the cosmics by 1 pixel in each direction (as in LACosmic)
-                growkernel = np.zeros((3,3))
-                growkernel[1,:] = np.ones(3)
-                extended_cosmics = np.cast['bool'](ndimage.convolve(np.cast['float32'](cosmics), growkernel))
-                cosmic_edges = np.logical_xor(cosmics, extended_cosmics)
-                # now check only for these pixels surrounding the cosmics whether they are affected (but use lower threshold)
-                bad_edges = np.logical_and(diff_spec_arr > low_thresh * min_sig_arr, cosmic_edges)
-                ord_cleaned_f_arr[bad_edges] = (min_spec_arr * scales.reshape(n_exp, 1))[bad_edges]
-                cleaned_f_arr[:,ord,:] = ord_cleaned_f_arr.copy()
+        # all orders are treated at once
+        if debug_level > 0:
+            print('Cleaning cosmics from all ' + str(f_list[0].shape[0]) + ' orders...')
+        if n_exp == 1:
+            # we have to do it the hard way...
+            print('coffee???')
+        else:
+            # (n_exp x n_ord) array of scales relative to the first exposure
+            scales = np.nanmedian(f_arr[:,:,1000:3000]/f_arr[0,:,1000:3000], axis=2)
+            scaled_f_arr = f_arr / scales[:,:,np.newaxis]
+            if n_exp == 2:
+                # take minimum image after scaling
+                ref_spec = np.min(scaled_f_arr, axis=0)
             else:
-                scales = np.nanmedian(f_arr[:,ord,1000:3000]/f_arr[0,ord,1000:3000], axis=1)
-                # take median after scaling 
-                med_spec = np.median(f_arr[:,ord,:] / scales.reshape(n_exp, 1), axis=0)
-                # make sure we don't have negative values for the SQRT (can happen eg b/c of bad pixels in bias subtraction)
-                med_spec = np.clip(med_spec, 0, None)
-                # "expected" STDEV for the median spectrum (NOT the proper error of the median); (from LB Eq 2.1)
-                med_sig_arr = np.sqrt(med_spec + 20**2)   # 20 ~ sqrt(19)*4.5 is the equivalent of read noise here, but that's really random; we just dont want to clean noise
-                # get array containing deviations from the median spectrum for each exposure
-                diff_spec_arr = f_arr[:,ord,:] / scales.reshape(n_exp, 1) - med_spec
-                # identify cosmic-ray affected pixels
-                cosmics = diff_spec_arr > thresh * med_sig_arr
-                # replace cosmic-ray affected pixels by the (scaled) pixel values in the median image
-                ord_cleaned_f_arr = f_arr[:,ord,:].copy()
-                med_spec_arr = np.vstack([med_spec] * n_exp)
-                ord_cleaned_f_arr[cosmics] = (med_spec_arr * scales.reshape(n_exp, 1))[cosmics]
-                # "grow" the cosmics by 1 pixel in each direction (as in LACosmic)
-                growkernel = np.zeros((3,3))
-                growkernel[1,:] = np.ones(3)
-                extended_cosmics = np.cast['bool'](ndimage.convolve(np.cast['float32'](cosmics), growkernel))
-                cosmic_edges = np.logical_xor(cosmics, extended_cosmics)
-                # now check only for these pixels surrounding the cosmics whether they are affected (but use lower threshold)
-                bad_edges = np.logical_and(diff_spec_arr > low_thresh * med_sig_arr, cosmic_edges)
-                ord_cleaned_f_arr[bad_edges] = (med_spec_arr * scales.reshape(n_exp, 1))[bad_edges]
-                cleaned_f_arr[:,ord,:] = ord_cleaned_f_arr.copy()
+                # take median after scaling
+                ref_spec = np.median(scaled_f_arr, axis=0)
+            # make sure we don't have negative values for the SQRT (can happen eg b/c of bad pixels in bias subtraction)
+            ref_spec = np.clip(ref_spec, 0, None)
+            # "expected" STDEV for the minimum / median spectrum (NOT the proper error of the median); (from LB Eq 2.1)
+            ref_sig_arr = np.sqrt(ref_spec + 20**2)   # 20 ~ sqrt(19)*4.5 is the equivalent of read noise here, but that's really random; we just dont want to clean noise
+            # get array containing deviations from the minimum / median spectrum for each exposure
+            diff_spec_arr = scaled_f_arr - ref_spec
+            # identify cosmic-ray affected pixels
+            cosmics = diff_spec_arr > thresh * ref_sig_arr
+            # replace cosmic-ray affected pixels by the (scaled) pixel values in the minimum / median spectrum
+            ref_spec_arr = ref_spec[np.newaxis,:,:] * scales[:,:,np.newaxis]
+            cleaned_f_arr[cosmics] = ref_spec_arr[cosmics]
+            # "grow" the cosmics by 1 pixel in each direction (as in LACosmic), but along the pixel axis only
+            extended_cosmics = ndimage.convolve1d(cosmics.astype('float32'), np.ones(3), axis=-1).astype('bool')
+            cosmic_edges = np.logical_xor(cosmics, extended_cosmics)
+            # now check only for these pixels surrounding the cosmics whether they are affected (but use lower threshold)
+            bad_edges = np.logical_and(diff_spec_arr > low_thresh * ref_sig_arr, cosmic_edges)
+            cleaned_f_arr[bad_edges] = ref_spec_arr[bad_edges]
     
     
     # prepare some arrays
@@ -798,9 +769,7 @@ def main_script_for_timtim(date = '20190621'):
         
         # remove cosmics (from stellar fibres only)
         f_clean = np.zeros(f.shape)
-        for o in range(f.shape[0]):
-            for fib in range(3,22):
-                f_clean[o,fib,:],ncos = onedim_medfilt_cosmic_ray_removal(f_ss[o,fib,:], err_ss[o,fib,:], w=31, thresh=5., low_thresh=3.)
+        f_clean[:,3:22,:],ncos = batched_onedim_medfilt_cosmic_ray_removal(f_ss[:,3:22,:], err_ss[:,3:22,:], w=31, thresh=5., low_thresh=3.)
                 
         # now combine the sky-subtracted and cosmic-cleaned stellar fibres
         comb_f, comb_err, ref_wl = combine_fibres(f_clean, err_ss, wl, osf=5, fibs='stellar')
@@ -13,7 +13,7 @@ from veloce_reduction.veloce_reduction.get_radial_velocity import *
 from veloce_reduction.veloce_reduction.helper_functions import get_snr, short_filenames, wm_and_wsv
 from veloce_reduction.veloce_reduction.flat_fielding import onedim_pixtopix_variations, deblaze_orders
 from veloce_reduction.veloce_reduction.barycentric_correction import get_barycentric_correction
-from veloce_reduction.veloce_reduction.cosmic_ray_removal import onedim_medfilt_cosmic_ray_removal
+from veloce_reduction.veloce_reduction.cosmic_ray_removal import onedim_medfilt_cosmic_ray_removal, batched_onedim_medfilt_cosmic_ray_removal
 
 
 ########################################################################################################################
@@ -203,16 +203,10 @@ smoothed_flat, pix_sens = onedim_pixtopix_variations(mw_flux, filt='gaussian', f
 f0_clean = pyfits.getdata(path + '20200313_837.01_13mar30132' + '_optimal3a_extracted_cleaned.fits')
 
 f0_clean = f0.copy()
-# loop over orders
-for o in range(f0.shape[0]):
-    print('Order ', o + 1)
-    # loop over fibres (but exclude the simThXe and LFC fibres for obvious reasons!!!)
-    for fib in range(1,f0.shape[1]-1):
-        if (o == 0) and (fib == 1):
-            start_time = time.time()
-        f0_clean[o, fib, :], ncos = onedim_medfilt_cosmic_ray_removal(f0[o, fib, :], err0[o, fib, :], w=31, thresh=5., low_thresh=3.)
-        if (o == 38) and (fib == 24):
-            print('time elapsed ', time.time() - start_time, ' seconds')
+start_time = time.time()
+# all orders and fibres at once (but exclude the simThXe and LFC fibres for obvious reasons!!!)
+f0_clean[:, 1:-1, :], ncos = batched_onedim_medfilt_cosmic_ray_removal(f0[:, 1:-1, :], err0[:, 1:-1, :], w=31, thresh=5., low_thresh=3.)
+print('time elapsed ', time.time() - start_time, ' seconds')
 
 
 # NO!!! I think we want to divide by the flat, not the smoothed flat otherwise we're not taking out the pix-to-pix sensitivity variations...
@@ -6,11 +6,23 @@ Created on 5 Feb. 2018
 
 import numpy as np
 import time
+import os
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
 import scipy.sparse as sparse
+from scipy.sparse.csgraph import connected_components
 from scipy.ndimage import label
 import astropy.io.fits as pyfits
 
-from veloce_reduction.veloce_reduction.helper_functions import polyfit2d, polyval2d, fit_poly_surface_2D, sigma_clip
+from veloce_reduction.veloce_reduction.helper_functions import polyfit2d, polyval2d, polyval2d_grid, fit_poly_surface_2D, sigma_clip
+
+
+
+# in-process LRU cache of background models (only the polynomial coefficients are stored), shared by all threads of this process
+BG_MODEL_CACHE = OrderedDict()
+BG_MODEL_CACHE_LOCK = threading.Lock()
 
 
 
@@ -18,11 +30,10 @@ def make_dummy_background(nx=4112, ny=4096):
     # make simulated background
     x = np.repeat(np.arange(nx) - nx/2,nx)
     y = np.tile(np.arange(ny) - ny/2,ny)
-    xx, yy = np.meshgrid(np.linspace(x.min(), x.max(), nx), np.linspace(y.min(), y.max(), ny))
     #m =    [a00,a01,a02,  a03  ,a10,a11,a12,a13,  a20 ,a21,a22,a23, a30 ,a31,a32,a33] for order=3
     parms = [90., 0., 0., 1.5e-9, 0., 0., 0., 0., -4e-9, 0., 0., 0., 1e-9, 0., 0., 0.]
     #parms = np.array([1000., 0., -5.e-5, 0., 0., 0., 0., 0., -5.e-5, 0., 0., 0., 0., 0., 0., 0.])
-    zz_nf = polyval2d(xx, yy, parms)
+    zz_nf = polyval2d_grid(np.linspace(x.min(), x.max(), nx), np.linspace(y.min(), y.max(), ny), parms)
     #add white noise
     noise = np.resize(np.random.normal(0, 1, nx*ny),(ny,nx))
     scaled_noise = noise * np.sqrt(zz_nf)
@@ -227,12 +238,10 @@ def extract_background(img, bgmask, timit=False):
 #     logging.info('Extracting background...')
     print('Extracting background...')
     
-    ny, nx = img.shape
-    xx = np.arange(nx, dtype='f8')
-    yy = np.arange(ny, dtype='f8')
-    x_grid, y_grid = np.meshgrid(xx, yy, copy=False)
+    # coordinates of the background pixels (no need for full-frame coordinate grids)
+    rows, cols = np.nonzero(bgmask)
     
-    mat = sparse.coo_matrix((np.squeeze(np.array(img[bgmask])), (y_grid[bgmask], x_grid[bgmask])), shape=img.shape)
+    mat = sparse.coo_matrix((np.asarray(img)[rows, cols], (rows, cols)), shape=img.shape)
     
     if timit:
         print('Elapsed time: ',time.time() - start_time,' seconds')
@@ -241,10 +250,118 @@ def extract_background(img, bgmask, timit=False):
 
 
 
+def get_order_intervals(P_id, nx, slit_height=25):
+    """
+    Returns the row intervals [start, stop) covered by each order (ie all pixels within 'slit_height' of the order trace) in each column.
+    
+    INPUT:
+    'P_id'         : dictionary of the form of {order: np.poly1d} (as returned by make_P_id / identify_stripes)
+    'nx'           : number of columns
+    'slit_height'  : half the total slit height in pixels
+    
+    OUTPUT:
+    'starts'  : (n_ord x nx)-array of the first rows of the orders (in the sorted order of the keys of P_id)
+    'stops'   : (n_ord x nx)-array of the rows just after the last rows of the orders
+    """
+    xx = np.arange(nx, dtype='f8')
+    traces = np.array([np.poly1d(p)(xx) for o,p in sorted(P_id.items())])
+    # pixel rows r with |r - y| <= slit_height (the first and last rows are checked with exactly that comparison, so that
+    # rounding errors in y -/+ slit_height cannot shift them by one pixel)
+    starts = np.ceil(traces - slit_height).astype(int)
+    starts[np.abs(starts - traces) > slit_height] += 1
+    starts[np.abs(starts - 1 - traces) <= slit_height] -= 1
+    lasts = np.floor(traces + slit_height).astype(int)
+    lasts[np.abs(lasts - traces) > slit_height] -= 1
+    lasts[np.abs(lasts + 1 - traces) <= slit_height] += 1
+    stops = lasts + 1
+    return starts, stops
+
+
+
+def get_interval_pixels(lo, hi):
+    """
+    Expands row intervals [lo, hi) to the coordinates of all the pixels they contain.
+    
+    INPUT:
+    'lo'  : (n_int x nx)-array of the first rows of the intervals in each column
+    'hi'  : (n_int x nx)-array of the rows just after the last rows of the intervals (empty intervals have hi <= lo)
+    
+    OUTPUT:
+    'rows'  : row indices of the pixels
+    'cols'  : column indices of the pixels
+    """
+    lo = np.atleast_2d(lo)
+    hi = np.atleast_2d(hi)
+    lengths = np.clip(hi - lo, 0, None).ravel()
+    seg_x = np.tile(np.arange(lo.shape[1]), lo.shape[0])
+    offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    rows = np.repeat(lo.ravel(), lengths) + offsets
+    cols = np.repeat(seg_x, lengths)
+    return rows, cols
+
+
+
+def get_background_intervals(P_id, ny, nx, slit_height=25, exclude_top_and_bottom=True):
+    """
+    Returns the inter-order (ie background) regions of the chip as row intervals [lo, hi) for each column, ie the gaps between
+    the (merged) order intervals from "get_order_intervals". No full-frame arrays are created.
+    
+    INPUT:
+    'P_id'                    : dictionary of the form of {order: np.poly1d} (as returned by make_P_id / identify_stripes)
+    'ny'                      : number of rows
+    'nx'                      : number of columns
+    'slit_height'             : half the total slit height in pixels
+    'exclude_top_and_bottom'  : boolean - do you want to exclude the top and bottom bits (where there are usually incomplete orders)
+    
+    OUTPUT:
+    'lo'  : ((n_ord+1) x nx)-array of the first rows of the background segments in each column (bottom to top)
+    'hi'  : ((n_ord+1) x nx)-array of the rows just after the last rows of the background segments (empty segments have hi == lo)
+    """
+    
+    starts, stops = get_order_intervals(P_id, nx, slit_height=slit_height)
+    
+    # sort the orders by their starting rows in each column, and merge overlapping orders
+    ix = np.argsort(starts, axis=0, kind='stable')
+    starts = np.take_along_axis(starts, ix, axis=0)
+    stops = np.maximum.accumulate(np.take_along_axis(stops, ix, axis=0), axis=0)
+    
+    # the gaps are [0, start_0), [stop_0, start_1), ..., [stop_n-1, ny)
+    lo = np.clip(np.vstack((np.zeros((1,nx), dtype=int), stops)), 0, ny)
+    hi = np.clip(np.vstack((starts, np.full((1,nx), ny, dtype=int))), 0, ny)
+    hi = np.maximum(hi, lo)
+    
+    # in case we want to exclude the top and bottom parts where incomplete orders are located
+    if exclude_top_and_bottom:
+        print('WARNING: this fix works for the current Veloce CCD layout only!!!')
+        # label connected background regions: segments in neighbouring columns are connected if they share at least one row
+        # (same as the default 4-connectivity of scipy.ndimage.label)
+        nseg = lo.shape[0]
+        nonempty = hi > lo
+        conn = ((lo[:,np.newaxis,:-1] < hi[np.newaxis,:,1:]) & (lo[np.newaxis,:,1:] < hi[:,np.newaxis,:-1]) &
+                nonempty[:,np.newaxis,:-1] & nonempty[np.newaxis,:,1:])
+        k1, k2, x = np.nonzero(conn)
+        graph = sparse.coo_matrix((np.ones(len(x), dtype=bool), (k1 * nx + x, k2 * nx + x + 1)), shape=(nseg*nx, nseg*nx))
+        ncomp, labels = connected_components(graph, directed=False)
+        labels = labels.reshape((nseg, nx))
+        # WARNING: this fix works for the current Veloce CCD layout only!!!
+        # segments containing the top-left, top-right, and bottom-right corners of the chip
+        corners = [(ny-1, 0), (ny-1, nx-1), (0, nx-1)]
+        for r,c in corners:
+            k = np.nonzero((lo[:,c] <= r) & (r < hi[:,c]))[0]
+            if len(k) > 0:
+                remove = labels == labels[k[0], c]
+                hi[remove] = lo[remove]
+    
+    return lo, hi
+
+
+
 def extract_background_pid(img, P_id, slit_height=25, return_mask=False, exclude_top_and_bottom=True, timit=False):
     """
     This function marks all relevant pixels for extraction. Extracts the background (ie the inter-order regions = everything outside the order stripes)
     from the original 2D spectrum to a sparse matrix containing only relevant pixels.
+    The background regions are found as row intervals in each column (see "get_background_intervals"), from which the coordinates 
+    of the background pixels follow directly.
     
     INPUT:
     'img'                     : 2D echelle spectrum [np.array]
@@ -266,40 +383,13 @@ def extract_background_pid(img, P_id, slit_height=25, return_mask=False, exclude
     print('Extracting background...')
 
     ny, nx = img.shape
-    xx = np.arange(nx, dtype='f8')
-    yy = np.arange(ny, dtype='f8')
-    x_grid, y_grid = np.meshgrid(xx, yy, copy=False)
-    bg_mask = np.ones((ny, nx), dtype=bool)
-
-    for o, p in sorted(P_id.items()):
-        
-        # order trace
-        y = np.poly1d(p)(xx)
-        
-        # distance from order trace
-        distance = y_grid - y.repeat(ny).reshape((nx, ny)).T
-        indices = abs(distance) > slit_height
-        
-        # include in global mask
-        bg_mask *= indices
-        
     
-    final_bg_mask = bg_mask.copy()
-    # in case we want to exclude the top and bottom parts where incomplete orders are located
-    if exclude_top_and_bottom:
-        print('WARNING: this fix works for the current Veloce CCD layout only!!!')
-        labelled_mask,nobj = label(bg_mask)
-        # WARNING: this fix works for the current Veloce CCD layout only!!!
-        topleftnumber = labelled_mask[ny-1,0]
-        toprightnumber = labelled_mask[ny-1,nx-1]
-#         bottomleftnumber = labelled_mask[0,0]
-        bottomrightnumber = labelled_mask[0,nx-1]
-        final_bg_mask[labelled_mask == topleftnumber] = False
-        final_bg_mask[labelled_mask == toprightnumber] = False
-        final_bg_mask[labelled_mask == bottomrightnumber] = False
+    lo, hi = get_background_intervals(P_id, ny, nx, slit_height=slit_height, exclude_top_and_bottom=exclude_top_and_bottom)
     
+    # expand the intervals to pixel coordinates
+    rows, cols = get_interval_pixels(lo, hi)
     
-    mat = sparse.coo_matrix((np.squeeze(np.array(img[final_bg_mask])), (y_grid[final_bg_mask], x_grid[final_bg_mask])), shape=(ny, nx))
+    mat = sparse.coo_matrix((np.asarray(img)[rows, cols], (rows, cols)), shape=(ny, nx))
 #     return mat.tocsr()
     
     if timit:
@@ -308,18 +398,70 @@ def extract_background_pid(img, P_id, slit_height=25, return_mask=False, exclude
     if not return_mask:
         return mat.tocsc()
     else:
+        final_bg_mask = np.zeros((ny, nx), dtype=bool)
+        final_bg_mask[rows, cols] = True
         return mat.tocsc(), final_bg_mask
 
 
 
 
 
-def fit_background(bg, deg=5, clip=10, return_full=True, timit=False):
+def bin_background(bg, binsize=32):
+    """
+    Reduces the inter-order regions to a coarse grid of robust block statistics, ie the median value of each inter-order gap within 
+    each bin of 'binsize' columns. A gap is a run of consecutive background rows within a column bin.
+    
+    INPUT:
+    'bg'        : sparse matrix containing the inter-order regions of the 2D image
+    'binsize'   : number of columns per bin
+    
+    OUTPUT:
+    'y'      : mean row index of the pixels in each block
+    'x'      : mean column index of the pixels in each block
+    'z'      : median value of the pixels in each block
+    'npix'   : number of pixels in each block (to be used as weights in the fit)
+    (ie the first three outputs are in the same format as the output from sparse.find)
+    """
+    
+    rows, cols, vals = sparse.find(bg)
+    colbin = cols // binsize
+    
+    # sort by column bin, and by row within each column bin
+    order = np.lexsort((rows, colbin))
+    rows = rows[order]
+    cols = cols[order]
+    vals = vals[order]
+    colbin = colbin[order]
+    
+    # a new block starts wherever the column bin changes, or where there is a gap of more than one row (ie an order in between)
+    newblock = np.r_[True, (colbin[1:] != colbin[:-1]) | (rows[1:] - rows[:-1] > 1)]
+    blockid = np.cumsum(newblock) - 1
+    npix = np.bincount(blockid)
+    
+    # mean positions of the blocks
+    y = np.bincount(blockid, weights=rows) / npix
+    x = np.bincount(blockid, weights=cols) / npix
+    
+    # medians of the blocks (sort values within each block)
+    vals = vals[np.lexsort((vals, blockid))]
+    starts = np.r_[0, np.cumsum(npix)[:-1]]
+    z = 0.5 * (vals[starts + (npix - 1) // 2] + vals[starts + npix // 2])
+    
+    return y, x, z, npix
+
+
+
+
+
+def fit_background(bg, deg=5, clip=10, binsize=None, return_full=True, timit=False):
     """ 
     INPUT:
     'bg'                      : sparse matrix containing the inter-order regions of the 2D image
     'deg'                     : the order of the polynomials to use in the fit (for both dimensions)
     'clip'                    : threshold for sigma clipping (needed to get rid of hot pixels etc)
+    'binsize'                 : if provided, the inter-order regions are first reduced to the median values of blocks of 'binsize' columns 
+                                of each inter-order gap (see "bin_background"), and the polynomial is fit to these (weighted by the number of 
+                                pixels in each block), rather than to every single pixel; the sigma-clipping is then applied to the blocks
     'return_full'             : boolean - if TRUE, then the full image of the background model is returned; otherwise just the set of coefficients that describe it
     'timit'                   : time it...
     
@@ -339,9 +481,15 @@ def fit_background(bg, deg=5, clip=10, return_full=True, timit=False):
     # contents[0] = row indices, ie y-values
     # contents[1] = column indices, ie x-values
     # contents[2] = values
-    contents = sparse.find(bg)
+    if binsize is None:
+        contents = sparse.find(bg)
+        weights = None
+    else:
+        # reduce the inter-order regions to a coarse grid of robust block statistics
+        contents = bin_background(bg, binsize=binsize)
+        weights = contents[3]
     
-    ny, nx = bg.todense().shape
+    ny, nx = bg.shape
     
     # perform sigma-clipping to get rid of hot pixels etc
     z_clean, goodix, badix = sigma_clip(contents[2], clip, return_indices=True)
@@ -353,10 +501,12 @@ def fit_background(bg, deg=5, clip=10, return_full=True, timit=False):
     y_norm = (contents[0][goodix] / ((nx-1)/2.)) - 1.
     x_norm = (contents[1][goodix] / ((ny-1)/2.)) - 1.
 #     z_clean_2 = contents[2][goodix]   # I double-checked and it really is the same as output from sigma_clip!!!
+    if weights is not None:
+        weights = weights[goodix]
     
     
 #     m = polyfit2d(contents[0]-int(ny/2), contents[1]-int(nx/2), contents[2], order=deg)
-    coeffs = polyfit2d(x_norm, y_norm, z_clean, order=deg)
+    coeffs = polyfit2d(x_norm, y_norm, z_clean, order=deg, weights=weights)
     # The result (m) is an array of the polynomial coefficients in the model f  = sum_i sum_j a_ij x^i y^j, 
     # eg:    m = [a00,a01,a02,a03,a10,a11,a12,a13,a20,.....,a33] for order=3
     
@@ -366,12 +516,7 @@ def fit_background(bg, deg=5, clip=10, return_full=True, timit=False):
         start_time_2 = time.time()
     
     if return_full:
-        xx = np.arange(nx)          
-        xxn = (xx / ((nx-1)/2.)) - 1.
-        yy = np.arange(ny)
-        yyn = (yy / ((ny-1)/2.)) - 1.
-        X,Y = np.meshgrid(xxn,yyn)
-        bkgd_img = polyval2d(X,Y,coeffs)
+        bkgd_img = make_background_image(coeffs, (ny,nx))
 #         bkgd_img = polyval2d(Y,X,coeffs)    # IDKY, but the indices are the wrong way around if I do it like in the line above!!!!! 
 #         Ha!!! I know why! I had x_norm and y_norm mixed up above...
     
@@ -422,7 +567,7 @@ def fit_background_astropy(bg, poly_deg=5, clip=10, polytype='chebyshev', return
     # contents[2] = values
     contents = sparse.find(bg)
     
-    ny, nx = bg.todense().shape
+    ny, nx = bg.shape
     
     # perform sigma-clipping to get rid of hot pixels etc
     z_clean, goodix, badix = sigma_clip(contents[2], clip, return_indices=True)
@@ -446,8 +591,7 @@ def fit_background_astropy(bg, poly_deg=5, clip=10, polytype='chebyshev', return
         xxn = (xx / ((nx-1)/2.)) - 1.
         yy = np.arange(ny)
         yyn = (yy / ((ny-1)/2.)) - 1.
-        X,Y = np.meshgrid(xxn,yyn)
-        bkgd_img = bkgd_coeffs(X,Y)
+        bkgd_img = polyval2d_grid(xxn, yyn, bkgd_coeffs)
 #         bkgd_img = bkgd_coeffs(Y,X)     #IDKY, but the indices are the wrong way around if I do it like in the line above!!!!!
 #         Ha!!! I know why! I had x_norm and y_norm mixed up above...
 
@@ -460,3 +604,99 @@ def fit_background_astropy(bg, poly_deg=5, clip=10, polytype='chebyshev', return
         return bkgd_coeffs
 
 
+
+def make_background_image(coeffs, shape, dtype='float64'):
+    """
+    Constructs the full background image from the polynomial coefficients returned by "fit_background".
+    
+    INPUT:
+    'coeffs'  : polynomial coefficients that describe the background model
+    'shape'   : shape (ny,nx) of the image
+    'dtype'   : data type of the output image
+    
+    OUTPUT:
+    'bkgd_img'  : full background image
+    """
+    ny, nx = shape
+    xxn = (np.arange(nx) / ((nx-1)/2.)) - 1.
+    yyn = (np.arange(ny) / ((ny-1)/2.)) - 1.
+    return polyval2d_grid(xxn, yyn, coeffs, dtype=dtype)
+
+
+
+def get_background_model_key(file_list, lamp_config, calib_hash='', bgmask=None, deg=5, clip=10, binsize=None):
+    """
+    Returns the key under which a background model is stored in the background-model cache. The key is made from the
+    list of exposures of the epoch (and lamp configuration) the model was derived from, the lamp configuration, a hash of the 
+    calibration frames used (see "calibration.get_calibration_hash"), the background mask, and the parameters of the fit
+    (see "fit_background"), so that models can never be re-used for a wrong epoch, for different calibrations, or for a
+    different fit.
+    """
+    h = hashlib.sha1(('|'.join(sorted(file_list)) + '|' + lamp_config + '|' + calib_hash + '|' + str(deg) + '|' + str(clip) + '|' + 
+                      str(binsize) + '|').encode())
+    if bgmask is not None:
+        h.update(str(np.shape(bgmask)).encode())
+        h.update(np.packbits(np.asarray(bgmask, dtype=bool)).tobytes())
+    return h.hexdigest()
+
+
+
+def cache_background_model(key, coeffs, maxsize=32, spill_dir=None):
+    """
+    Stores the coefficients of a background model in the in-process LRU cache (evicting the least recently used models once
+    there are more than 'maxsize' of them), and optionally also in a scratch directory.
+    
+    INPUT:
+    'key'        : the cache key (from "get_background_model_key")
+    'coeffs'     : polynomial coefficients that describe the background model
+    'maxsize'    : maximum number of background models held in memory
+    'spill_dir'  : if provided, the coefficients are also written to this (ideally private) directory
+    """
+    coeffs = np.array(coeffs)
+    with BG_MODEL_CACHE_LOCK:
+        BG_MODEL_CACHE[key] = coeffs
+        BG_MODEL_CACHE.move_to_end(key)
+        while len(BG_MODEL_CACHE) > maxsize:
+            BG_MODEL_CACHE.popitem(last=False)
+    if spill_dir is not None:
+        # write to a unique temporary file first, then rename it, so that concurrent workers never see a partially written file
+        fd, tempname = tempfile.mkstemp(suffix='.npy', dir=spill_dir)
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, coeffs)
+        os.replace(tempname, os.path.join(spill_dir, 'bg_model_' + key + '.npy'))
+    return
+
+
+
+def get_cached_background_model(key, maxsize=32, spill_dir=None):
+    """
+    Returns the coefficients of a background model from the in-process LRU cache (or from the scratch directory, if it has been
+    evicted from memory, in which case it is put back into the LRU cache), or None if there is no such model.
+    
+    INPUT:
+    'key'        : the cache key (from "get_background_model_key")
+    'maxsize'    : maximum number of background models held in memory
+    'spill_dir'  : the scratch directory the models have been written to (if any)
+    
+    OUTPUT:
+    'coeffs'  : polynomial coefficients that describe the background model (or None)
+    """
+    with BG_MODEL_CACHE_LOCK:
+        if key in BG_MODEL_CACHE:
+            BG_MODEL_CACHE.move_to_end(key)
+            return BG_MODEL_CACHE[key]
+    if spill_dir is not None and os.path.isfile(os.path.join(spill_dir, 'bg_model_' + key + '.npy')):
+        coeffs = np.load(os.path.join(spill_dir, 'bg_model_' + key + '.npy'))
+        cache_background_model(key, coeffs, maxsize=maxsize)
+        return coeffs
+    return
+
+
+
+def clear_background_model_cache():
+    """
+    Removes all background models from the in-process cache.
+    """
+    with BG_MODEL_CACHE_LOCK:
+        BG_MODEL_CACHE.clear()
+    return
@@ -8,11 +8,15 @@ import astropy.io.fits as pyfits
 import numpy as np
 from itertools import combinations
 import time
+import os
+import tempfile
+import hashlib
 import matplotlib.pyplot as plt
 from scipy import ndimage
 
-from veloce_reduction.veloce_reduction.helper_functions import correct_orientation, sigma_clip, polyfit2d, polyval2d
+from veloce_reduction.veloce_reduction.helper_functions import correct_orientation, sigma_clip, polyfit2d, polyval2d, polyval2d_grid
 from veloce_reduction.veloce_reduction.background import extract_background, fit_background
+from veloce_reduction.veloce_reduction.chipmasks import load_chipmask, get_chipmask_plane
 
 
 
@@ -1208,13 +1212,12 @@ def make_master_bias_from_coeffs(coeffs, nx, ny, savefile=False, path=None, timi
     yy_q1 = np.arange(ny/2)      
     xxn_q1 = (xx_q1 / (((nx/2)-1)/2.)) - 1. 
     yyn_q1 = (yy_q1 / (((ny/2)-1)/2.)) - 1.
-    XX_norm,YY_norm = np.meshgrid(xxn_q1,yyn_q1)
     
     #model the 4 quadrants
-    model_q1 = polyval2d(XX_norm, YY_norm, coeffs_q1)
-    model_q2 = polyval2d(XX_norm, YY_norm, coeffs_q2)
-    model_q3 = polyval2d(XX_norm, YY_norm, coeffs_q3)
-    model_q4 = polyval2d(XX_norm, YY_norm, coeffs_q4)
+    model_q1 = polyval2d_grid(xxn_q1, yyn_q1, coeffs_q1)
+    model_q2 = polyval2d_grid(xxn_q1, yyn_q1, coeffs_q2)
+    model_q3 = polyval2d_grid(xxn_q1, yyn_q1, coeffs_q3)
+    model_q4 = polyval2d_grid(xxn_q1, yyn_q1, coeffs_q4)
     
     #make master bias frame from 4 quadrant models
     master_bias = np.zeros((ny,nx))
@@ -1564,6 +1567,79 @@ def correct_for_bias_and_dark_from_filename(imgname, MB, MD, gain=None, scalable
 
 
 
+def get_calibration_hash(MB, MD, gain=None, scalable=False):
+    """
+    Returns a hash of the calibration frames (and settings) used for the bias- & dark-correction, so that products derived
+    from calibrated images (eg cached background models) can be tied to the exact calibrations they were made with.
+    
+    INPUT:
+    'MB'        : the master bias frame [ADU]
+    'MD'        : the master dark frame [e-]
+    'gain'      : array of gains for each quadrant (in units of e-/ADU)
+    'scalable'  : boolean - is the master dark "scalable"?
+    
+    OUTPUT:
+    'calib_hash'  : hex digest of the hash
+    """
+    h = hashlib.sha1()
+    for frame in [MB, MD]:
+        if frame is None:
+            h.update(b'None')
+        else:
+            h.update(np.ascontiguousarray(frame).tobytes())
+    h.update(str(gain).encode())
+    h.update(str(scalable).encode())
+    return h.hexdigest()
+
+
+
+def make_calibrated_stack(file_list, MB, MD, gain=None, scalable=False, scratch_dir=None, dtype='float32', timit=False):
+    """
+    Bias- & dark-corrects all images of a list (eg all exposures of one epoch) ONCE, and writes them to a single (n_img x ny x nx) 
+    memory-mapped array in a scratch directory. The stack can then be re-used for every exposure of the epoch (eg for the background 
+    estimation with "stack_median_and_min") without having to re-read and re-calibrate the raw images, and without having to hold 
+    all of them in memory at the same time.
+    
+    INPUT:
+    'file_list'    : list of filenames of raw images (incl. directories)
+    'MB'           : the master bias frame (bias only, excluding overscan) [ADU]
+    'MD'           : the master dark frame [e-]
+    'gain'         : the gains for each quadrant [e-/ADU]
+    'scalable'     : boolean - do you want to normalize the dark current to an exposure time of 1s? (ie do you want to make it "scalable"?)
+    'scratch_dir'  : directory for the memory-mapped file (a new private temporary directory is created if not provided)
+    'dtype'        : data type of the stack (single precision by default, which halves the disk space of the stack)
+    'timit'        : boolean - do you want to measure the execution run time?
+    
+    OUTPUT:
+    'stack'  : (n_img x ny x nx) np.memmap of the bias- & dark-corrected images [e-]; the filename is stack.filename (it is up to the 
+               user to delete it when it is no longer needed)
+    """
+    
+    if timit:
+        start_time = time.time()
+    
+    if scratch_dir is None:
+        scratch_dir = tempfile.mkdtemp(prefix='veloce_stack_')
+    
+    fd, outfn = tempfile.mkstemp(suffix='.npy', prefix='calibrated_stack_', dir=scratch_dir)
+    os.close(fd)
+    
+    for n,file in enumerate(file_list):
+        img = correct_for_bias_and_dark_from_filename(file, MB, MD, gain=gain, scalable=scalable, savefile=False)   # [e-]
+        if n == 0:
+            stack = np.lib.format.open_memmap(outfn, mode='w+', dtype=dtype, shape=(len(file_list),) + img.shape)
+        stack[n,:,:] = img
+    stack.flush()
+    
+    if timit:
+        print('Time elapsed: ' + str(np.round(time.time() - start_time,1)) + ' seconds')
+    
+    return stack
+
+
+
+
+
 def make_master_calib(file_list, lamptype=None, MB=None, ronmask=None, MD=None, gain=None, chipmask=None, scalable=False, remove_bg=True,
                       savefile=True, saveall=False, pathdict=None, debug_level=0, timit=False):
     """
@@ -1729,14 +1805,14 @@ def make_master_calib(file_list, lamptype=None, MB=None, ronmask=None, MD=None,
     # now subtract background (errors remain unchanged)
     if remove_bg:
         if chipmask is None:
-            chipmask = np.load(chipmask_path + 'chipmask_' + date + '.npy').item()
+            chipmask = load_chipmask(chipmask_path + 'chipmask_' + date)
             
         if lamptype.lower() == 'simth':
-            lampmask = chipmask['thxe']
+            lampmask = get_chipmask_plane(chipmask, 'thxe')
         elif lamptype.lower() == 'lfc':
-            lampmask = chipmask['lfc']
+            lampmask = get_chipmask_plane(chipmask, 'lfc')
         else:
-            lampmask = np.logical_or(chipmask['thxe'], chipmask['lfc'])
+            lampmask = np.logical_or(get_chipmask_plane(chipmask, 'thxe'), get_chipmask_plane(chipmask, 'lfc'))
             
         # grow this region by 3 pixels either side to avoid contaminating the background
         growkernel = np.ones((7,7))
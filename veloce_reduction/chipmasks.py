@@ -5,9 +5,119 @@ Created on 8 Oct. 2018
 '''
 import numpy as np
 import time
+import os
 from scipy.ndimage import label
 
 
+# bit values of the different mask types in the bit-packed chipmask (see "make_packed_chipmask")
+CHIPMASK_BITS = {'stellar':1, 'sky2':2, 'sky3':4, 'thxe':8, 'lfc':16, 'bg':32}
+
+
+
+
+
+def get_chipmask_boundaries(fibparms, meansep, order, masktype='stellar', use_lfc=False):
+    """
+    Returns the upper and lower boundaries (in spatial direction, for all pixel columns) of the region of one order that belongs to one chipmask type.
+    For masktype 'bg' / 'background' these are the boundaries of the region that is NOT background.
+
+    INPUT:
+    'fibparms'  : dictionary containing the fibre profile parameters (incl. the traces 'mu_fit' for all pixel columns)
+    'meansep'   : dictionary containing the mean fibre separations (from "get_mean_fibre_separation")
+    'order'     : the order (eg 'order_01')
+    'masktype'  : one of ["stellar" / "sky2" / "sky3" / "lfc" / "thxe" / "background" or "bg"]
+    'use_lfc'   : boolean - do you want to use the trace of the LFC fibre (if available) for the boundaries?
+
+    OUTPUT:
+    'f_upper'  : the upper boundary for all pixel columns
+    'f_lower'  : the lower boundary for all pixel columns
+    """
+
+    if masktype.lower() == 'stellar':
+        # for the object-fibres chipmask, take the middle between the last object fibre and first sky fibre at each end (ie the "gaps")
+        f_upper = 0.5 * (fibparms[order]['fibre_04']['mu_fit'] + fibparms[order]['fibre_06']['mu_fit'])
+        f_lower = 0.5 * (fibparms[order]['fibre_24']['mu_fit'] + fibparms[order]['fibre_26']['mu_fit'])
+    elif masktype.lower() == 'sky2':
+        # for the 2 sky fibres near the ThXe, we use the "gap" as the upper bound, and as the lower bound either (i) the midpoint between the lowest sky2 fibre and
+        # the simThXe fibre, or (ii) the trace of the lowermost sky fibre minus half the average fibre separation for this order and pixel location
+        f_upper = 0.5 * (fibparms[order]['fibre_24']['mu_fit'] + fibparms[order]['fibre_26']['mu_fit'])
+        try:
+            f_lower = 0.5 * (fibparms[order]['fibre_27']['mu_fit'] + fibparms[order]['fibre_28']['mu_fit'])
+        except:
+            f_lower = 1 * fibparms[order]['fibre_27']['mu_fit']     # the multiplication with one acts like a copy
+            f_lower -= 0.5 * meansep[order]
+    elif masktype.lower() == 'sky3':
+        # for the 3 sky fibres near the LFC, we use the "gap" as the lower bound, and as the upper bound either (i) the midpoint between the uppermost sky3 fibre and
+        # the LFC fibre, or (ii) the trace of the uppermost sky fibre plus half the average fibre separation for this order and pixel location
+        if use_lfc:
+            try:
+                f_upper = 0.5 * (fibparms[order]['fibre_02']['mu_fit'] + fibparms[order]['fibre_01']['mu_fit'])
+            except:
+                f_upper = 1 * fibparms[order]['fibre_02']['mu_fit']     # the multiplication with one acts like a copy
+                f_upper += 0.5 * meansep[order]
+        else:
+            f_upper = 1 * fibparms[order]['fibre_02']['mu_fit']     # the multiplication with one acts like a copy
+            f_upper += 0.5 * meansep[order]
+        f_lower = 0.5 * (fibparms[order]['fibre_04']['mu_fit'] + fibparms[order]['fibre_06']['mu_fit'])
+    elif masktype.lower() == 'lfc':
+        # for the LFC fibre, we assume as the lower bound either (i) the midpoint between the uppermost sky3 fibre and the LFC fibre, or (ii) the trace of the uppermost 
+        # sky fibre plus half the average fibre separation for this order and pixel location; as the upper bound either (i) the trace of the LFC fibre plus half the average 
+        # fibre separation for this order and pixel location, or (ii) the trace of the uppermost sky3 fibre plus one and a half times the average fibre separation for this
+        # order and pixel location
+        if use_lfc:
+            try:
+                f_upper = 1 * fibparms[order]['fibre_01']['mu_fit']     # the multiplication with one acts like a copy
+                f_upper += 0.5 * meansep[order]
+                f_lower = 0.5 * (fibparms[order]['fibre_01']['mu_fit'] + fibparms[order]['fibre_02']['mu_fit'])
+            except:
+                f_upper = 1 * fibparms[order]['fibre_02']['mu_fit']     # the multiplication with one acts like a copy
+                f_upper += 1.5 * meansep[order]
+                f_lower = 1 * fibparms[order]['fibre_02']['mu_fit']     # the multiplication with one acts like a copy
+                f_lower += 0.5 * meansep[order]
+        else:
+            f_upper = 1 * fibparms[order]['fibre_02']['mu_fit']     # the multiplication with one acts like a copy
+            f_upper += 1.5 * meansep[order]
+            f_lower = 1 * fibparms[order]['fibre_02']['mu_fit']     # the multiplication with one acts like a copy
+            f_lower += 0.5 * meansep[order]
+    elif masktype.lower() == 'thxe':
+        # for the simThXe fibre, we assume as the lower bound either (i) the trace of the simThXe fibre minus half the average fibre separation for this order and pixel 
+        # location, or (ii) the trace of the lowermost sky2 fibre minus one and a half times the average fibre separation for this order and pixel location; as the upper
+        # bound either (i) the midpoint between the lowermost sky2 fibre and the simThXe fibre, or (ii) the trace of the lowermost sky2 fibre minus one a half times the 
+        # average fibre separation for this order and pixel location
+        try:
+            f_upper = 0.5 * (fibparms[order]['fibre_27']['mu_fit'] + fibparms[order]['fibre_28']['mu_fit'])
+            f_lower = 1 * fibparms[order]['fibre_28']['mu_fit']     # the multiplication with one acts like a copy
+            f_lower -= 0.5 * meansep[order]
+        except:
+            f_upper = 1 * fibparms[order]['fibre_27']['mu_fit']     # the multiplication with one acts like a copy
+            f_upper -= 0.5 * meansep[order]
+            f_lower = 1 * fibparms[order]['fibre_27']['mu_fit']     # the multiplication with one acts like a copy
+            f_lower -= 1.5 * meansep[order]
+    elif masktype.lower() in ['background', 'bg']:
+        # could either do sth like 1. - np.sum(chipmask_i), but we can also just use the lower bound of ThXe and the upper bound of LFC
+        # identify what is NOT background, and later "invert" that
+        if use_lfc:
+            try:
+                f_upper = 1 * fibparms[order]['fibre_01']['mu_fit']     # the multiplication with one acts like a copy
+                f_upper += 1. * meansep[order]     # use whole meansep here to avoid contamination from the calib sources a bit more
+                f_lower = 1 * fibparms[order]['fibre_28']['mu_fit']     # the multiplication with one acts like a copy
+                f_lower -= 1. * meansep[order]     # use whole meansep here to avoid contamination from the calib sources a bit more
+            except:
+                f_upper = 1 * fibparms[order]['fibre_02']['mu_fit']     # the multiplication with one acts like a copy
+                f_upper += 2. * meansep[order]     # use 2 here to avoid contamination from the calib sources a bit more
+                f_lower = 1 * fibparms[order]['fibre_27']['mu_fit']     # the multiplication with one acts like a copy
+                f_lower -= 2. * meansep[order]     # use 2 here to avoid contamination from the calib sources a bit more
+        else:
+            f_upper = 1 * fibparms[order]['fibre_02']['mu_fit']     # the multiplication with one acts like a copy
+            f_upper += 2. * meansep[order]     # use 2 here to avoid contamination from the calib sources a bit more
+            try:
+                f_lower = 1 * fibparms[order]['fibre_28']['mu_fit']     # the multiplication with one acts like a copy
+                f_lower -= 1. * meansep[order]  
+            except:
+                f_lower = 1 * fibparms[order]['fibre_27']['mu_fit']     # the multiplication with one acts like a copy
+                f_lower -= 2. * meansep[order]     # use 2 here to avoid contamination from the calib sources a bit more
+
+    return f_upper, f_lower
 
 
 
@@ -34,89 +144,7 @@ def make_single_chipmask(fibparms, meansep, masktype='stellar', exclude_top_and_
         if debug_level >= 1:
             print('Checking ' + order)
 
-        if masktype.lower() == 'stellar':
-            # for the object-fibres chipmask, take the middle between the last object fibre and first sky fibre at each end (ie the "gaps")
-            f_upper = 0.5 * (fibparms[order]['fibre_04']['mu_fit'] + fibparms[order]['fibre_06']['mu_fit'])
-            f_lower = 0.5 * (fibparms[order]['fibre_24']['mu_fit'] + fibparms[order]['fibre_26']['mu_fit'])
-        elif masktype.lower() == 'sky2':
-            # for the 2 sky fibres near the ThXe, we use the "gap" as the upper bound, and as the lower bound either (i) the midpoint between the lowest sky2 fibre and
-            # the simThXe fibre, or (ii) the trace of the lowermost sky fibre minus half the average fibre separation for this order and pixel location
-            f_upper = 0.5 * (fibparms[order]['fibre_24']['mu_fit'] + fibparms[order]['fibre_26']['mu_fit'])
-            try:
-                f_lower = 0.5 * (fibparms[order]['fibre_27']['mu_fit'] + fibparms[order]['fibre_28']['mu_fit'])
-            except:
-                f_lower = 1 * fibparms[order]['fibre_27']['mu_fit']     # the multiplication with one acts like a copy
-                f_lower -= 0.5 * meansep[order]
-        elif masktype.lower() == 'sky3':
-            # for the 3 sky fibres near the LFC, we use the "gap" as the lower bound, and as the upper bound either (i) the midpoint between the uppermost sky3 fibre and
-            # the LFC fibre, or (ii) the trace of the uppermost sky fibre plus half the average fibre separation for this order and pixel location
-            if use_lfc:
-                try:
-                    f_upper = 0.5 * (fibparms[order]['fibre_02']['mu_fit'] + fibparms[order]['fibre_01']['mu_fit'])
-                except:
-                    f_upper = 1 * fibparms[order]['fibre_02']['mu_fit']     # the multiplication with one acts like a copy
-                    f_upper += 0.5 * meansep[order]
-            else:
-                f_upper = 1 * fibparms[order]['fibre_02']['mu_fit']     # the multiplication with one acts like a copy
-                f_upper += 0.5 * meansep[order]
-            f_lower = 0.5 * (fibparms[order]['fibre_04']['mu_fit'] + fibparms[order]['fibre_06']['mu_fit'])
-        elif masktype.lower() == 'lfc':
-            # for the LFC fibre, we assume as the lower bound either (i) the midpoint between the uppermost sky3 fibre and the LFC fibre, or (ii) the trace of the uppermost 
-            # sky fibre plus half the average fibre separation for this order and pixel location; as the upper bound either (i) the trace of the LFC fibre plus half the average 
-            # fibre separation for this order and pixel location, or (ii) the trace of the uppermost sky3 fibre plus one and a half times the average fibre separation for this
-            # order and pixel location
-            if use_lfc:
-                try:
-                    f_upper = 1 * fibparms[order]['fibre_01']['mu_fit']     # the multiplication with one acts like a copy
-                    f_upper += 0.5 * meansep[order]
-                    f_lower = 0.5 * (fibparms[order]['fibre_01']['mu_fit'] + fibparms[order]['fibre_02']['mu_fit'])
-                except:
-                    f_upper = 1 * fibparms[order]['fibre_02']['mu_fit']     # the multiplication with one acts like a copy
-                    f_upper += 1.5 * meansep[order]
-                    f_lower = 1 * fibparms[order]['fibre_02']['mu_fit']     # the multiplication with one acts like a copy
-                    f_lower += 0.5 * meansep[order]
-            else:
-                f_upper = 1 * fibparms[order]['fibre_02']['mu_fit']     # the multiplication with one acts like a copy
-                f_upper += 1.5 * meansep[order]
-                f_lower = 1 * fibparms[order]['fibre_02']['mu_fit']     # the multiplication with one acts like a copy
-                f_lower += 0.5 * meansep[order]
-        elif masktype.lower() == 'thxe':
-            # for the simThXe fibre, we assume as the lower bound either (i) the trace of the simThXe fibre minus half the average fibre separation for this order and pixel 
-            # location, or (ii) the trace of the lowermost sky2 fibre minus one and a half times the average fibre separation for this order and pixel location; as the upper
-            # bound either (i) the midpoint between the lowermost sky2 fibre and the simThXe fibre, or (ii) the trace of the lowermost sky2 fibre minus one a half times the 
-            # average fibre separation for this order and pixel location
-            try:
-                f_upper = 0.5 * (fibparms[order]['fibre_27']['mu_fit'] + fibparms[order]['fibre_28']['mu_fit'])
-                f_lower = 1 * fibparms[order]['fibre_28']['mu_fit']     # the multiplication with one acts like a copy
-                f_lower -= 0.5 * meansep[order]
-            except:
-                f_upper = 1 * fibparms[order]['fibre_27']['mu_fit']     # the multiplication with one acts like a copy
-                f_upper -= 0.5 * meansep[order]
-                f_lower = 1 * fibparms[order]['fibre_27']['mu_fit']     # the multiplication with one acts like a copy
-                f_lower -= 1.5 * meansep[order]
-        elif masktype.lower() in ['background', 'bg']:
-            # could either do sth like 1. - np.sum(chipmask_i), but we can also just use the lower bound of ThXe and the upper bound of LFC
-            # identify what is NOT background, and later "invert" that
-            if use_lfc:
-                try:
-                    f_upper = 1 * fibparms[order]['fibre_01']['mu_fit']     # the multiplication with one acts like a copy
-                    f_upper += 1. * meansep[order]     # use whole meansep here to avoid contamination from the calib sources a bit more
-                    f_lower = 1 * fibparms[order]['fibre_28']['mu_fit']     # the multiplication with one acts like a copy
-                    f_lower -= 1. * meansep[order]     # use whole meansep here to avoid contamination from the calib sources a bit more
-                except:
-                    f_upper = 1 * fibparms[order]['fibre_02']['mu_fit']     # the multiplication with one acts like a copy
-                    f_upper += 2. * meansep[order]     # use 2 here to avoid contamination from the calib sources a bit more
-                    f_lower = 1 * fibparms[order]['fibre_27']['mu_fit']     # the multiplication with one acts like a copy
-                    f_lower -= 2. * meansep[order]     # use 2 here to avoid contamination from the calib sources a bit more
-            else:
-                f_upper = 1 * fibparms[order]['fibre_02']['mu_fit']     # the multiplication with one acts like a copy
-                f_upper += 2. * meansep[order]     # use 2 here to avoid contamination from the calib sources a bit more
-                try:
-                    f_lower = 1 * fibparms[order]['fibre_28']['mu_fit']     # the multiplication with one acts like a copy
-                    f_lower -= 1. * meansep[order]  
-                except:
-                    f_lower = 1 * fibparms[order]['fibre_27']['mu_fit']     # the multiplication with one acts like a copy
-                    f_lower -= 2. * meansep[order]     # use 2 here to avoid contamination from the calib sources a bit more
+        f_upper, f_lower = get_chipmask_boundaries(fibparms, meansep, order, masktype=masktype, use_lfc=use_lfc)
 
         # get indices of the pixels that fall into the respective regions
         order_stripe = (YY < f_upper) & (YY > f_lower)
@@ -143,6 +171,111 @@ def make_single_chipmask(fibparms, meansep, masktype='stellar', exclude_top_and_
 
 
 
+def make_packed_chipmask(fibparms, meansep, object_list=['stellar', 'sky2', 'sky3', 'thxe', 'lfc', 'bg'], exclude_top_and_bottom=True, nx=4112, ny=4096,
+                         use_lfc=False, debug_level=0, timit=False):
+    """
+    Creates all chipmasks in a single pass, as one bit-packed uint8 image in which each bit corresponds to one mask type (see CHIPMASK_BITS).
+    Instead of comparing a full meshgrid against the boundaries of each order (as in "make_single_chipmask"), the rows between the boundaries
+    are marked for each pixel column by a +1 / -1 at the first / last+1 row, and a cumulative sum along the columns then fills in the regions.
+    The individual boolean masks can be retrieved with "get_chipmask_plane". The resulting masks are identical to the ones from "make_single_chipmask".
+
+    INPUT:
+    'fibparms'                : dictionary containing the fibre profile parameters (incl. the traces 'mu_fit' for all pixel columns)
+    'meansep'                 : dictionary containing the mean fibre separations (from "get_mean_fibre_separation")
+    'object_list'             : list of the mask types to create
+    'exclude_top_and_bottom'  : boolean - do you want to exclude the top and bottom regions from the background mask (which still include fainter orders etc)?
+    'nx'                      : number of pixel columns
+    'ny'                      : number of pixel rows
+    'use_lfc'                 : boolean - do you want to use the trace of the LFC fibre (if available) for the boundaries?
+    'debug_level'             : for debugging...
+    'timit'                   : boolean - do you want to measure execution run time?
+
+    OUTPUT:
+    'chipmask'  : the bit-packed chipmask (ny, nx)
+    """
+
+    if timit:
+        start_time = time.time()
+
+    chipmask = np.zeros((ny, nx), dtype=np.uint8)
+    xx = np.arange(nx)
+
+    for masktype in object_list:
+
+        if masktype.lower() == 'background':
+            masktype = 'bg'
+
+        # +1 at the first row and -1 after the last row inside the boundaries of each order
+        edges = np.zeros((ny + 1, nx), dtype=np.int16)
+        for order in sorted(fibparms.keys()):
+            if debug_level >= 1:
+                print('Checking ' + order + ' (' + masktype + ')')
+            f_upper, f_lower = get_chipmask_boundaries(fibparms, meansep, order, masktype=masktype, use_lfc=use_lfc)
+            # the rows with f_lower < y < f_upper
+            finite = np.logical_and(np.isfinite(f_upper), np.isfinite(f_lower))
+            first = np.clip(np.floor(np.where(finite, f_lower, 0)).astype(int) + 1, 0, ny)
+            stop = np.clip(np.ceil(np.where(finite, f_upper, 0)).astype(int), 0, ny)
+            ok = np.logical_and(finite, stop > first)
+            edges[first[ok], xx[ok]] += 1
+            edges[stop[ok], xx[ok]] -= 1
+        plane = np.cumsum(edges[:-1], axis=0, dtype=np.int16) > 0
+
+        # for the background we have to invert that mask and (optionally) exclude the top and bottom regions (same as in "make_single_chipmask")
+        if masktype == 'bg':
+            plane = np.invert(plane)
+            if exclude_top_and_bottom:
+                labelled_mask, nobj = label(plane)
+                # WARNING: this fix works for the current Veloce CCD layout only!!!
+                topleftnumber = labelled_mask[ny - 1, 0]
+                bottomrightnumber = labelled_mask[0, nx - 1]
+                plane[labelled_mask == topleftnumber] = False
+                plane[labelled_mask == bottomrightnumber] = False
+
+        chipmask[plane] |= CHIPMASK_BITS[masktype]
+
+    if timit:
+        print('Time elapsed: ' + str(np.round(time.time() - start_time, 1)) + ' seconds')
+
+    return chipmask
+
+
+
+def get_chipmask_plane(chipmask, masktype):
+    """
+    Returns the 2-dim boolean mask for one mask type, either from a bit-packed chipmask (from "make_packed_chipmask"), or from a dictionary
+    of boolean masks (as created by older versions of "make_chipmask").
+    """
+    if masktype.lower() == 'background':
+        masktype = 'bg'
+    if isinstance(chipmask, dict):
+        return chipmask[masktype]
+    return (chipmask & CHIPMASK_BITS[masktype]) != 0
+
+
+
+def get_chipmask_indices(chipmask, masktype):
+    """
+    Returns the flat indices (ie into img.ravel()) of the pixels that belong to one mask type.
+    """
+    return np.flatnonzero(get_chipmask_plane(chipmask, masktype))
+
+
+
+def load_chipmask(filename):
+    """
+    Reads a chipmask from file, either bit-packed (.npz, see "make_packed_chipmask"), or as a pickled dictionary of boolean masks (.npy).
+    If 'filename' has no extension, the .npz version is used if it exists.
+    """
+    if not filename.endswith(('.npy', '.npz')):
+        filename = filename + '.npz' if os.path.isfile(filename + '.npz') else filename + '.npy'
+    if filename.endswith('.npz'):
+        with np.load(filename, allow_pickle=False) as npz:
+            return npz['chipmask']
+    else:
+        return np.load(filename, allow_pickle=True).item()
+
+
+
 def old_make_single_chipmask(fibparms, meansep, masktype='stellar', exclude_top_and_bottom=False, nx=4112, ny=4096):
 
     """OLD ROUTINE, NOT CURRENTLY IN USE!!!"""
@@ -271,7 +404,11 @@ def get_mean_fibre_separation(fibparms, nx=4112):
 
 
 
-def make_chipmask(date, pathdict=None, savefile=False, combined_fibparms=True, timit=False):
+def make_chipmask(date, pathdict=None, savefile=False, combined_fibparms=True, packed=True, timit=False):
+    """
+    Creates the chipmasks for all mask types for one night. If 'packed' is set to TRUE, the result is one bit-packed uint8 image
+    (see "make_packed_chipmask"; use "get_chipmask_plane" to get the boolean mask for one mask type), otherwise a dictionary of boolean masks.
+    """
 
     assert pathdict is not None, 'ERROR: path dictionary not provided!!!'
 
@@ -294,8 +431,11 @@ def make_chipmask(date, pathdict=None, savefile=False, combined_fibparms=True, t
 
     meansep = get_mean_fibre_separation(fibparms)
 
-    for object in object_list:
-        chipmask[object] = make_single_chipmask(fibparms, meansep, masktype=object)
+    if packed:
+        chipmask = make_packed_chipmask(fibparms, meansep, object_list=object_list)
+    else:
+        for object in object_list:
+            chipmask[object] = make_single_chipmask(fibparms, meansep, masktype=object)
 
     # stellar_chipmask = make_single_chipmask(fibparms, meansep, masktype='stellar')
     # sky2_chipmask = make_single_chipmask(fibparms, meansep, masktype='sky2')
@@ -306,7 +446,10 @@ def make_chipmask(date, pathdict=None, savefile=False, combined_fibparms=True, t
     # bg_chipmask_excl = make_single_chipmask(fibparms, meansep, masktype='background', exclude_top_and_bottom=True)
 
     if savefile:
-        np.save(outpath + 'chipmask_' + date + '.npy', chipmask)
+        if packed:
+            np.savez_compressed(outpath + 'chipmask_' + date + '.npz', chipmask=chipmask)
+        else:
+            np.save(outpath + 'chipmask_' + date + '.npy', chipmask)
 
     if timit:
         print('Time elapsed: ' + str(np.round(time.time() - start_time, 1)) + ' seconds')
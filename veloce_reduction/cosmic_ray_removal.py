@@ -7,12 +7,13 @@ Created on 4 Oct. 2017
 from scipy import ndimage
 import numpy as np
 import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import scipy.interpolate as ipol
 import astropy.io.fits as pyfits
 from scipy.signal import medfilt
 import matplotlib.pyplot as plt
 
-from veloce_reduction.veloce_reduction.helper_functions import sigma_clip
+from veloce_reduction.veloce_reduction.helper_functions import sigma_clip, sigma_clip_rows, stack_median_and_min
 
 
 
@@ -24,7 +25,7 @@ def median_remove_cosmics(img_list, main_index=0, scales=None, ronmask=None, thr
     If there are exactly two exposures per epoch, then look at the deviation from the lower one (after scaling).
 
     INPUT:
-    "file_list"  - list of filenames of all exposures for a given epoch of a star
+    "img_list"  - list of all exposures for a given epoch of a star (or an (n_img x ny x nx) stack, eg from "make_calibrated_stack")
 
     TODO:
     how to deal with changing relints??? read paper by Croke 1995 PASP 107:1255
@@ -47,7 +48,7 @@ def median_remove_cosmics(img_list, main_index=0, scales=None, ronmask=None, thr
         ronmask = np.ones(img_list[0].shape) * 4.   # 4 e- per pixel is a sensible guess for the read noise
 
     # this is the image that we want to rid of cosmic rays
-    img = img_list[main_index]
+    img = np.array(img_list[main_index])
 
     ####################################################################################################################
     ##### CRAP: this does not work if the relative intensities between the fibres is varying a lot between individual exposures of a given epoch!!! #####
@@ -65,9 +66,9 @@ def median_remove_cosmics(img_list, main_index=0, scales=None, ronmask=None, thr
     # so let's just scale by exposure time for now (using "scales" variable, ie relative to the main-index-exposure)
     # POSSIBLE IMPROVEMENTS: use CHIPMASK (showing locations of bg , calib, sky, and stellar light), use relints for stellar/sky, just exp time for rest
 
-    # median image
+    # median image (calculated in bands of rows, so we never need to hold the full cube in memory)
     # medimg = np.median(np.array(img_list), axis=0)
-    medimg = np.median(np.array(img_list) / scales.reshape(len(img_list), 1, 1), axis=0)
+    medimg = stack_median_and_min(img_list, scales=scales)
 
     # make sure we don't have negative values for the SQRT (can happen eg b/c of bad pixels in bias subtraction)
     medimg = np.clip(medimg, 0, None)
@@ -158,6 +159,90 @@ def onedim_medfilt_cosmic_ray_removal(f, err, thresh=5., low_thresh=3., w=31, ma
 
 
 
+def batched_onedim_medfilt_cosmic_ray_removal(f, err, thresh=5., low_thresh=3., w=31, maxfilter_size=250, gauss_filter_sigma=15, debug_level=0):
+    """
+    Batched version of "onedim_medfilt_cosmic_ray_removal", which cleans all 1-dim spectra of an extracted spectrum (eg an 
+    (n_ord x n_fib x n_pix) array) at once. All filters are run along the last (ie the pixel) axis of the entire array in single
+    ndimage calls, and the threshold and "grow" logic is vectorized. The result is the same as running "onedim_medfilt_cosmic_ray_removal"
+    on every row separately.
+    
+    INPUT:
+    'f'                   : flux array (any shape, the last axis is the pixel axis)
+    'err'                 : corresponding uncertainty array
+    'thresh'              : threshold (in units of the normalized scatter) for the identification of cosmics
+    'low_thresh'          : lower threshold for the pixels adjacent to the cosmics
+    'w'                   : width of the median filter
+    'maxfilter_size'      : size of the maximum filter used for the rough continuum
+    'gauss_filter_sigma'  : sigma of the Gaussian filter used for the rough continuum
+    'debug_level'         : for debugging...
+    
+    OUTPUT:
+    'f_clean'  : the cleaned flux array
+    'ncos'     : number of cleaned pixels for each row (ie an array of shape f.shape[:-1])
+    """
+    
+    f = np.asarray(f, dtype='float64')
+    err = np.asarray(err, dtype='float64')
+    
+    # all filters only act along the pixel axis
+    f_clean = f.copy()
+    f_sm = medfilt_rows(f, w)
+    err_sm = medfilt_rows(err, w)
+    cont_rough = ndimage.gaussian_filter(ndimage.maximum_filter(f_sm, size=(1,) * (f.ndim - 1) + (maxfilter_size,)), 
+                                         (0,) * (f.ndim - 1) + (gauss_filter_sigma,))
+    # we also need to adjust the threshold according to the normalized scatter of f - f_sm
+    dum = (f - f_sm) / err_sm
+    scatter = np.nanstd(np.where(sigma_clip_rows(dum, 3), dum, np.nan), axis=-1)[..., np.newaxis]
+    cosmics = (dum > thresh * scatter) & (f > cont_rough)
+    f_clean[cosmics] = f_sm[cosmics]
+    
+    # "grow" the cosmics by 1 pixel in each direction (as in LACosmic)
+    extended_cosmics = ndimage.convolve1d(cosmics.astype('float32'), np.ones(3), axis=-1).astype('bool')
+    cosmic_edges = np.logical_xor(cosmics, extended_cosmics)
+    
+    # now check only for these pixels surrounding the cosmics whether they are affected (but use lower threshold)
+    bad_edges = np.logical_and(dum > low_thresh * scatter, cosmic_edges)
+    f_clean[bad_edges] = f_sm[bad_edges]
+    
+    ncos = np.sum(cosmics, axis=-1) + np.sum(bad_edges, axis=-1)
+    
+    if debug_level >= 1:
+        print('Total number of cosmic-ray affected pixels: ', np.sum(ncos))
+    
+    return f_clean, ncos
+
+
+
+
+
+def medfilt_rows(x, w):
+    """
+    Median-filters all rows of an array (ie along the last axis) with a single ndimage call. The result is identical to applying
+    scipy.signal.medfilt(row, w) to every row (ie zero-padded edges). The rows are laid out one after another in a 1-dim array, 
+    separated by (w//2) zeros, so that no window ever reaches into a neighbouring row (1-dim median filters are also much faster 
+    than N-dim median filters with a (1,...,1,w) footprint).
+    
+    INPUT:
+    'x'   : the array to be filtered (any shape, the last axis is the pixel axis)
+    'w'   : width of the median filter (odd number)
+    
+    OUTPUT:
+    'x_sm'  : the median-filtered array
+    """
+    
+    x = np.asarray(x, dtype='float64')
+    npix = x.shape[-1]
+    rows = x.reshape(-1, npix)
+    padded = np.zeros((rows.shape[0], npix + w//2))
+    padded[:,:npix] = rows
+    flat_sm = ndimage.median_filter(padded.ravel(), size=w, mode='constant', cval=0.)
+    
+    return flat_sm.reshape(padded.shape)[:,:npix].reshape(x.shape)
+
+
+
+
+
 def old_onedim_medfilt_cosmic_ray_removal(f, err, w=31, thresh=5., low_thresh=3., debug_level=0):
     f_clean = f.copy()
     f_sm = medfilt(f, w)
@@ -182,7 +267,8 @@ def old_onedim_medfilt_cosmic_ray_removal(f, err, w=31, thresh=5., low_thresh=3.
 
 
 
-def remove_cosmics(img, ronmask, obsname, path, Flim=3.0, siglim=5.0, maxiter=20, savemask=True, savefile=False, save_err=False, verbose=False, timit=False):
+def remove_cosmics(img, ronmask, obsname, path, Flim=3.0, siglim=5.0, maxiter=20, regmask=None, tilesize=512, incremental=True, nbands=1, nthreads=1, 
+                   savemask=True, savefile=False, save_err=False, verbose=False, timit=False):
     """
     Top-level wrapper function for the cosmic-ray cleaning of an image. 
     
@@ -194,6 +280,14 @@ def remove_cosmics(img, ronmask, obsname, path, Flim=3.0, siglim=5.0, maxiter=20
     'Flim'     : lower threshold for the identification of a pixel as a cosmic ray when using L+/F (ie Laplacian image divided by fine-structure image) (= lbarplus/F2 in the implementation below)
     'siglim'   : sigma threshold for identification as cosmic in S_prime
     'maxiter'  : maximum number of iterations
+    'regmask'  : 2-dim boolean mask of the region of interest (eg chipmask['bg']) - if provided, cosmics are only identified and cleaned 
+                 within this region, and only in the bounding boxes of that region within each tile (plus halos); default is the full frame
+    'tilesize' : size of the (square) tiles used to find the bounding boxes of the region of interest (only used if 'regmask' is provided)
+    'incremental' : boolean - if TRUE, iterations after the first one only re-evaluate the neighbourhoods of the cosmics cleaned in the
+                    previous iteration (as nothing can change anywhere else), rather than the full frame / full region
+    'nbands'   : number of row bands the full frame is split into for the identification of the cosmics (see "identify_cosmics"; only used
+                 if 'regmask' is not provided - otherwise the tiles are used)
+    'nthreads' : number of parallel workers used to process the row bands (or the tiles / boxes of the region of interest)
     'savemask' : boolean - do you want to save the cosmic-ray mask?
     'savefile' : boolean - do you want to save the cosmic-ray corrected image?
     'save_err' : boolean - do you want to save the corresponding error array as well? (remains unchanged though)
@@ -217,18 +311,38 @@ def remove_cosmics(img, ronmask, obsname, path, Flim=3.0, siglim=5.0, maxiter=20
     n_new = 0
     cleaned = img.copy()
     
+    #get the regions to work on (skipping tiles that do not contain any pixels of the region of interest)
+    if regmask is not None:
+        boxes = get_region_boxes(regmask, tilesize=tilesize)
+        if verbose:
+            print('Restricting cosmic-ray removal to '+str(len(boxes))+' tiles...')
+    
     #remove cosmics iteratively
     while ((niter == 0) or n_new > 0) and (niter < maxiter):
         print('Now running iteration '+str(niter+1)+'...')
         #go and identify cosmics
-        mask = identify_cosmics(cleaned, ronmask, Flim=Flim, siglim=siglim, verbose=verbose, timit=timit)
+        if incremental and niter > 0:
+            #only pixels in the vicinity of the previously cleaned cosmics can change
+            iter_boxes = get_update_boxes(mask)
+            mask, excl_mask = identify_cosmics_in_region(cleaned, ronmask, regmask, iter_boxes, Flim=Flim, siglim=siglim, return_excl=True, 
+                                                         nthreads=nthreads, verbose=verbose, timit=timit)
+        elif regmask is None:
+            mask = identify_cosmics(cleaned, ronmask, Flim=Flim, siglim=siglim, nbands=nbands, nthreads=nthreads, verbose=verbose, timit=timit)
+        else:
+            mask, excl_mask = identify_cosmics_in_region(cleaned, ronmask, regmask, boxes, Flim=Flim, siglim=siglim, return_excl=True, 
+                                                         nthreads=nthreads, verbose=verbose, timit=timit)
         n_new = np.sum(mask)
         #add to global mask
         global_mask = np.logical_or(global_mask, mask)
         n_cosmics += n_new
         #n_global = np.sum(global_mask)     #should be equal to n_cosmics!!!!! if they're not, this means that some of the "cleaned" cosmics from a previous round are identified as cosmics again!!! well, they're not...
         #now go and clean these newly found cosmics
-        cleaned = clean_cosmics(cleaned, mask, verbose=verbose, timit=timit)
+        if incremental and niter > 0:
+            cleaned = clean_cosmics_in_region(cleaned, mask, iter_boxes, excl_mask=excl_mask, verbose=verbose, timit=timit)
+        elif regmask is None:
+            cleaned = clean_cosmics(cleaned, mask, verbose=verbose, timit=timit)
+        else:
+            cleaned = clean_cosmics_in_region(cleaned, mask, boxes, excl_mask=excl_mask, verbose=verbose, timit=timit)
         niter += 1
     
     #save cosmic-ray mask
@@ -274,7 +388,7 @@ def remove_cosmics(img, ronmask, obsname, path, Flim=3.0, siglim=5.0, maxiter=20
 
 
 
-def identify_cosmics(img, ronmask, Flim=3.0, siglim=5.0, verbose=False, timit=False):
+def identify_cosmics(img, ronmask, Flim=3.0, siglim=5.0, nbands=1, nthreads=1, halo=8, use_processes=False, verbose=False, timit=False):
     """
     This routine identifies cosmic rays via Laplacian edge detection based on the method (ie LACosmic) described by van Dokkum et al., 2001, PASP, 113:1420 
     Should be slightly faster than the python translation of LACosmics by Malte Tewes, as it uses "ndimage" rather than "signal" package for convolution.
@@ -285,6 +399,15 @@ def identify_cosmics(img, ronmask, Flim=3.0, siglim=5.0, verbose=False, timit=Fa
     "Flim"      - lower threshold for the identification of a pixel as a cosmic ray when using L+/F (ie Laplacian image divided by fine-structure image) (= lbarplus/F2 in the implementation below)
     "siglim"    - sigma threshold for identification as cosmic in S_prime
     
+    KWARGS:
+    "nbands"        - number of row bands the image is split into (each band is processed independently; default is one band, ie the full frame)
+    "nthreads"      - number of parallel workers used to process the bands
+    "halo"          - number of extra rows added to either side of each band; the mask at a given pixel only depends on pixels within
+                      6 rows of it, so the default of 8 makes the stitched mask identical to the full-frame mask
+    "use_processes" - boolean - use a pool of processes rather than a pool of threads for the bands
+    "verbose"       - boolean - for user information / debugging...
+    "timit"         - boolean - do you want to measure execution run time?
+    
     OUTPUT:
     "final_mask"   - a boolean mask, where True identifies pixels affected by cosmic rays. This mask has the same dimensions as the input image "img"
     
@@ -300,6 +423,41 @@ def identify_cosmics(img, ronmask, Flim=3.0, siglim=5.0, verbose=False, timit=Fa
     if verbose:
         print('Identifying cosmics...')
     
+    if nbands <= 1:
+        final_mask = identify_cosmics_single_band(img, ronmask, Flim=Flim, siglim=siglim)
+    else:
+        final_mask = identify_cosmics_tiled(img, ronmask, Flim=Flim, siglim=siglim, nbands=nbands, nthreads=nthreads, halo=halo,
+                                            use_processes=use_processes)
+    
+    #user info
+    ncosmic = np.sum(final_mask)
+    if verbose:
+        print('Number of pixels found to be affected by cosmic rays: '+str(ncosmic))
+    
+    #timing
+    if timit:
+        delta_t = time.time() - start_time
+        print('Time taken for cosmic ray identification: '+str(delta_t)+' seconds...')
+    
+    #return the final cosmic mask       ; todo: and total number of cosmics found, and, b/c this is done iteratively the number and locations of cosmics found in the particular iteration
+    return final_mask
+
+
+
+def identify_cosmics_single_band(img, ronmask, Flim=3.0, siglim=5.0):
+    """
+    The actual LACosmic identification for a single image (or a single row band of an image, see "identify_cosmics_tiled").
+    
+    INPUT:
+    "img"       - a 2-dim image (or row band of an image)
+    "ronmask"   - read-out noise in ADUs (either a scalar or an array with the same dimensions as "img")
+    "Flim"      - lower threshold for the identification of a pixel as a cosmic ray when using L+/F (ie Laplacian image divided by fine-structure image) (= lbarplus/F2 in the implementation below)
+    "siglim"    - sigma threshold for identification as cosmic in S_prime
+    
+    OUTPUT:
+    "final_mask"   - a boolean mask, where True identifies pixels affected by cosmic rays
+    """
+    
     #subsample by a factor of 2
     im_sub = subsample(img)
     #Laplacian Kernel
@@ -369,26 +527,347 @@ def identify_cosmics(img, ronmask, Flim=3.0, siglim=5.0, verbose=False, timit=Fa
     final_mask = np.cast['bool'](ndimage.convolve(np.cast['float32'](growcosmics),growkernel))
     final_mask = np.logical_and(S_prime > 0.3*siglim, final_mask)
     
-    #user info
-    ncosmic = np.sum(final_mask)
+    return final_mask
+
+
+
+def identify_cosmics_tiled(img, ronmask, Flim=3.0, siglim=5.0, nbands=8, nthreads=4, halo=8, use_processes=False):
+    """
+    Runs "identify_cosmics_single_band" on overlapping row bands of an image in parallel and stitches the resulting masks back together.
+    Each band is padded with "halo" rows of the actual image on either side, which are discarded again after the identification. The 
+    image edges are left untouched, so that the boundary treatment of the filters (mode='mirror') is the same as for the full frame.
+    
+    INPUT:
+    "img"       - a 2-dim image
+    "ronmask"   - read-out noise in ADUs (either a scalar or an array with the same dimensions as "img")
+    "Flim"      - lower threshold for the identification of a pixel as a cosmic ray when using L+/F
+    "siglim"    - sigma threshold for identification as cosmic in S_prime
+    
+    KWARGS:
+    "nbands"        - number of row bands
+    "nthreads"      - number of parallel workers
+    "halo"          - number of extra rows on either side of each band (needs to be >= 6 for the result to be identical to the full-frame mask)
+    "use_processes" - boolean - use a pool of processes rather than a pool of threads
+    
+    OUTPUT:
+    "final_mask"   - a boolean mask, where True identifies pixels affected by cosmic rays. This mask has the same dimensions as the input image "img"
+    """
+    
+    ny = img.shape[0]
+    nbands = int(np.clip(nbands, 1, ny))
+    # row boundaries of the bands
+    edges = np.linspace(0, ny, nbands + 1).astype(int)
+    
+    # prepare the (haloed) cutouts
+    starts = []
+    stops = []
+    args = []
+    for lo,hi in zip(edges[:-1], edges[1:]):
+        start = max(lo - halo, 0)
+        stop = min(hi + halo, ny)
+        starts.append(start)
+        stops.append(stop)
+        if np.ndim(ronmask) == 2:
+            ron_band = ronmask[start:stop,:]
+        else:
+            ron_band = ronmask
+        args.append((img[start:stop,:], ron_band, Flim, siglim))
+    
+    # identify the cosmics in each band
+    if nthreads > 1:
+        if use_processes:
+            executor = ProcessPoolExecutor(max_workers=nthreads)
+        else:
+            executor = ThreadPoolExecutor(max_workers=nthreads)
+        with executor:
+            futures = [executor.submit(identify_cosmics_single_band, *arg) for arg in args]
+            band_masks = [future.result() for future in futures]
+    else:
+        band_masks = [identify_cosmics_single_band(*arg) for arg in args]
+    
+    # stitch the band masks together (discarding the halos)
+    final_mask = np.zeros(img.shape, dtype='bool')
+    for lo,hi,start,band_mask in zip(edges[:-1], edges[1:], starts, band_masks):
+        final_mask[lo:hi,:] = band_mask[lo-start:hi-start,:]
+    
+    return final_mask
+
+
+
+def get_region_boxes(regmask, tilesize=512, halo=8):
+    """
+    Divides the image into square tiles and finds the bounding box of the region of interest within each tile. Tiles that do not 
+    contain any pixels of the region of interest are skipped entirely.
+    
+    INPUT:
+    "regmask"   - 2-dim boolean mask of the region of interest (eg chipmask['bg'])
+    
+    KWARGS:
+    "tilesize"  - size of the (square) tiles
+    "halo"      - number of extra pixels added to each side of the bounding boxes (clipped at the image edges); this needs to be at least
+                  as large as the dependency range of the LACosmic filters (6 pixels) and half the box size used in "clean_cosmics"
+    
+    OUTPUT:
+    "boxes"     - list of tuples (core, outer), where "core" is the bounding box of the region of interest within a tile, and "outer" is 
+                  that bounding box plus the halo (each a tuple of slices into the image)
+    """
+    
+    ny, nx = regmask.shape
+    boxes = []
+    
+    for y0 in range(0, ny, tilesize):
+        for x0 in range(0, nx, tilesize):
+            tile = regmask[y0:y0+tilesize, x0:x0+tilesize]
+            if not tile.any():
+                continue
+            rows = np.where(tile.any(axis=1))[0]
+            cols = np.where(tile.any(axis=0))[0]
+            ylo, yhi = y0 + rows[0], y0 + rows[-1] + 1
+            xlo, xhi = x0 + cols[0], x0 + cols[-1] + 1
+            core = (slice(ylo, yhi), slice(xlo, xhi))
+            outer = (slice(max(ylo - halo, 0), min(yhi + halo, ny)), slice(max(xlo - halo, 0), min(xhi + halo, nx)))
+            boxes.append((core, outer))
+    
+    return boxes
+
+
+
+def get_update_boxes(mask, halo=8):
+    """
+    Finds the regions of an image that need to be re-evaluated by LACosmic after the pixels in "mask" have been cleaned. The LACosmic 
+    mask at a given pixel only depends on the pixels within 6 pixels of it, so only the neighbourhoods of the cleaned pixels can change.
+    Nearby cosmics are merged into a single box.
+    
+    INPUT:
+    "mask"      - a 2-dim boolean mask of the pixels that have been changed (ie the cosmics cleaned in the previous iteration)
+    
+    KWARGS:
+    "halo"      - size of the neighbourhood that can be affected; also the number of extra pixels added to these neighbourhoods for the 
+                  filtering
+    
+    OUTPUT:
+    "boxes"     - list of tuples (core, outer), in the same format as the output from "get_region_boxes"
+    """
+    
+    ny, nx = mask.shape
+    boxes = []
+    
+    if not mask.any():
+        return boxes
+    
+    #grow the mask by the halo (separable, so this is fast)
+    grown = ndimage.binary_dilation(mask, structure=np.ones((2*halo+1, 1), dtype='bool'))
+    grown = ndimage.binary_dilation(grown, structure=np.ones((1, 2*halo+1), dtype='bool'))
+    labels, nlabels = ndimage.label(grown)
+    
+    for core in ndimage.find_objects(labels):
+        outer = (slice(max(core[0].start - halo, 0), min(core[0].stop + halo, ny)), 
+                 slice(max(core[1].start - halo, 0), min(core[1].stop + halo, nx)))
+        boxes.append((core, outer))
+    
+    return boxes
+
+
+
+def identify_cosmics_in_region(img, ronmask, regmask, boxes, Flim=3.0, siglim=5.0, return_excl=False, boxsize=5, nthreads=1, verbose=False, 
+                               timit=False):
+    """
+    Same as "identify_cosmics", but the filtering is only done within the boxes from "get_region_boxes", and only pixels within the 
+    region of interest can be flagged as cosmics. Away from the region of interest the image is never touched. Because of the halos
+    the mask is identical to the full-frame mask (within the region of interest).
+    The cosmics just outside the region of interest still have to be excluded from the replacement values of the ones inside, so 
+    optionally a second mask is returned, which contains all cosmics within boxsize//2 pixels of the cores of the boxes (regardless of 
+    "regmask"), ie over the full footprint of the replacement boxes in "clean_cosmics_in_region".
+    
+    INPUT:
+    "img"       - a 2-dim image
+    "ronmask"   - read-out noise in ADUs (either a scalar or an array with the same dimensions as "img")
+    "regmask"   - 2-dim boolean mask of the region of interest (can be None, in which case all pixels within the boxes can be flagged)
+    "boxes"     - list of (core, outer) bounding boxes from "get_region_boxes" or "get_update_boxes"
+    "Flim"      - lower threshold for the identification of a pixel as a cosmic ray when using L+/F
+    "siglim"    - sigma threshold for identification as cosmic in S_prime
+    "return_excl" - boolean - do you also want to return the mask of all cosmics over the footprint of the replacement boxes?
+    "boxsize"   - the size of the replacement boxes used in "clean_cosmics_in_region" (must not be larger than 2*(halo-6)+1)
+    "nthreads"  - number of parallel workers used to process the boxes
+    
+    OUTPUT:
+    "final_mask"   - a boolean mask, where True identifies pixels affected by cosmic rays. This mask has the same dimensions as the input image "img"
+    "excl_mask"    - a boolean mask of all cosmics over the footprint of the replacement boxes (only if "return_excl" is set to TRUE)
+    """
+    
+    if timit:
+        start_time = time.time()
+    
     if verbose:
-        print('Number of pixels found to be affected by cosmic rays: '+str(ncosmic))
+        print('Identifying cosmics...')
+    
+    final_mask = np.zeros(img.shape, dtype='bool')
+    if return_excl:
+        excl_mask = np.zeros(img.shape, dtype='bool')
+        pad = int(boxsize)//2
+    
+    # identify the cosmics in each (outer) box
+    args = []
+    for core,outer in boxes:
+        if np.ndim(ronmask) == 2:
+            ron_box = ronmask[outer]
+        else:
+            ron_box = ronmask
+        args.append((img[outer], ron_box, Flim, siglim))
+    if nthreads > 1 and len(boxes) > 1:
+        with ThreadPoolExecutor(max_workers=nthreads) as executor:
+            futures = [executor.submit(identify_cosmics_single_band, *arg) for arg in args]
+            box_masks = [future.result() for future in futures]
+    else:
+        box_masks = [identify_cosmics_single_band(*arg) for arg in args]
+    
+    # combine the masks (the boxes can overlap)
+    for (core,outer),box_mask in zip(boxes, box_masks):
+        # position of the core within the outer box
+        inner = (slice(core[0].start - outer[0].start, core[0].stop - outer[0].start), 
+                 slice(core[1].start - outer[1].start, core[1].stop - outer[1].start))
+        if regmask is None:
+            final_mask[core] = np.logical_or(final_mask[core], box_mask[inner])
+        else:
+            final_mask[core] = np.logical_or(final_mask[core], np.logical_and(box_mask[inner], regmask[core]))
+        if return_excl:
+            # the core plus the footprint of the replacement boxes (within the outer box)
+            foot = (slice(max(core[0].start - pad, outer[0].start), min(core[0].stop + pad, outer[0].stop)), 
+                    slice(max(core[1].start - pad, outer[1].start), min(core[1].stop + pad, outer[1].stop)))
+            foot_inner = (slice(foot[0].start - outer[0].start, foot[0].stop - outer[0].start), 
+                          slice(foot[1].start - outer[1].start, foot[1].stop - outer[1].start))
+            excl_mask[foot] = np.logical_or(excl_mask[foot], box_mask[foot_inner])
+    
+    if verbose:
+        print('Number of pixels found to be affected by cosmic rays: '+str(np.sum(final_mask)))
     
-    #timing
     if timit:
         delta_t = time.time() - start_time
         print('Time taken for cosmic ray identification: '+str(delta_t)+' seconds...')
     
-    #return the final cosmic mask       ; todo: and total number of cosmics found, and, b/c this is done iteratively the number and locations of cosmics found in the particular iteration
-    return final_mask
+    if return_excl:
+        return final_mask, excl_mask
+    else:
+        return final_mask
 
 
 
-def clean_cosmics(img, mask, badpixmask=None, method='median', boxsize=5, verbose=False, timit=False):
+def clean_cosmics_in_region(img, mask, boxes, boxsize=5, excl_mask=None, verbose=False, timit=False):
+    """
+    Same as "clean_cosmics" (with method='median'), but only working on the boxes from "get_region_boxes". Boxes without any cosmics 
+    are skipped. Only the cosmics in "mask" are replaced, but all cosmics in "excl_mask" (eg the ones just outside the region of 
+    interest, from "identify_cosmics_in_region") are excluded from the replacement values as well, so that the result is the same
+    as for the full frame.
+    
+    INPUT:
+    "img"       - a 2-dim image
+    "mask"      - a 2-dim boolean mask, where True identifies pixels affected by cosmic rays (this MUST have the same dimensions as "img"!!!)
+    "boxes"     - list of (core, outer) bounding boxes from "get_region_boxes" or "get_update_boxes"
+    
+    KWARGS:
+    "boxsize"   - the size of the surrounding pixels to be considered (must not be larger than 2*halo+1 used in "get_region_boxes")
+    "excl_mask" - a 2-dim boolean mask of further cosmics that are not replaced, but must not be used for the replacement values
+    "verbose"   - for debugging...
+    "timit"     - boolean - do you want to measure execution run time?
+    
+    OUTPUT:
+    "cleaned"   - the cleaned image
+    """
+    
+    if timit:
+        start_time = time.time()
+    
+    if verbose:
+        print("Cleaning cosmic-affected pixels ...")
+    
+    cleaned = img.copy()
+    
+    for core,outer in boxes:
+        if not mask[core].any():
+            continue
+        # only the cosmics within the core are replaced, but the ones in the halo (and the ones in "excl_mask") are still excluded from the medians
+        box_mask = mask[outer]
+        core_only = np.zeros(box_mask.shape, dtype='bool')
+        inner = (slice(core[0].start - outer[0].start, core[0].stop - outer[0].start), 
+                 slice(core[1].start - outer[1].start, core[1].stop - outer[1].start))
+        core_only[inner] = box_mask[inner]
+        if excl_mask is None:
+            box_cleaned = clean_cosmics(img[outer], box_mask, boxsize=boxsize)
+        else:
+            box_cleaned = clean_cosmics(img[outer], np.logical_or(box_mask, excl_mask[outer]), boxsize=boxsize)
+        cleaned[outer][core_only] = box_cleaned[core_only]
+    
+    if verbose:
+        print("Cleaning done!")
+    
+    if timit:
+        print('Time elapsed: '+str(np.round(time.time() - start_time,1))+' seconds')
+    
+    return cleaned
+
+
+
+def cosmics_in_region_test(ny=512, nx=512, ncosmics=400, bandwidth=16, tilesize=128, seed=None):
+    """
+    Compares the cosmic-ray identification and cleaning within a region of interest ("identify_cosmics_in_region" and 
+    "clean_cosmics_in_region") with the full-frame versions ("identify_cosmics" and "clean_cosmics") for one pass on a synthetic image 
+    with cosmics scattered all over the frame (ie also right next to the edges of the region of interest).
+    
+    INPUT:
+    "ny", "nx"    - dimensions of the synthetic image
+    "ncosmics"    - number of cosmic-ray tracks
+    "bandwidth"   - width of the alternating bands of rows that form the region of interest (and the rest of the image)
+    "tilesize"    - size of the tiles for "get_region_boxes"
+    "seed"        - seed for the random number generator
+    
+    OUTPUT:
+    "n_diff"      - number of pixels that differ between the cleaned images (or the masks) from the two methods
+    """
+    
+    np.random.seed(seed)
+    
+    # smooth background plus a few "orders", with noise
+    yy, xx = np.mgrid[:ny, :nx]
+    img = 100. + 0.05 * xx + 2000. * np.exp(-0.5 * ((yy % 40 - 20) / 3.)**2)
+    img = img + np.random.normal(size=img.shape) * np.sqrt(img + 9.)
+    # add short cosmic-ray tracks
+    for i in range(ncosmics):
+        y0, x0 = np.random.randint(2, ny-2), np.random.randint(2, nx-2)
+        dy, dx = np.random.randint(-1, 2, size=2)
+        for j in range(np.random.randint(1, 4)):
+            img[y0 + j*dy, x0 + j*dx] += np.random.uniform(500., 5000.)
+    ronmask = 3.
+    
+    # region of interest = alternating bands of rows
+    regmask = ((yy // bandwidth) % 2) == 0
+    
+    # full frame
+    mask = identify_cosmics(img, ronmask)
+    cleaned = clean_cosmics(img, mask)
+    
+    # region of interest only
+    boxes = get_region_boxes(regmask, tilesize=tilesize)
+    reg_mask, excl_mask = identify_cosmics_in_region(img, ronmask, regmask, boxes, return_excl=True)
+    reg_cleaned = clean_cosmics_in_region(img, reg_mask, boxes, excl_mask=excl_mask)
+    
+    n_diff = np.sum(reg_mask != np.logical_and(mask, regmask))
+    n_diff += np.sum(reg_cleaned[regmask] != cleaned[regmask])
+    n_diff += np.sum(reg_cleaned[~regmask] != img[~regmask])
+    
+    print('Number of cosmic-affected pixels (full frame / region of interest): '+str(np.sum(mask))+' / '+str(np.sum(reg_mask)))
+    print('Number of pixels that differ: '+str(n_diff))
+    
+    return n_diff
+
+
+
+def clean_cosmics(img, mask, badpixmask=None, method='median', boxsize=5, degpol=2, verbose=False, timit=False):
         """
         This routine replaces the flux in the pixels identified as being affected by cosmics rays (from function "identify_cosmics") with either
         a median value of surrounding non-cosmic-affected pixels, or with the value of a surface fit to the surrounding non-affected pixels,
         depending on the "method" kwarg.
+        All cosmic-affected pixels are treated at once, ie the boxes around them are gathered into one (n_cosmics x boxsize^2) array
+        and the replacement values are computed from that array in a batch.
         
         INPUT:
         "img"          - a 2-dim image
@@ -397,17 +876,18 @@ def clean_cosmics(img, mask, badpixmask=None, method='median', boxsize=5, verbos
                          of the median values or spline interpolation of the replacement values
         
         KWARGS:
-        "method"    - 'median' : the flux values in the cosmic-affected pixels are replaced by the median value of the surrounding non-cosmic-affected pixels
-                    - 'spline' : a cubic spline interpolation is performed through the surrounding non-cosmic-affected pixels and the flux of the cosmic-affected
-                                 pixels is replaced with the interpolated value at their respective locations
+        "method"    - 'median'  : the flux values in the cosmic-affected pixels are replaced by the median value of the surrounding non-cosmic-affected pixels
+                    - 'surface' : a 2-dim polynomial surface of degree "degpol" is fit to the surrounding non-cosmic-affected pixels and the flux of the 
+                                  cosmic-affected pixels is replaced with the value of that surface at their respective locations
+                    - 'spline'  : same as 'surface', but using a (bi-)cubic surface, ie degpol=3
         "boxsize"   - the size of the surrounding pixels to be considered. default value is 5, ie a box of 5x5 pixels centred on the affected pixel
+        "degpol"    - degree of the polynomial surface for method='surface'
         "verbose"   - for debugging...
         "timit"     - boolean - do you want to measure execution run time?
 
         This routine borrows heavily from the python translation of LACosmic by Malte Tewes!
         
-        TODO:
-        implement surface fit method
+        NOTE: if there are too few good pixels in a box for a surface fit, the median value is used instead
         """
         
         if timit:
@@ -431,6 +911,7 @@ def clean_cosmics(img, mask, badpixmask=None, method='median', boxsize=5, verbos
                         return
                     elif choice in ['y','Y','yes','Yes']:
                         print('OK, ignoring bad pixel mask...')
+                        badpixmask = None
                     else:
                         print('Invalid input! Please try again...')
                         choice = None
@@ -438,7 +919,12 @@ def clean_cosmics(img, mask, badpixmask=None, method='median', boxsize=5, verbos
         #check that boxsize is an odd number
         while (boxsize % 2) == 0:
             print('ERROR: size of the box for median/interpolation needs to be an odd number, please try again!')
-            boxsize = input('Enter an odd number for the box size: ')
+            boxsize = int(input('Enter an odd number for the box size: '))
+        
+        if method not in ['median', 'surface', 'spline']:
+            raise RuntimeError('invalid kwarg for "method" !')
+        if method == 'spline':
+            degpol = 3
             
         #create a copy of the image which is to be manipulated
         cleaned = img.copy()
@@ -447,63 +933,69 @@ def clean_cosmics(img, mask, badpixmask=None, method='median', boxsize=5, verbos
             print("Cleaning cosmic-affected pixels ...")
         
         # So...mask is a 2D-array containing False and True, where True means "here is a cosmic"
-        # We want to loop through these cosmics one by one. This is a list of the indices of cosmic affected pixels:
-        cosmicindices = np.argwhere(mask)   
+        # These are the indices of cosmic affected pixels:
+        cy, cx = np.nonzero(mask)
+        if len(cy) == 0:
+            return cleaned
         
-        # We put cosmic ray pixels to np.Inf to flag them :
-        cleaned[mask] = np.Inf
+        # pixels that must not be used for the replacement values (cosmics and otherwise bad pixels)
+        if badpixmask is not None:
+            unusable = np.logical_or(mask, badpixmask)
+        else:
+            unusable = mask
         
-        # Now we want to have a 2 pixel frame of Inf padding around our image.
-        w = cleaned.shape[0]
-        h = cleaned.shape[1]
-        #padsize = floor(boxsize/2.)   #same thing really...
-        padsize = int(boxsize)/2
-        #create this "padarray" so that edge effects are taken care of without the need for awkward for-/if-loops around adge pixels
-        padarray = np.zeros((w+boxsize-1, h+boxsize-1)) + np.Inf
-        padarray[padsize:w+padsize,padsize:h+padsize] = cleaned.copy() # that copy is important, we need 2 independent arrays
+        # offsets of the pixels in a box relative to its centre
+        padsize = int(boxsize)//2
+        dy, dx = np.mgrid[-padsize:padsize+1, -padsize:padsize+1]
+        dy = dy.ravel()
+        dx = dx.ravel()
         
-        # The medians will be evaluated in this padarray, excluding the infinite values (that are either the edges, the cosmic-affected pixels or the otherwise bad pixels)
-        # Now in this copy called padarray, we also put the saturated stars to np.Inf, if available :
-        if badpixmask is not None:
-            padarray[padsize:w+padsize,padsize:h+padsize][badpixmask] = np.Inf
+        # gather all boxes at once (n_cosmics x boxsize^2); pixels outside the image are flagged as unusable, just like the 
+        # pixels in the Inf-padded frame in the original (loop-based) implementation
+        yy = cy[:,np.newaxis] + dy[np.newaxis,:]
+        xx = cx[:,np.newaxis] + dx[np.newaxis,:]
+        inside = (yy >= 0) & (yy < img.shape[0]) & (xx >= 0) & (xx < img.shape[1])
+        yy = np.clip(yy, 0, img.shape[0] - 1)
+        xx = np.clip(xx, 0, img.shape[1] - 1)
+        good = inside & ~unusable[yy,xx]
+        cutouts = np.where(good, img[yy,xx], np.nan)
+        ngood = np.sum(good, axis=1)
         
-        # A loop through every cosmic pixel :
-        for cosmicpos in cosmicindices:
-            x = cosmicpos[0]
-            y = cosmicpos[1]
-#             if verbose:
-#                 print('[x,y] = ['+str(x)+','+str(y)+']')
-            cutout = padarray[x:x+boxsize, y:y+boxsize].ravel() # remember the shift due to the padding !
-            # Now we have our cutout pixels, some of them are np.Inf, which will be ignored for calculating median or interpolating
-            goodcutout = cutout[cutout != np.Inf]
-            
-            if np.alen(goodcutout) >= boxsize*boxsize :
-                # This never happened, but you never know ...
-                #raise RuntimeError, "Mega error in clean !"
-                raise RuntimeError("Mega error in clean !")
-            elif np.alen(goodcutout) > 0 :
-                #WHICH METHOD???
-                if method == 'median':
-                    replacementvalue = np.median(goodcutout)
-                elif method == 'spline':
-                    print('WARNING: THIS IS NOT FULLY IMPLEMENTED YET!!!!!')
-                    box = padarray[x:x+boxsize, y:y+boxsize]
-                    goodbox = np.argwhere(box != np.Inf)
-                    xx = goodbox[:,1]
-                    yy = goodbox[:,0]
-                    zz = goodcutout
-                    spline_func = ipol.interp2d(xx,yy,zz,kind='cubic')
-                    replacementvalue = spline_func(padsize,padsize)
-                else:
-                    #raise RuntimeError, 'invalid kwarg for "method" !'
-                    raise RuntimeError('invalid kwarg for "method" !')
-            else :    
-                # i.e. no good pixels : Shit, a huge cosmic, we will have to improvise ...
-                print("WARNING: Huge cosmic ray encounterd - it fills the entire ("+str(boxsize)+"x"+str(boxsize)+")-pixel cutout! Using backup value...")
-                replacementvalue = np.median(padarray[padarray != np.Inf])    #I don't like this...maybe need to do sth smarter in the future, but I doubt it will ever happen if boxsize is sufficiently large
-            
-            # Now update the cleaned array, but remember the median was calculated from the padarray...otherwise it would depend on the order in which the cosmics are treated!!!
-            cleaned[x, y] = replacementvalue
+        if np.any(ngood >= boxsize*boxsize):
+            # This never happened, but you never know ...
+            raise RuntimeError("Mega error in clean !")
+        
+        replacementvalues = np.zeros(len(cy))
+        
+        # i.e. no good pixels : Shit, a huge cosmic, we will have to improvise ...
+        huge = (ngood == 0)
+        if np.any(huge):
+            print("WARNING: "+str(np.sum(huge))+" huge cosmic ray(s) encounterd - filling the entire ("+str(boxsize)+"x"+str(boxsize)+")-pixel cutout! Using backup value...")
+            replacementvalues[huge] = np.median(img[~unusable])    #I don't like this...maybe need to do sth smarter in the future, but I doubt it will ever happen if boxsize is sufficiently large
+        
+        # masked medians of all boxes
+        replacementvalues[~huge] = np.nanmedian(cutouts[~huge,:], axis=1)
+        
+        # batched least-squares surface fits (the design matrix is the same for every box, only the weights (0/1) differ)
+        if method in ['surface', 'spline']:
+            terms = [(i,j) for i in range(degpol+1) for j in range(degpol+1-i)]
+            A = np.array([dx**i * dy**j for i,j in terms], dtype='float64').T     # (boxsize^2 x nterms)
+            # only fit boxes that have enough good pixels
+            fitix = np.where(ngood >= len(terms) + 1)[0]
+            if len(fitix) > 0:
+                w = good[fitix,:].astype('float64')
+                z = np.where(good[fitix,:], cutouts[fitix,:], 0.)
+                AtWA = np.einsum('pk,np,pl->nkl', A, w, A)
+                AtWz = np.einsum('pk,np->nk', A, w * z)
+                # the surface value at the centre of the box is simply the constant term
+                solvable = np.abs(np.linalg.det(AtWA)) > 1e-8
+                if np.any(solvable):
+                    coeffs = np.linalg.solve(AtWA[solvable], AtWz[solvable][:,:,np.newaxis])[:,:,0]
+                    replacementvalues[fitix[solvable]] = coeffs[:, terms.index((0,0))]
+        
+        # Now update the cleaned array, (all replacement values were calculated from the original image, so this does not depend on the order 
+        # in which the cosmics are treated)
+        cleaned[cy,cx] = replacementvalues
             
         # That's it.
         if verbose:
@@ -515,6 +1007,7 @@ def clean_cosmics(img, mask, badpixmask=None, method='median', boxsize=5, verbos
             
         #return the cleaned image
         return cleaned    
+
             
 
    
@@ -556,7 +1049,7 @@ def rebin(a, newshape):
         
     shape = a.shape
     lenShape = len(shape)
-    factor = np.asarray(shape)/np.asarray(newshape)
+    factor = np.asarray(shape)//np.asarray(newshape)
     #print factor
     #evList = ['a.reshape('] + ['newshape[%d],factor[%d],'%(i,i) for i in xrange(lenShape)] + [')'] + ['.sum(%d)'%(i+1) for i in xrange(lenShape)] + ['/factor[%d]'%i for i in xrange(lenShape)]
     evList = ['a.reshape('] + ['newshape[%d],factor[%d],'%(i,i) for i in range(lenShape)] + [')'] + ['.sum(%d)'%(i+1) for i in range(lenShape)] + ['/factor[%d]'%i for i in range(lenShape)]
@@ -574,4 +1067,4 @@ def rebin2x2(a):
         #raise RuntimeError, "I want even image shapes !"
         raise RuntimeError("I want even image shapes !")
         
-    return rebin(a, inshape/2)         
\ No newline at end of file
+    return rebin(a, inshape//2)         
\ No newline at end of file
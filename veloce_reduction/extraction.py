@@ -9,12 +9,14 @@ import time
 import datetime
 import astropy.io.fits as pyfits
 import os
+import tempfile
 
 from veloce_reduction.veloce_reduction.helper_functions import fibmodel_with_amp, make_norm_profiles_6, short_filenames
 from veloce_reduction.veloce_reduction.spatial_profiles import fit_single_fibre_profile
 from veloce_reduction.veloce_reduction.linalg import linalg_extract_column
 from veloce_reduction.veloce_reduction.order_tracing import flatten_single_stripe, flatten_single_stripe_from_indices, extract_stripes
-from veloce_reduction.veloce_reduction.relative_intensities import get_relints
+from veloce_reduction.veloce_reduction.relative_intensities import get_relints, get_relints_from_etas, append_relints_to_FITS
+from veloce_reduction.veloce_reduction.get_profile_parameters import load_fibparms, get_order_fibparms, save_fibparms_arrays
 
 
 
@@ -323,7 +325,7 @@ def collapse_extract_from_indices(img, err_img, stripe_indices, tramlines, slit_
 
 def optimal_extraction(stripes, err_stripes=None, ron_stripes=None, slit_height=30, date=None, pathdict=None, fibs='all', relints=None, skip_first_order=False,
                        simu=False, phi_onthefly=False, individual_fibres=True, combined_profiles=False, integrate_profiles=False,
-                       slope=False, offset=False, collapse=False, debug_level=0, timit=False):
+                       slope=False, offset=False, collapse=False, drift=None, debug_level=0, timit=False):
 
     """
     This routine performs the optimal extraction of an echelle spectrum following the formalism described in Sharp & Birchall 2010, PASA, 27:91.
@@ -348,6 +350,8 @@ def optimal_extraction(stripes, err_stripes=None, ron_stripes=None, slit_height=
     'slope'              : boolean - do you want to include a slope as an "extra fibre"?
     'offset'             : boolean - do you want to include an offset as an "extra fibre"?
     'collapse'           : boolean - set this keyword to simply do a collapse extract (not recommended - this is a CODING RELIC - TO BE REMOVED; use routine "quick_extract" instead)
+    'drift'              : spatial drift of the spectrum with respect to the fibre profiles [pixels] - either a scalar, or a dictionary (keys = orders) as returned
+                           by "measure_trace_drift"; the profiles are shifted by this amount instead of being refitted
     'debug_level'        : for debugging...
     'timit'              : boolean - do you want to measure execution run time?
 
@@ -398,13 +402,13 @@ def optimal_extraction(stripes, err_stripes=None, ron_stripes=None, slit_height=
     else:
         if date not in ['20181116', '20190127', '20190201']:
 #             fibparms = np.load(pathdict['fp'] + 'archive/fibre_profile_fits_' + date + '.npy').item()
-            fibparms = np.load(pathdict['fp'] + 'archive/combined_fibre_profile_fits_' + date + '.npy').item()
+            fibparms = load_fibparms(pathdict['fp'] + 'archive/combined_fibre_profile_fits_' + date)
             if debug_level > 0:
                 print('OK, loading fibre profiles for ' + date + '...')
         else:
             # have to laod this crutch, as the first order fits were crap for 20181116 / 20190127 / 20190201, so just for order 01 I replaced them with the parms from the following night
 #             fibparms = np.load(pathdict['fp'] + 'archive/fibre_profile_fits_' + date + '_crutch.npy').item()
-            fibparms = np.load(pathdict['fp'] + 'archive/combined_fibre_profile_fits_' + date + '_crutch.npy').item()
+            fibparms = load_fibparms(pathdict['fp'] + 'archive/combined_fibre_profile_fits_' + date + '_crutch')
             if debug_level > 0:
                 print('OK, loading fibre profiles (CRUTCH!!!) for ' + date + '...')
 
@@ -433,7 +437,14 @@ def optimal_extraction(stripes, err_stripes=None, ron_stripes=None, slit_height=
             print(' ' + ordnum),
 
         # fibre profile parameters for that order
-        fppo = fibparms[ord]
+        fppo = get_order_fibparms(fibparms, ord)
+        # spatial drift of this order with respect to the fibre profiles
+        if drift is None:
+            ordshift = 0.
+        elif isinstance(drift, dict):
+            ordshift = drift.get(ord, 0.)
+        else:
+            ordshift = drift
 
         # define stripe
         stripe = stripes[ord]
@@ -522,13 +533,13 @@ def optimal_extraction(stripes, err_stripes=None, ron_stripes=None, slit_height=
             else:
                 # get normalized profiles for all fibres for this cutout
                 if combined_profiles:
-                    phi_laser = np.sum(make_norm_profiles_6(sr[:, i], i, fppo, integrate=integrate_profiles, fibs='laser'), axis=1)
-                    phi_thxe = np.sum(make_norm_profiles_6(sr[:, i], i, fppo, integrate=integrate_profiles, fibs='thxe'), axis=1)
-                    phis_sky3 = make_norm_profiles_6(sr[:, i], i, fppo, integrate=integrate_profiles, fibs='sky3')
+                    phi_laser = np.sum(make_norm_profiles_6(sr[:, i] - ordshift, i, fppo, integrate=integrate_profiles, fibs='laser'), axis=1)
+                    phi_thxe = np.sum(make_norm_profiles_6(sr[:, i] - ordshift, i, fppo, integrate=integrate_profiles, fibs='thxe'), axis=1)
+                    phis_sky3 = make_norm_profiles_6(sr[:, i] - ordshift, i, fppo, integrate=integrate_profiles, fibs='sky3')
                     phi_sky3 = np.sum(phis_sky3, axis=1) / 3.
-                    phis_stellar = make_norm_profiles_6(sr[:, i], i, fppo, integrate=integrate_profiles, fibs='stellar')
+                    phis_stellar = make_norm_profiles_6(sr[:, i] - ordshift, i, fppo, integrate=integrate_profiles, fibs='stellar')
                     phi_stellar = np.sum(phis_stellar * relints, axis=1)
-                    phis_sky2 = make_norm_profiles_6(sr[:, i], i, fppo, integrate=integrate_profiles, fibs='sky2')
+                    phis_sky2 = make_norm_profiles_6(sr[:, i] - ordshift, i, fppo, integrate=integrate_profiles, fibs='sky2')
                     phi_sky2 = np.sum(phis_sky2, axis=1) / 2.
                     phi_sky = (phi_sky3 + phi_sky2) / 2.
                     phi = np.vstack((phi_laser, phi_sky, phi_stellar, phi_thxe)).T
@@ -536,7 +547,7 @@ def optimal_extraction(stripes, err_stripes=None, ron_stripes=None, slit_height=
                     # phi = make_norm_profiles(sr[:,i], ord, i, fibparms)
                     # phi = make_norm_profiles_temp(sr[:,i], ord, i, fibparms)
                     # phi = make_norm_single_profile_temp(sr[:,i], ord, i, fibparms)
-                    phi = make_norm_profiles_6(sr[:, i], i, fppo, integrate=integrate_profiles, slope=slope, offset=offset, fibs=fibs)
+                    phi = make_norm_profiles_6(sr[:, i] - ordshift, i, fppo, integrate=integrate_profiles, slope=slope, offset=offset, fibs=fibs)
 
             # print('WARNING: TEMPORARY offset correction is not commented out!!!')
             # # subtract the median as the offset if BG is not properly corrected for
@@ -647,7 +658,7 @@ def optimal_extraction(stripes, err_stripes=None, ron_stripes=None, slit_height=
 def optimal_extraction_from_indices(img, stripe_indices, err_img=None, ronmask=None, slit_height=30, date=None, pathdict=None, fibs='all',
                                     relints=None, skip_first_order=False, simu=False, phi_onthefly=False, individual_fibres=True,
                                     combined_profiles=False, integrate_profiles=False, slope=False, offset=False,
-                                    collapse=False, debug_level=0, timit=False):
+                                    collapse=False, drift=None, debug_level=0, timit=False):
     """
     This routine performs the optimal extraction of an echelle spectrum following the formalism described in Sharp & Birchall 2010, PASA, 27:91.
     Output is saved in dictionaries ("pix", "flux", "err").
@@ -672,6 +683,8 @@ def optimal_extraction_from_indices(img, stripe_indices, err_img=None, ronmask=N
     'slope'              : boolean - do you want to include a slope as an "extra fibre"?
     'offset'             : boolean - do you want to include an offset as an "extra fibre"?
     'collapse'           : boolean - set this keyword to simply do a collapse extract (not recommended - this is a CODING RELIC - TO BE REMOVED; use routine "quick_extract" instead)
+    'drift'              : spatial drift of the spectrum with respect to the fibre profiles [pixels] - either a scalar, or a dictionary (keys = orders) as returned
+                           by "measure_trace_drift"; the profiles are shifted by this amount instead of being refitted
     'debug_level'        : for debugging...
     'timit'              : boolean - do you want to measure execution run time?
 
@@ -724,13 +737,13 @@ def optimal_extraction_from_indices(img, stripe_indices, err_img=None, ronmask=N
     else:
         if date not in ['20181116', '20190127', '20190201']:
 #             fibparms = np.load(pathdict['fp'] + 'archive/fibre_profile_fits_' + date + '.npy').item()
-            fibparms = np.load(pathdict['fp'] + 'archive/combined_fibre_profile_fits_' + date + '.npy').item()
+            fibparms = load_fibparms(pathdict['fp'] + 'archive/combined_fibre_profile_fits_' + date)
             if debug_level > 0:
                 print('OK, loading fibre profiles for ' + date + '...')
         else:
             # have to laod this crutch, as the first order fits were crap for 20181116 / 20190127 / 20190201, so just for order 01 I replaced them with the parms from the following night
 #             fibparms = np.load(pathdict['fp'] + 'archive/fibre_profile_fits_' + date + '_crutch.npy').item()
-            fibparms = np.load(pathdict['fp'] + 'archive/combined_fibre_profile_fits_' + date + '_crutch.npy').item()
+            fibparms = load_fibparms(pathdict['fp'] + 'archive/combined_fibre_profile_fits_' + date + '_crutch')
             if debug_level > 0:
                 print('OK, loading fibre profiles (CRUTCH!!!) for ' + date + '...')
 
@@ -760,7 +773,14 @@ def optimal_extraction_from_indices(img, stripe_indices, err_img=None, ronmask=N
             print(' ' + ordnum),
 
         # fibre profile parameters for that order
-        fppo = fibparms[ord]
+        fppo = get_order_fibparms(fibparms, ord)
+        # spatial drift of this order with respect to the fibre profiles
+        if drift is None:
+            ordshift = 0.
+        elif isinstance(drift, dict):
+            ordshift = drift.get(ord, 0.)
+        else:
+            ordshift = drift
 
         # define stripe indices
         indices = stripe_indices[ord]
@@ -856,13 +876,13 @@ def optimal_extraction_from_indices(img, stripe_indices, err_img=None, ronmask=N
             else:
                 # get normalized profiles for all fibres for this cutout
                 if combined_profiles:
-                    phi_laser = np.sum(make_norm_profiles_6(sr[:, i], i, fppo, integrate=integrate_profiles, fibs='laser'), axis=1)
-                    phi_thxe = np.sum(make_norm_profiles_6(sr[:, i], i, fppo, integrate=integrate_profiles, fibs='thxe'), axis=1)
-                    phis_sky3 = make_norm_profiles_6(sr[:, i], i, fppo, integrate=integrate_profiles, fibs='sky3')
+                    phi_laser = np.sum(make_norm_profiles_6(sr[:, i] - ordshift, i, fppo, integrate=integrate_profiles, fibs='laser'), axis=1)
+                    phi_thxe = np.sum(make_norm_profiles_6(sr[:, i] - ordshift, i, fppo, integrate=integrate_profiles, fibs='thxe'), axis=1)
+                    phis_sky3 = make_norm_profiles_6(sr[:, i] - ordshift, i, fppo, integrate=integrate_profiles, fibs='sky3')
                     phi_sky3 = np.sum(phis_sky3, axis=1) / 3.
-                    phis_stellar = make_norm_profiles_6(sr[:, i], i, fppo, integrate=integrate_profiles, fibs='stellar')
+                    phis_stellar = make_norm_profiles_6(sr[:, i] - ordshift, i, fppo, integrate=integrate_profiles, fibs='stellar')
                     phi_stellar = np.sum(phis_stellar * relints, axis=1)
-                    phis_sky2 = make_norm_profiles_6(sr[:, i], i, fppo, integrate=integrate_profiles, fibs='sky2')
+                    phis_sky2 = make_norm_profiles_6(sr[:, i] - ordshift, i, fppo, integrate=integrate_profiles, fibs='sky2')
                     phi_sky2 = np.sum(phis_sky2, axis=1) / 2.
                     phi_sky = (phi_sky3 + phi_sky2) / 2.
                     phi = np.vstack((phi_laser, phi_sky, phi_stellar, phi_thxe)).T
@@ -870,7 +890,7 @@ def optimal_extraction_from_indices(img, stripe_indices, err_img=None, ronmask=N
                     # phi = make_norm_profiles(sr[:,i], ord, i, fibparms)
                     # phi = make_norm_profiles_temp(sr[:,i], ord, i, fibparms)
                     # phi = make_norm_single_profile_temp(sr[:,i], ord, i, fibparms)
-                    phi = make_norm_profiles_6(sr[:, i], i, fppo, integrate=integrate_profiles, slope=slope, offset=offset, fibs=fibs)
+                    phi = make_norm_profiles_6(sr[:, i] - ordshift, i, fppo, integrate=integrate_profiles, slope=slope, offset=offset, fibs=fibs)
 
             # print('WARNING: TEMPORARY offset correction is not commented out!!!')
             # # subtract the median as the offset if BG is not properly corrected for
@@ -978,9 +998,39 @@ def optimal_extraction_from_indices(img, stripe_indices, err_img=None, ronmask=N
 
 
 
+def make_extracted_arrays(flux, err):
+    """
+    Stacks the extracted flux and error dictionaries (keys = orders) into arrays for writing to a FITS file. For the optimal extraction 
+    methods (3a, 3b, 3c) flux[ord] is itself a dictionary (keys = fibres or objects), and the output arrays have dimensions 
+    (n_ord, n_fib, npix), with the fibres / objects in ascending order of their names; otherwise they have dimensions (n_ord, npix).
+    
+    INPUT:
+    'flux'  : dictionary (keys = orders) containing the extracted flux
+    'err'   : dictionary (keys = orders) containing the uncertainty in the extracted flux
+    
+    OUTPUT:
+    'fluxarr'  : the extracted flux as an array
+    'errarr'   : the uncertainty in the extracted flux as an array
+    """
+    
+    orders = sorted(flux.keys())
+    
+    if isinstance(flux[orders[0]], dict):
+        fluxarr = np.array([[flux[o][fib] for fib in sorted(flux[o].keys())] for o in orders], dtype=float)
+        errarr = np.array([[err[o][fib] for fib in sorted(err[o].keys())] for o in orders], dtype=float)
+    else:
+        fluxarr = np.array([flux[o] for o in orders], dtype=float)
+        errarr = np.array([err[o] for o in orders], dtype=float)
+    
+    return fluxarr, errarr
+
+
+
+
+
 def extract_spectrum(stripes, err_stripes, ron_stripes, method='optimal', individual_fibres=True, combined_profiles=False, integrate_profiles=False, slope=False,
                      offset=False, fibs='all', slit_height=30, savefile=False, filetype='fits', obsname=None, date=None, pathdict=None, lamp_config=None,
-                     skip_first_order=False, simu=False, verbose=False, timit=False, debug_level=0):
+                     skip_first_order=False, simu=False, drift=None, relints_from_etas=False, verbose=False, timit=False, debug_level=0):
     """
     This routine is simply a wrapper code for the different extraction methods. There are a total FIVE (1,2,3a,3b,3c) different extraction methods implemented, 
     which can be selected by a combination of the 'method', individual_fibres', and 'combined_profile' keyword arguments.
@@ -1029,6 +1079,10 @@ def extract_spectrum(stripes, err_stripes, ron_stripes, method='optimal', indivi
     'lamp_config'        : simcalib lamp configuration (only needed for output filename determination for simcalib frames)
     'skip_first_order'   : boolean - do you want to skip order 01 (causes problems as not fully on chip, and especially b/c LFC trace is rubbish)
     'simu'               : boolean - are you using ES-simulated spectra???
+    'drift'              : spatial drift of the spectrum with respect to the fibre profiles [pixels] (scalar or dictionary, as returned by "measure_trace_drift");
+                           only used for optimal extraction
+    'relints_from_etas'  : boolean - do you want to derive the relative fibre intensities from the extracted fibre amplitudes (see "get_relints_from_etas")
+                           and write them to the output file (FITS header and/or dictionary)? only used for method (3a) with fibs='all' or fibs='stellar'
     'verbose'            : boolean - for debugging...
     'timit'              : boolean - do you want to measure execution run time?
     'debug_level'        : for debugging...
@@ -1066,11 +1120,16 @@ def extract_spectrum(stripes, err_stripes, ron_stripes, method='optimal', indivi
     elif method.lower() == 'optimal':
         pix,flux,err = optimal_extraction(stripes, err_stripes=err_stripes, ron_stripes=ron_stripes, slit_height=slit_height, individual_fibres=individual_fibres,
                                           skip_first_order=skip_first_order, combined_profiles=combined_profiles, integrate_profiles=integrate_profiles, slope=slope, 
-                                          offset=offset, fibs=fibs, date=date, pathdict=pathdict, simu=simu, timit=timit, debug_level=debug_level)
+                                          offset=offset, fibs=fibs, date=date, pathdict=pathdict, simu=simu, drift=drift, timit=timit, debug_level=debug_level)
     else:
         print('ERROR: Nightmare! That should never happen  --  must be an error in the Matrix...')
         return    
     
+    # relative intensities in the stellar fibres straight from the extracted amplitudes (no need to read the image again)
+    relints, err_relints = (None, None)
+    if relints_from_etas and method.lower() == 'optimal' and individual_fibres and fibs.lower() in ['all', 'stellar']:
+        relints, err_relints = get_relints_from_etas(flux, err, fibs=fibs, nfib=19, debug_level=debug_level, timit=timit)
+    
     # now save to FITS file or PYTHON DICTIONARY if desired
     if savefile:
         
@@ -1112,11 +1171,7 @@ def extract_spectrum(stripes, err_stripes, ron_stripes, method='optimal', indivi
                 print('ERROR: file type for output file not recognized!')
                 filetype = raw_input('Which file type do you want to use (valid options are ["fits" / "dict" / "both"] )?') 
             if filetype in ['fits', 'both']:
-                fluxarr = np.zeros((len(pix), len(flux[flux.keys()[0]]), len(pix[pix.keys()[0]])))
-                errarr = np.zeros((len(pix), len(flux[flux.keys()[0]]), len(pix[pix.keys()[0]])))
-                for i,o in enumerate(sorted(pix.keys())):
-                    fluxarr[i,:] = flux[o]
-                    errarr[i,:] = err[o]
+                fluxarr, errarr = make_extracted_arrays(flux, err)
                 # try and get header from previously saved files
                 if os.path.exists(path + date + '_' + obsname + '_BD_CR_BG_FF.fits'):
                     h = pyfits.getheader(path + date + '_' + obsname + '_BD_CR_BG_FF.fits')
@@ -1151,6 +1206,9 @@ def extract_spectrum(stripes, err_stripes, ron_stripes, method='optimal', indivi
                 h_err = h.copy()
                 h_err['HISTORY'] = 'estimated uncertainty in EXTRACTED SPECTRUM - created ' + time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime()) + ' (GMT)'
                 pyfits.append(outfn, np.float32(errarr), h_err, overwrite=True)
+                # add the relative intensities to the header
+                if relints is not None:
+                    append_relints_to_FITS(relints, outfn, err_relints=err_relints)
                 
             if filetype in ['dict', 'both']:
                 # OK, save as a python dictionary
@@ -1159,6 +1217,9 @@ def extract_spectrum(stripes, err_stripes, ron_stripes, method='optimal', indivi
                 extracted['pix'] = pix
                 extracted['flux'] = flux
                 extracted['err'] = err
+                if relints is not None:
+                    extracted['relints'] = relints
+                    extracted['err_relints'] = err_relints
                 np.save(path + date + '_' + starname + '_' + obsname + '_' + method.lower() + submethod + '_extracted.npy', extracted)
         
     return pix,flux,err
@@ -1169,7 +1230,7 @@ def extract_spectrum(stripes, err_stripes, ron_stripes, method='optimal', indivi
 
 def extract_spectrum_from_indices(img, err_img, stripe_indices, ronmask=None, method='optimal', individual_fibres=True, combined_profiles=False, integrate_profiles=False, slope=False,
                                   offset=False, fibs='all', slit_height=30, savefile=False, filetype='fits', obsname=None, date=None, pathdict=None, lamp_config=None,
-                                  skip_first_order=False, simu=False, verbose=False, timit=False, debug_level=0):
+                                  skip_first_order=False, simu=False, drift=None, relints_from_etas=False, verbose=False, timit=False, debug_level=0):
     """
     CLONE OF 'extract_spectrum'! 
     This routine is simply a wrapper code for the different extraction methods. There are a total FIVE (1,2,3a,3b,3c) different extraction methods implemented, 
@@ -1219,6 +1280,10 @@ def extract_spectrum_from_indices(img, err_img, stripe_indices, ronmask=None, me
     'lamp_config'        : simcalib lamp configuration (only needed for output filename determination for simcalib frames)
     'skip_first_order'   : boolean - do you want to skip order 01 (causes problems as not fully on chip, and especially b/c LFC trace is rubbish)
     'simu'               : boolean - are you using ES-simulated spectra???
+    'drift'              : spatial drift of the spectrum with respect to the fibre profiles [pixels] (scalar or dictionary, as returned by "measure_trace_drift");
+                           only used for optimal extraction
+    'relints_from_etas'  : boolean - do you want to derive the relative fibre intensities from the extracted fibre amplitudes (see "get_relints_from_etas")
+                           and write them to the output file (FITS header and/or dictionary)? only used for method (3a) with fibs='all' or fibs='stellar'
     'verbose'            : boolean - for debugging...
     'timit'              : boolean - do you want to measure execution run time?
     'debug_level'        : for debugging...
@@ -1255,11 +1320,16 @@ def extract_spectrum_from_indices(img, err_img, stripe_indices, ronmask=None, me
     elif method.lower() == 'optimal':
         pix,flux,err = optimal_extraction_from_indices(img, stripe_indices, err_img=err_img, ronmask=ronmask, slit_height=slit_height, individual_fibres=individual_fibres,
                                                        combined_profiles=combined_profiles, integrate_profiles=integrate_profiles, slope=slope, offset=offset, fibs=fibs, 
-                                                       skip_first_order=skip_first_order, date=date, pathdict=pathdict, simu=simu, timit=timit, debug_level=debug_level)
+                                                       skip_first_order=skip_first_order, date=date, pathdict=pathdict, simu=simu, drift=drift, timit=timit, debug_level=debug_level)
     else:
         print('ERROR: Nightmare! That should never happen  --  must be an error in the Matrix...')
         return    
         
+    # relative intensities in the stellar fibres straight from the extracted amplitudes (no need to read the image again)
+    relints, err_relints = (None, None)
+    if relints_from_etas and method.lower() == 'optimal' and individual_fibres and fibs.lower() in ['all', 'stellar']:
+        relints, err_relints = get_relints_from_etas(flux, err, fibs=fibs, nfib=19, debug_level=debug_level, timit=timit)
+    
     # now save to FITS file or PYTHON DICTIONARY if desired
     if savefile:
         
@@ -1301,19 +1371,7 @@ def extract_spectrum_from_indices(img, err_img, stripe_indices, ronmask=None, me
                 print('ERROR: file type for output file not recognized!')
                 filetype = raw_input('Which file type do you want to use (valid options are ["fits" / "dict" / "both"] )?') 
             if filetype in ['fits', 'both']:
-                if method.lower() == 'optimal' and submethod == '3a':      # ie for individual-fibre extraction
-                    fluxarr = np.zeros((len(pix), len(flux[flux.keys()[0]]), len(pix[pix.keys()[0]])))
-                    errarr = np.zeros((len(pix), len(flux[flux.keys()[0]]), len(pix[pix.keys()[0]])))
-                    for i,o in enumerate(sorted(pix.keys())):
-                        for j,fib in enumerate(sorted(flux[o].keys())):
-                            fluxarr[i,j,:] = flux[o][fib]
-                            errarr[i,j,:] = err[o][fib]
-                else:
-                    fluxarr = np.zeros((len(pix), len(pix['order_01'])))
-                    errarr = np.zeros((len(pix), len(pix['order_01'])))
-                    for i,o in enumerate(sorted(pix.keys())):
-                        fluxarr[i,:] = flux[o]
-                        errarr[i,:] = err[o]
+                fluxarr, errarr = make_extracted_arrays(flux, err)
                 # try and get header from previously saved files
                 if os.path.exists(path + date + '_' + obsname + '_BD_CR_BG_FF.fits'):
                     h = pyfits.getheader(path + date + '_' + obsname + '_BD_CR_BG_FF.fits')
@@ -1349,6 +1407,9 @@ def extract_spectrum_from_indices(img, err_img, stripe_indices, ronmask=None, me
                 h_err = h.copy()
                 h_err['HISTORY'] = 'estimated uncertainty in EXTRACTED SPECTRUM - created ' + time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime()) + ' (GMT)'
                 pyfits.append(outfn, np.float32(errarr), h_err, overwrite=True)
+                # add the relative intensities to the header
+                if relints is not None:
+                    append_relints_to_FITS(relints, outfn, err_relints=err_relints)
                 
             if filetype in ['dict', 'both']:
                 # OK, save as a python dictionary
@@ -1357,6 +1418,9 @@ def extract_spectrum_from_indices(img, err_img, stripe_indices, ronmask=None, me
                 extracted['pix'] = pix
                 extracted['flux'] = flux
                 extracted['err'] = err
+                if relints is not None:
+                    extracted['relints'] = relints
+                    extracted['err_relints'] = err_relints
                 np.save(path + date + '_' + starname + '_' + obsname + '_' + method.lower() + submethod + '_extracted.npy', extracted)
         
     return pix,flux,err
@@ -1365,6 +1429,73 @@ def extract_spectrum_from_indices(img, err_img, stripe_indices, ronmask=None, me
 
 
 
+def relints_from_etas_test(path=None, nx=200, seed=None):
+    """
+    End-to-end test of the 'relints_from_etas' option of "extract_spectrum_from_indices": creates a synthetic, noise-free single-order frame 
+    from known fibre amplitudes and fibre profiles (saved with "save_fibparms_arrays"), extracts it with method (3a), and compares the 
+    relative intensities in the header of the output FITS file with the injected ones.
+    
+    INPUT:
+    'path'  : directory for the (temporary) input and output files - default is a new temporary directory
+    'nx'    : number of pixel columns
+    'seed'  : seed for the random number generator
+    
+    OUTPUT:
+    'max_diff'  : maximum absolute difference between the relative intensities from the FITS header and the injected ones
+    """
+    
+    if path is None:
+        path = tempfile.mkdtemp() + '/'
+    os.makedirs(path + 'archive/', exist_ok=True)
+    pathdict = {'raw':path, 'fp':path}
+    date = '20200101'
+    obsname = 'test'
+    ny = 80
+    slit_height = 30
+    nfib = 26
+    
+    np.random.seed(seed)
+    
+    # fibre profiles with a slight curvature in the traces
+    xx = np.arange(nx)
+    fppo = {}
+    for j in range(nfib):
+        fppo['fibre_' + str(j + 1).zfill(2)] = {'mu_fit': 14.5 + 2. * j + 1e-5 * (xx - nx/2.)**2, 'sigma_fit': np.repeat(0.8, nx), 
+                                                'beta_fit': np.repeat(2., nx)}
+    save_fibparms_arrays({'order_02':fppo}, path + 'archive/combined_fibre_profile_fits_' + date + '.npz')
+    
+    # synthetic frame from known fibre amplitudes (in the order of the extracted fibres)
+    amps = 1000. * np.random.uniform(0.5, 1.5, nfib)
+    rows = np.arange(ny)
+    img = np.zeros((ny, nx))
+    for i in range(nx):
+        img[:,i] = np.dot(make_norm_profiles_6(rows, i, fppo, fibs='all'), amps)
+    err_img = np.sqrt(img + 9.)
+    h = pyfits.Header()
+    h['OBJECT'] = 'HD000000'
+    pyfits.writeto(path + obsname + '.fits', np.float32(img), h, overwrite=True)
+    stripe_indices = {'order_02': np.zeros((ny, nx), dtype=bool)}
+    stripe_indices['order_02'][10:10 + 2 * slit_height, :] = True
+    
+    pix, flux, err = extract_spectrum_from_indices(img, err_img, stripe_indices, method='optimal', individual_fibres=True, fibs='all', 
+                                                   slit_height=slit_height, savefile=True, filetype='fits', obsname=obsname, date=date, 
+                                                   pathdict=pathdict, relints_from_etas=True)
+    
+    outfn = path + date + '_HD000000_' + obsname + '_optimal3a_extracted.fits'
+    h = pyfits.getheader(outfn)
+    relints = np.array([h['RELINT' + str(i + 1).zfill(2)] for i in range(19)])
+    # the stellar fibres are fibres 4-22 (see "make_norm_profiles_6")
+    true_relints = amps[3:22] / np.sum(amps[3:22])
+    max_diff = np.max(np.abs(relints - true_relints))
+    
+    print('max |difference| in relints: ' + str(max_diff))
+    
+    return max_diff
+    
+
+
+
+
 def extract_spectra(filelist, P_id, mask, method='optimal', save_files=True, outpath=None, verbose=False):
     """
     DUMMY ROUTINE: not currently in use
@@ -5,12 +5,21 @@ Created on 26 Apr. 2018
 '''
 
 import numpy as np
-from scipy.interpolate import UnivariateSpline
+import time
+import os
+import hashlib
+from collections import OrderedDict
+from scipy.interpolate import UnivariateSpline, BSpline
 from scipy.signal import medfilt
 from scipy import ndimage
 import astropy.io.fits as pyfits
 
 
+# in-process cache of the pixel-to-pixel sensitivities (one entry per night and set of parameters, see "get_pixtopix_key")
+P2P_CACHE = {}
+# in-process LRU cache of the normalized blaze functions (ie master whites) used in "deblaze_orders_batched" (see "get_blaze_key")
+BLAZE_CACHE = OrderedDict()
+
 
 
 # xdisp_boxsize = 1
@@ -146,6 +155,214 @@ def onedim_pixtopix_variations_spline(flat, knots=9, guess=13, savefits=True, pa
 
 
 
+def make_spline_design_matrix(npix, knots=9, degree=3):
+    """
+    Returns the B-spline design matrix for a (least-squares) spline with 'knots' equally spaced knots (incl. the two end points, ie the 
+    same as len(spl.get_knots()) for a UnivariateSpline) over the pixel range [0, npix-1].
+    
+    INPUT:
+    'npix'    : number of pixels
+    'knots'   : the number of knots (incl. the end points)
+    'degree'  : degree of the spline
+    
+    OUTPUT:
+    'B'  : the design matrix (npix, knots + degree - 1), ie B[i,j] is the j-th B-spline evaluated at pixel i
+    """
+    xx = np.arange(npix)
+    t = np.r_[np.repeat(0., degree), np.linspace(0, npix - 1, knots), np.repeat(npix - 1., degree)]
+    nb = len(t) - degree - 1
+    B = BSpline(t, np.eye(nb), degree, extrapolate=False)(xx)
+    
+    return B
+
+
+
+def fit_batched_spline(data, knots=9, degree=3, clip=5., maxiter=10, mask=None, debug_level=0):
+    """
+    Fits a least-squares spline with the same (equally spaced) knots to every row of 'data' (ie along the last axis) at once, with 
+    iterative clipping of outliers. As all rows share the same design matrix, the normal equations for all rows are obtained from a 
+    few matrix products over the bands of the (banded) matrix B.T * W * B, and solved in one go. Outliers (> clip * robust sigma from the 
+    fit of that row) are clipped from all rows simultaneously until nothing changes any more (or 'maxiter' is reached).
+    
+    INPUT:
+    'data'         : the data (any shape, the fit is done along the last axis); non-finite values are ignored
+    'knots'        : the number of knots (incl. the end points)
+    'degree'       : degree of the spline
+    'clip'         : clipping threshold (in units of the robust standard deviation of the residuals of each row); set to None for no clipping
+    'maxiter'      : maximum number of clipping iterations
+    'mask'         : boolean mask (same shape as data) of the data points that can be used at all (eg to exclude padding); the others get 
+                     zero weight in the fit and are ignored in the clipping statistics
+    'debug_level'  : for debugging...
+    
+    OUTPUT:
+    'model'     : the best-fit splines (same shape as data)
+    'goodmask'  : boolean mask (same shape as data) of the data points used in the final fit
+    """
+    
+    shape = data.shape
+    npix = shape[-1]
+    y = data.reshape(-1, npix).astype(float)
+    
+    B = make_spline_design_matrix(npix, knots=knots, degree=degree)
+    nb = B.shape[1]
+    # the products of the B-splines on the main diagonal and the 'degree' upper diagonals (all others are zero)
+    bands = [B[:, :nb-d] * B[:, d:] for d in range(degree + 1)]
+    
+    valid = np.isfinite(y)
+    if mask is not None:
+        valid = np.logical_and(valid, np.asarray(mask, dtype=bool).reshape(-1, npix))
+    goodmask = valid.copy()
+    y = np.where(valid, y, 0.)
+    
+    for n in range(maxiter + 1):
+        w = goodmask.astype(float)
+        G = np.zeros((len(y), nb, nb))
+        for d in range(degree + 1):
+            Gd = np.dot(w, bands[d])
+            G[:, np.arange(nb-d), np.arange(d, nb)] = Gd
+            G[:, np.arange(d, nb), np.arange(nb-d)] = Gd
+        # B-splines without any good data points have zero coefficient
+        empty = np.diagonal(G, axis1=1, axis2=2) == 0
+        G[:, np.arange(nb), np.arange(nb)] += empty
+        b = np.dot(w * y, B)
+        coeffs = np.linalg.solve(G, b[..., np.newaxis])[..., 0]
+        model = np.dot(coeffs, B.T)
+        
+        if clip is None or n == maxiter:
+            break
+        resid = np.where(goodmask, y - model, np.nan)
+        # (rows without any good data points are left alone)
+        sigma = np.repeat(np.inf, len(y))
+        rows = np.any(goodmask, axis=1)
+        sigma[rows] = 1.4826 * np.nanmedian(np.abs(resid[rows]), axis=1)
+        bad = np.logical_and(goodmask, np.abs(y - model) > clip * sigma[:, np.newaxis])
+        if debug_level >= 1:
+            print('clipping iteration ' + str(n + 1) + ': ' + str(np.sum(bad)) + ' data points clipped')
+        if not np.any(bad):
+            break
+        goodmask[bad] = False
+    
+    return model.reshape(shape), goodmask.reshape(shape)
+
+
+
+def get_pixtopix_key(flat, date, knots=9, clip=5.):
+    """
+    Returns the key under which the pixel-to-pixel sensitivities of one night are stored in the cache. The key is made from the date, 
+    the parameters of the spline fit, and a hash of the extracted master white itself, so that sensitivities can never be re-used for 
+    a different master white.
+    """
+    return hashlib.sha1((date + '|' + str(knots) + '|' + str(clip) + '|').encode() + np.ascontiguousarray(flat, dtype=float).tobytes()).hexdigest()
+
+
+
+def onedim_pixtopix_variations_spline_batched(flat, knots=9, clip=5., maxiter=10, date=None, use_cache=True, savefits=False, path=None,
+                                              debug_level=0, timit=False):
+    """
+    Same as "onedim_pixtopix_variations_spline", but all (order, fibre) rows of the extracted master white are fitted at once with a 
+    least-squares spline with the same equally spaced knots (see "fit_batched_spline"), rather than tuning the smoothing factor of a 
+    UnivariateSpline for every single row until it has the desired number of knots. Outliers (eg cosmics or bad pixels) are clipped. 
+    Non-positive and non-finite pixels (eg the zero padding of orders that do not fill the whole chip) are not used in the fit, and 
+    their sensitivities are set to 1. If 'date' is provided, the results are cached (in memory, and in the FITS files if 'savefits' is set to TRUE) and re-used for the 
+    same master white of that night.
+    
+    INPUT:
+    'flat'          : np.array (order, pixel) or (order, fibre, pixel), or dictionary (keys = orders), containing the extracted flux from the master white
+    'knots'         : the number of knots (incl. the end points)
+    'clip'          : clipping threshold (in units of the robust standard deviation of the residuals); set to None for no clipping
+    'maxiter'       : maximum number of clipping iterations
+    'date'          : the date of the master white ('YYYYMMDD') - needed for caching (taken from 'path' if not provided)
+    'use_cache'     : boolean - do you want to re-use previously determined sensitivities for this night (if available)?
+    'savefits'      : boolean - do you want to save the results to FITS files?
+    'path'          : the directory containing the master white (and where the FITS files are saved)
+    'debug_level'   : for debugging...
+    'timit'         : boolean - do you want to measure execution run time?
+    
+    OUTPUT:
+    'smoothed_flat' : np.array / dictionary of the smoothed (ie filtered) whites
+    'pix_sens'      : np.array / dictionary of the pixel-to-pixel sensitivities
+    """
+    
+    if timit:
+        start_time = time.time()
+    
+    if savefits:
+        assert path is not None, 'ERROR: path variable is not set!'
+    
+    # check whether it's a numpy array (eg from FITS file), or a python dictionary
+    if flat.__class__ == dict:
+        ords = sorted(flat.keys())
+        smoothed_flat, pix_sens = onedim_pixtopix_variations_spline_batched(np.array([flat[ord] for ord in ords]), knots=knots, clip=clip, 
+                                                                            maxiter=maxiter, date=date, use_cache=use_cache, savefits=savefits, 
+                                                                            path=path, debug_level=debug_level, timit=timit)
+        return dict(zip(ords, smoothed_flat)), dict(zip(ords, pix_sens))
+    elif flat.__class__ != np.ndarray:
+        print('ERROR: data type / variable class not recognized')
+        return
+    
+    # make sure that they are either quick-extracted spectra (order, pixel), or optimal-extracted spectra (order, fibre, pixel)
+    assert len(flat.shape) in [2,3], 'ERROR: shape of flat not recognized!!!'
+    
+    # the date of the master white (same convention as in "onedim_pixtopix_variations_spline" if only the path is given)
+    if date is None and path is not None:
+        date = path.split('/')[-2]
+    
+    key = None
+    if date is not None:
+        key = get_pixtopix_key(flat, date, knots=knots, clip=clip)
+        if use_cache:
+            if key in P2P_CACHE:
+                if debug_level >= 1:
+                    print('Using cached pixel-to-pixel sensitivities for ' + date + '...')
+                return P2P_CACHE[key][0].copy(), P2P_CACHE[key][1].copy()
+            if path is not None and os.path.isfile(path + date + '_pixel_sensitivity.fits'):
+                if pyfits.getval(path + date + '_pixel_sensitivity.fits', 'P2PKEY', default='') == key:
+                    if debug_level >= 1:
+                        print('Loading pixel-to-pixel sensitivities for ' + date + '...')
+                    smoothed_flat = pyfits.getdata(path + date + '_smoothed_flat.fits').astype(float)
+                    pix_sens = pyfits.getdata(path + date + '_pixel_sensitivity.fits').astype(float)
+                    P2P_CACHE[key] = (smoothed_flat, pix_sens)
+                    return smoothed_flat.copy(), pix_sens.copy()
+    
+    if debug_level >= 1:
+        print('Fitting smoothing splines with ' + str(knots) + ' knots to all orders (and fibres) at once...')
+    
+    usable = np.logical_and(np.isfinite(flat), flat > 0)
+    smoothed_flat, goodmask = fit_batched_spline(flat, knots=knots, clip=clip, maxiter=maxiter, mask=usable, debug_level=debug_level)
+    pix_sens = np.ones(flat.shape)
+    pix_sens[usable] = flat[usable] / smoothed_flat[usable]
+    
+    if key is not None:
+        P2P_CACHE[key] = (smoothed_flat.copy(), pix_sens.copy())
+    
+    if savefits:
+        # get header from master white
+        h = pyfits.getheader(path + date + '_master_white.fits')
+        # add requested number of knots to header
+        h['N_KNOTS'] = (knots, 'number of knots used in smoothing spline')
+        h['P2PCLIP'] = (str(clip), 'clipping threshold used for smoothing spline')
+        h['P2PKEY'] = (key, 'MW + spline hash')
+        pyfits.writeto(path + date + '_smoothed_flat.fits', np.float32(smoothed_flat), h, overwrite=True)
+        pyfits.writeto(path + date + '_pixel_sensitivity.fits', np.float32(pix_sens), h, overwrite=True)
+    
+    if timit:
+        print('Time elapsed: ' + str(np.round(time.time() - start_time, 2)) + ' seconds')
+    
+    return smoothed_flat, pix_sens
+
+
+
+def clear_pixtopix_cache():
+    """
+    Removes all pixel-to-pixel sensitivities from the in-process cache.
+    """
+    P2P_CACHE.clear()
+    return
+
+
+
+
+
 def onedim_pixtopix_variations(flat, filt='gaussian', filter_width=25):
     """
     This routine applies a filter ('gaussian' / 'savgol' / 'median') to an observed flat field in order to determine the pixel-to-pixel sensitivity variations
@@ -177,17 +394,30 @@ def onedim_pixtopix_variations(flat, filt='gaussian', filter_width=25):
         
         pix_sens = np.zeros(flat.shape) - 1.
         smoothed_flat = np.zeros(flat.shape) - 1.
-        # loop over all orders
-        for o in range(flat.shape[0]):
-            # are they optimal 3a extracted spectra?
-            if len(flat.shape) == 3:
-                # loop over all fibres
-                for f in range(flat.shape[1]): 
-                    if filt.lower() in ['g','gaussian']:
-                        #Gaussian filter
-                        smoothed_flat[o,f,:] = ndimage.gaussian_filter(flat[o,f,:], filter_width)    
-                        pix_sens[o,f,:] = flat[o,f,:] / smoothed_flat[o,f,:]
-                    elif filt.lower() in ['s','savgol']:
+        if filt.lower() in ['g','gaussian']:
+            # Gaussian filter along the dispersion direction for all orders (and fibres) at once
+            smoothed_flat[...] = ndimage.gaussian_filter1d(flat, filter_width, axis=-1)
+            pix_sens = flat / smoothed_flat
+        else:
+            # loop over all orders
+            for o in range(flat.shape[0]):
+                # are they optimal 3a extracted spectra?
+                if len(flat.shape) == 3:
+                    # loop over all fibres
+                    for f in range(flat.shape[1]): 
+                        if filt.lower() in ['s','savgol']:
+                            print('WARNING: SavGol filter not implemented yet!!!')
+                            break
+                        elif filt.lower() in ['m','median']:
+                            print('WARNING: Median filter not implemented yet!!!')
+                            break
+                        else:
+                            #This should never happen!!!
+                            print("ERROR: filter choice still not recognised!")
+                            break
+                # or are they just quick-extracted spectra
+                else:
+                    if filt.lower() in ['s','savgol']:
                         print('WARNING: SavGol filter not implemented yet!!!')
                         break
                     elif filt.lower() in ['m','median']:
@@ -197,22 +427,6 @@ def onedim_pixtopix_variations(flat, filt='gaussian', filter_width=25):
                         #This should never happen!!!
                         print("ERROR: filter choice still not recognised!")
                         break
-            # or are they just quick-extracted spectra
-            else:
-                if filt.lower() in ['g','gaussian']:
-                    #Gaussian filter
-                    smoothed_flat[o,:] = ndimage.gaussian_filter(flat[o,:], filter_width)    
-                    pix_sens[o,:] = flat[o,:] / smoothed_flat[o,:]
-                elif filt.lower() in ['s','savgol']:
-                    print('WARNING: SavGol filter not implemented yet!!!')
-                    break
-                elif filt.lower() in ['m','median']:
-                    print('WARNING: Median filter not implemented yet!!!')
-                    break
-                else:
-                    #This should never happen!!!
-                    print("ERROR: filter choice still not recognised!")
-                    break
                 
     elif flat.__class__ == dict:
         pix_sens = {}
@@ -287,9 +501,15 @@ def onedim_pixtopix_variations_single_order(f_flat, filt='gaussian', filter_widt
     
     
 def deblaze_orders(f, flat, err=None, mask=None, wl=None, degpol=1, gauss_filter_sigma=3., maxfilter_size=100,
-                   combine_fibres=False, skip_first_order=False, debug_level=0):
+                   combine_fibres=False, skip_first_order=False, batched=True, use_cache=False, debug_level=0):
     
     assert f.shape == flat.shape, 'Shapes of "flux" and "flat" do not agree!!!'
+    
+    # for numpy arrays, all orders and fibres are de-blazed at once (see "deblaze_orders_batched")
+    if batched and flat.__class__ == np.ndarray:
+        return deblaze_orders_batched(f, flat, err=err, mask=mask, wl=wl, degpol=degpol, gauss_filter_sigma=gauss_filter_sigma, 
+                                      maxfilter_size=maxfilter_size, combine_fibres=combine_fibres, skip_first_order=skip_first_order, 
+                                      use_cache=use_cache, debug_level=debug_level)
 # wl has shape (40,4112), whereas flux has (39, 4112)
 #     assert f.shape == wl.shape, 'Shapes of "flux" and "wl" do not agree!!!'
     if wl is not None:
@@ -426,3 +646,191 @@ def deblaze_orders(f, flat, err=None, mask=None, wl=None, degpol=1, gauss_filter
 
 
 
+
+def get_blaze_key(flat, combine_fibres=False, degpol=1, gauss_filter_sigma=3., maxfilter_size=100, wl_space=False):
+    """
+    Returns the key under which a normalized blaze function is stored in the cache. The key is made from a hash of the master white 
+    itself and the parameters of the de-blazing (incl. whether the continuum is fitted in wavelength or in pixel space), so that a 
+    blaze function can never be re-used for a different master white or different settings.
+    """
+    h = hashlib.sha1((str(flat.shape) + '|' + str(combine_fibres) + '|' + str(degpol) + '|' + str(gauss_filter_sigma) + '|' + 
+                      str(maxfilter_size) + '|' + str(wl_space) + '|').encode())
+    h.update(memoryview(np.ascontiguousarray(flat, dtype=float)).cast('B'))
+    return h.hexdigest()
+
+
+
+def get_normalized_blaze(flat, combine_fibres=False, key=None, maxsize=4):
+    """
+    Returns the blaze function (ie the extracted and smoothed master white) normalized to a maximum of 1 for every order (and fibre),
+    as used in "deblaze_orders". If 'combine_fibres' is set to TRUE, the sum over all fibres is used for each order. If 'key' (from 
+    "get_blaze_key") is provided, the result is cached (read-only) and re-used; only the 'maxsize' most recently used blaze functions 
+    are kept.
+    """
+    
+    if key is not None and key in BLAZE_CACHE:
+        BLAZE_CACHE.move_to_end(key)
+        return BLAZE_CACHE[key]
+    
+    if combine_fibres and len(flat.shape) == 3:
+        combined = np.nansum(flat, axis=1, keepdims=True)
+        blaze = np.broadcast_to(combined / np.nanmax(combined, axis=-1, keepdims=True), flat.shape)
+    else:
+        blaze = flat / np.nanmax(flat, axis=-1, keepdims=True)
+    
+    if key is not None:
+        blaze.flags.writeable = False
+        BLAZE_CACHE[key] = blaze
+        while len(BLAZE_CACHE) > maxsize:
+            BLAZE_CACHE.popitem(last=False)
+    
+    return blaze
+
+
+
+def deblaze_orders_batched(f, flat, err=None, mask=None, wl=None, degpol=1, gauss_filter_sigma=3., maxfilter_size=100,
+                           combine_fibres=False, skip_first_order=False, use_cache=False, debug_level=0, timit=False):
+    """
+    Same as "deblaze_orders", but for the entire (order, fibre, pixel) cube (or (order, pixel) array) at once: the filters are applied along 
+    the last axis of the whole cube in one call each, and the low-order polynomials for the continuum of all orders and fibres are obtained 
+    from one stacked least-squares problem (the normal equations of every row are built from the power sums of the (scaled) abscissae, and 
+    solved together). NaNs are excluded from the polynomial fits.
+    
+    INPUT:
+    'f'                   : np.array (order, pixel) or (order, fibre, pixel) containing the extracted flux
+    'flat'                : np.array of the same shape as 'f' containing the blaze function (eg the smoothed master white)
+    'err'                 : np.array of the same shape as 'f' containing the uncertainties in 'f' (optional)
+    'mask'                : dictionary (keys = orders, eg 'order_01') of boolean masks of the pixels to use for the continuum fits (default is to use all pixels)
+    'wl'                  : np.array of the same shape as 'f' containing the wavelengths (optional); if provided, the continuum is fitted in wavelength space
+    'degpol'              : degree of the polynomial for the continuum
+    'gauss_filter_sigma'  : sigma of the Gaussian filter for the rough continuum
+    'maxfilter_size'      : size of the maximum filter for the rough continuum
+    'combine_fibres'      : boolean - do you want to use the sum over all fibres of the flat as the blaze function for each order?
+    'skip_first_order'    : boolean - do you want to skip order 01 (its output is set to zero)?
+    'use_cache'           : boolean - do you want to cache and re-use the normalized blaze function? (NOTE: the cache key is a hash of the 
+                            whole master white (see "get_blaze_key"), which for a full-size flat takes about as long as the normalization)
+    'debug_level'         : for debugging...
+    'timit'               : boolean - do you want to measure execution run time?
+    
+    OUTPUT:
+    'f_dblz'    : the de-blazed flux
+    'err_dblz'  : the correspondingly scaled uncertainties (only if 'err' is provided)
+    """
+    
+    if timit:
+        start_time = time.time()
+    
+    # make sure that they are either quick-extracted spectra (order, pixel), or optimal-extracted spectra (order, fibre, pixel)
+    assert len(f.shape) in [2,3], 'ERROR: shape of flux-array not recognized!!!'
+    assert f.shape == flat.shape, 'Shapes of "flux" and "flat" do not agree!!!'
+    if err is not None:
+        assert f.shape == err.shape, 'Shapes of "flux" and "error" do not agree!!!'
+    if wl is not None:
+        assert f.shape == wl.shape, 'Shapes of "flux" and "wl" do not agree!!!'
+    
+    nord = f.shape[0]
+    npix = f.shape[-1]
+    
+    # boolean masks for all orders, broadcast over all fibres
+    if mask is None:
+        ordmask = np.ones((nord, npix), dtype='bool')
+    else:
+        ordmask = np.array([mask['order_'+str(o+1).zfill(2)] for o in range(nord)]).astype(bool)
+    if len(f.shape) == 3:
+        ordmask = ordmask[:, np.newaxis, :]
+    ordmask = np.broadcast_to(ordmask, f.shape)
+    
+    # first, divide by the "blaze-function", ie the flat, which we got from filtering the MASTER WHITE
+    key = None
+    if use_cache:
+        key = get_blaze_key(flat, combine_fibres=combine_fibres, degpol=degpol, gauss_filter_sigma=gauss_filter_sigma, 
+                            maxfilter_size=maxfilter_size, wl_space=wl is not None)
+    blaze = get_normalized_blaze(flat, combine_fibres=combine_fibres, key=key)
+    f_dblz = f / blaze
+    
+    # get rough continuum shape by performing a series of filters (along the dispersion direction)
+    cont_rough = ndimage.maximum_filter1d(ndimage.gaussian_filter1d(f_dblz, gauss_filter_sigma, axis=-1), size=maxfilter_size, axis=-1)
+    
+    # now fit polynomials to the rough continua of all rows at once (in wavelength space if wl is provided, otherwise in pixel space);
+    # the abscissae are scaled to [-1,1] for numerical stability, and the normal equations (Hankel matrices of the power sums of the 
+    # abscissae) of all rows are solved together
+    y = cont_rough.reshape(-1, npix)
+    good = ordmask.reshape(-1, npix) & np.isfinite(y)
+    ys = np.where(good, y, 0.)
+    ix = np.arange(degpol + 1)
+    if wl is None:
+        # same abscissae for all rows, so the power sums are just matrix products with one Vandermonde matrix
+        xs = (np.arange(npix) - 0.5 * (npix - 1)) / (0.5 * (npix - 1))
+        V = xs[:, np.newaxis] ** np.arange(2*degpol + 1)
+        moments = np.dot(good.astype(float), V)
+        rhs = np.dot(ys, V[:, :degpol+1])
+    else:
+        x = wl.reshape(-1, npix).astype(float)
+        good &= np.isfinite(x)
+        # scale the abscissae of every row individually
+        xmin = np.min(np.where(good, x, np.inf), axis=1, keepdims=True)
+        xmax = np.max(np.where(good, x, -np.inf), axis=1, keepdims=True)
+        ok = np.logical_and(np.isfinite(xmin), xmax > xmin)
+        xs = (x - np.where(ok, 0.5 * (xmin + xmax), 0.)) / np.where(ok, 0.5 * (xmax - xmin), 1.)
+        ys = np.where(good, ys, 0.)
+        w = good.astype(float)
+        xpow = np.ones(xs.shape)
+        moments = []
+        rhs = []
+        for k in range(2*degpol + 1):
+            moments.append(np.sum(w * xpow, axis=1))
+            if k <= degpol:
+                rhs.append(np.sum(ys * xpow, axis=1))
+            xpow = xpow * xs
+        moments = np.array(moments).T
+        rhs = np.array(rhs).T
+    G = moments[:, ix[:, np.newaxis] + ix[np.newaxis, :]]
+    # rows without enough good pixels are not fitted (their polynomial is set to NaN below)
+    fitted = np.sum(good, axis=1) > degpol
+    G[~fitted] = np.eye(degpol + 1)
+    coeffs = np.linalg.solve(G, rhs[..., np.newaxis])[..., 0]
+    coeffs[~fitted] = np.nan
+    # evaluate the polynomials (coefficients are in increasing order)
+    if wl is None:
+        px = np.dot(coeffs, V[:, :degpol+1].T)
+    else:
+        px = np.zeros(xs.shape) + coeffs[:, -1:]
+        for k in range(degpol - 1, -1, -1):
+            px = px * xs + coeffs[:, k:k+1]
+    px = px.reshape(f.shape)
+    
+    # then divide by that polynomial (normalized to a median of 1 over the masked region)
+    contnorm = px / np.nanmedian(np.where(ordmask, px, np.nan), axis=-1)[..., np.newaxis]
+    f_dblz = f_dblz / contnorm
+    # need to treat the error arrays in the same way, as need to keep relative error the same
+    if err is not None:
+        err_dblz = err / blaze / contnorm
+    
+    if skip_first_order:
+        f_dblz[0] = 0.
+        if err is not None:
+            err_dblz[0] = 0.
+    
+    if debug_level >= 1:
+        print(str(np.sum(~fitted)) + ' rows could not be de-blazed (not enough good pixels)')
+    
+    if timit:
+        print('Time elapsed: ' + str(np.round(time.time() - start_time, 3)) + ' seconds')
+    
+    if err is not None:
+        return f_dblz, err_dblz
+    else:
+        return f_dblz
+
+
+
+def clear_blaze_cache():
+    """
+    Removes all normalized blaze functions from the in-process cache.
+    """
+    BLAZE_CACHE.clear()
+    return
+
+
+
+
@@ -11,6 +11,7 @@ import numpy as np
 
 from veloce_reduction.veloce_reduction.helper_functions import laser_on, thxe_on, find_nearest
 from veloce_reduction.veloce_reduction.calibration import correct_for_bias_and_dark_from_filename
+from veloce_reduction.veloce_reduction.chipmasks import load_chipmask
 
 
 
@@ -126,15 +127,15 @@ def get_obstype_lists(pathdict, pattern=None, weeding=True, quick=False, raw_goo
     
     if int(checkdate) < 20190503:
         # check if chipmask for that night already exists (if not revert to the closest one in time (preferably earlier in time))
-        if os.path.isfile(chipmask_path + 'chipmask_' + date + '.npy'):
-            chipmask = np.load(chipmask_path + 'chipmask_' + date + '.npy').item()
+        if os.path.isfile(chipmask_path + 'chipmask_' + date + '.npz') or os.path.isfile(chipmask_path + 'chipmask_' + date + '.npy'):
+            chipmask = load_chipmask(chipmask_path + 'chipmask_' + date)
         else:
-            cm_list = glob.glob(chipmask_path + 'chipmask*.npy')
+            cm_list = glob.glob(chipmask_path + 'chipmask*.np[yz]')
             cm_datelist = [int(cm.split('.')[-2][-8:]) for cm in cm_list]
             cm_datelist.sort()   # need to make sure it is sorted, so that find_nearest finds the earlier one in time if two dates are found that have the same delta_t to date
             cm_dates = np.array(cm_datelist)
             alt_date = find_nearest(cm_dates, int(date))
-            chipmask = np.load(chipmask_path + 'chipmask_' + str(alt_date) + '.npy').item()
+            chipmask = load_chipmask(chipmask_path + 'chipmask_' + str(alt_date))
             
         # look at the actual 2D image (using chipmasks for LFC and simThXe) to determine which calibration lamps fired
         for file in calib_list:
@@ -5,6 +5,9 @@ Created on 21 Nov. 2017
 '''
 
 import glob
+import os
+import struct
+import zipfile
 import numpy as np
 import astropy.io.fits as pyfits
 import datetime
@@ -434,19 +437,182 @@ def combine_fibparms(date=None, path=None, use_lfc=False, savefile=True):
     if savefile:
         if use_lfc:
             np.save(archive_path + 'combined_fibre_profile_fits_using_lfc_' + date + '.npy', combined_fibparms)
+            save_fibparms_arrays(combined_fibparms, archive_path + 'combined_fibre_profile_fits_using_lfc_' + date + '.npz')
         else:
             np.save(archive_path + 'combined_fibre_profile_fits_' + date + '.npy', combined_fibparms)
+            save_fibparms_arrays(combined_fibparms, archive_path + 'combined_fibre_profile_fits_' + date + '.npz')
         
     return combined_fibparms
+
+
+
+def save_fibparms_arrays(fibparms, filename, degpol=7, tables=True):
+    """
+    Saves a fibparms dictionary (order -> fibre -> {'mu_fit', 'sigma_fit', 'beta_fit', ...}) in a compact, array-based format, ie as an
+    (uncompressed) .npz file that contains no pickled objects (so it can be read with allow_pickle=False, and with any Python version).
     
+    Contents of the file:
+    'orders' : names of the orders (n_ord)
+    'fibres' : names of the fibres (n_fib), in ascending order (same as sorted(fibparms[ord].keys()))
+    'params' : names of the parameters (n_par), ie all floating-point per-pixel-column arrays found in the fibparms (eg 'mu_fit', 'sigma_fit', 
+               'beta_fit')
+    'coeffs' : Chebyshev coefficients (n_ord, n_fib, n_par, degpol+1) of the parameters as a function of pixel number (normalized to [-1,1])
+    'tables' : the parameters evaluated at every pixel column (n_par, n_ord, n_fib, nx), in single precision - only if 'tables' is set 
+               to TRUE; the parameters for a given order are then one contiguous (n_fib, nx) block each
+    'flags'  : names of all other (ie not floating-point) per-pixel-column arrays found in the fibparms (eg 'onchip')
+    'flag_*' : one (n_ord, n_fib, nx)-array for each of the 'flags', with its original dtype (eg 'flag_onchip' is boolean)
+    'nx'     : number of pixel columns
     
+    INPUT:
+    'fibparms'  : the fibparms dictionary (eg from "make_real_fibparms_by_ord" or "combine_fibparms")
+    'filename'  : the name of the output file (should end in .npz)
+    'degpol'    : degree of the Chebyshev polynomials 
+    'tables'    : boolean - do you want to save the parameters evaluated at every pixel column as well? (if not, they are evaluated from
+                  the coefficients when loading; this is exact for 'mu_fit', but only approximate for the smoothed 'sigma_fit' and 'beta_fit')
+    """
+    
+    orders = sorted(fibparms.keys())
+    fibres = sorted(fibparms[orders[0]].keys())
+    for ord in orders:
+        assert sorted(fibparms[ord].keys()) == fibres, 'ERROR: not all orders contain the same fibres!!!'
+    # all parameters that are given for every pixel column
+    first = fibparms[orders[0]][fibres[0]]
+    nx = len(first['mu_fit'])
+    allparams = [key for key in sorted(first.keys()) if np.ndim(first[key]) == 1 and len(first[key]) == nx]
+    # only the floating-point parameters can be represented by polynomials; anything else (eg the boolean 'onchip') is stored as it is
+    params = [par for par in allparams if np.issubdtype(np.asarray(first[par]).dtype, np.floating)]
+    flags = [par for par in allparams if par not in params]
+    
+    alltables = np.zeros((len(params), len(orders), len(fibres), nx))
+    allflags = {flag: np.zeros((len(orders), len(fibres), nx), dtype=np.asarray(first[flag]).dtype) for flag in flags}
+    for o,ord in enumerate(orders):
+        for f,fib in enumerate(fibres):
+            for p,par in enumerate(params):
+                alltables[p,o,f,:] = fibparms[ord][fib][par]
+            for flag in flags:
+                allflags[flag][o,f,:] = fibparms[ord][fib][flag]
+    
+    # Chebyshev fits for all orders, fibres and parameters in one go
+    xnorm = np.linspace(-1, 1, nx)
+    coeffs = np.linalg.lstsq(np.polynomial.chebyshev.chebvander(xnorm, degpol), alltables.reshape(-1, nx).T, rcond=None)[0]
+    coeffs = coeffs.T.reshape(len(params), len(orders), len(fibres), degpol+1).transpose(1,2,0,3)
+    
+    out = {'orders':np.array(orders), 'fibres':np.array(fibres), 'params':np.array(params), 'coeffs':coeffs, 'nx':np.array(nx), 
+           'flags':np.array(flags, dtype=str)}
+    for flag in flags:
+        out['flag_' + flag] = allflags[flag]
+    if tables:
+        out['tables'] = alltables.astype('f4')
+    np.savez(filename, **out)
+    
+    return
+
+
+
+def load_fibparms_arrays(filename, mmap=True):
+    """
+    Reads fibparms that were saved with "save_fibparms_arrays". If 'mmap' is set to TRUE, the (large) arrays are memory-mapped directly from 
+    the .npz file (which is possible, as it is not compressed), ie nothing is actually read until it is needed.
     
+    OUTPUT:
+    'fpa'  : dictionary with the same contents as the file (see "save_fibparms_arrays"); use "get_order_fibparms" to access the parameters
+    """
+    
+    fpa = {}
+    with np.load(filename, allow_pickle=False) as npz:
+        for key in npz.files:
+            if mmap and (key in ['coeffs', 'tables'] or key.startswith('flag_')):
+                continue
+            fpa[key] = npz[key]
+    fpa['nx'] = int(fpa['nx'])
+    fpa['orders'] = [str(ord) for ord in fpa['orders']]
+    fpa['fibres'] = [str(fib) for fib in fpa['fibres']]
+    fpa['params'] = [str(par) for par in fpa['params']]
+    # (older files contain no flags)
+    fpa['flags'] = [str(flag) for flag in fpa.get('flags', [])]
+    
+    if mmap:
+        with zipfile.ZipFile(filename) as zf, open(filename, 'rb') as fh:
+            for info in zf.infolist():
+                key = info.filename[:-4]
+                if (key not in ['coeffs', 'tables'] and not key.startswith('flag_')) or info.compress_type != zipfile.ZIP_STORED:
+                    continue
+                # skip the local file header to get to the start of the .npy file
+                fh.seek(info.header_offset)
+                header = fh.read(30)
+                namelen, extralen = struct.unpack('<HH', header[26:30])
+                fh.seek(info.header_offset + 30 + namelen + extralen)
+                version = np.lib.format.read_magic(fh)
+                if version == (1,0):
+                    shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(fh)
+                else:
+                    shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(fh)
+                fpa[key] = np.memmap(filename, dtype=dtype, mode='r', shape=shape, order='F' if fortran_order else 'C', offset=fh.tell())
+    
+    return fpa
+
+
+
+def load_fibparms(filename, mmap=True):
+    """
+    Reads fibparms from file, either in the compact array-based format (.npz, see "save_fibparms_arrays"), or as a pickled dictionary 
+    (.npy). If 'filename' has no extension, the .npz version is used if it exists.
+    """
+    if not filename.endswith(('.npy', '.npz')):
+        filename = filename + '.npz' if os.path.isfile(filename + '.npz') else filename + '.npy'
+    if filename.endswith('.npz'):
+        return load_fibparms_arrays(filename, mmap=mmap)
+    else:
+        return np.load(filename, allow_pickle=True).item()
+
+
+
+def get_order_fibparms(fibparms, ord):
+    """
+    Returns the fibre profile parameters for one order, ie "fppo" for "make_norm_profiles_6". For fibparms in the compact array-based format 
+    (from "load_fibparms_arrays") this is a dictionary with the contiguous (n_fib, nx) arrays of each parameter and flag (fibres in the same 
+    ascending order as sorted(fibparms[ord].keys()) would give), plus the list of the fibre names under 'fibres'. For a fibparms dictionary, 
+    it is just fibparms[ord].
+    """
     
+    if 'tables' not in fibparms and 'coeffs' not in fibparms:
+        return fibparms[ord]
     
-    
-    
-    
-    
-    
-    
-    
\ No newline at end of file
+    o = fibparms['orders'].index(ord)
+    fppo = {'fibres':fibparms['fibres']}
+    if 'tables' in fibparms:
+        for p,par in enumerate(fibparms['params']):
+            fppo[par] = np.asarray(fibparms['tables'][p,o])
+    else:
+        vander = np.polynomial.chebyshev.chebvander(np.linspace(-1, 1, fibparms['nx']), fibparms['coeffs'].shape[-1] - 1)
+        for p,par in enumerate(fibparms['params']):
+            fppo[par] = np.dot(np.asarray(fibparms['coeffs'][o,:,p,:]), vander.T)
+    for flag in fibparms.get('flags', []):
+        fppo[flag] = np.asarray(fibparms['flag_' + flag][o])
+    
+    return fppo
+
+
+
+def fibparms_arrays_to_dict(fibparms, callables=False):
+    """
+    Converts fibparms in the compact array-based format (from "load_fibparms_arrays") back to the fibparms dictionary 
+    (order -> fibre -> {'mu_fit', 'sigma_fit', 'beta_fit', ...}) for code that needs the latter. If 'callables' is set to TRUE, the 
+    parameters are given as functions of pixel number (ie the stored Chebyshev polynomials, which can be called like np.poly1d), 
+    as needed eg by "make_norm_profiles_2", rather than as arrays (the flags, eg 'onchip', are always given as arrays).
+    """
+    fpdict = {}
+    for o,ord in enumerate(fibparms['orders']):
+        fpdict[ord] = {}
+        if callables:
+            for f,fib in enumerate(fibparms['fibres']):
+                fpdict[ord][fib] = {par: np.polynomial.Chebyshev(np.array(fibparms['coeffs'][o,f,p]), domain=[0, fibparms['nx'] - 1]) 
+                                    for p,par in enumerate(fibparms['params'])}
+                for flag in fibparms.get('flags', []):
+                    fpdict[ord][fib][flag] = np.array(fibparms['flag_' + flag][o,f])
+        else:
+            fppo = get_order_fibparms(fibparms, ord)
+            for f,fib in enumerate(fppo['fibres']):
+                fpdict[ord][fib] = {par: fppo[par][f] for par in fibparms['params'] + fibparms.get('flags', [])}
+    return fpdict
+
@@ -18,9 +18,13 @@ from astropy.modeling import models, fitting
 import collections
 from scipy import ndimage
 from scipy import special, signal
-from numpy.polynomial import polynomial
+from numpy.polynomial import polynomial, chebyshev, legendre, polyutils
 from scipy.integrate import quad, fixed_quad
 from scipy import ndimage
+from multiprocessing import shared_memory
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+
+from veloce_reduction.veloce_reduction.chipmasks import get_chipmask_plane
 # from json.decoder import _decode_uXXXX
 
 
@@ -114,7 +118,14 @@ def CMB_multi_gaussian(x, *p):
     return f
 
 def CMB_multi_gaussian_with_offset(x, *p):
-    return CMB_multi_gaussian(x,*p[:-2]) + p[-1]
+    return CMB_multi_gaussian(x,*p[:-1]) + p[-1]
+
+def CMB_multi_gaussian_jac(x, *p):
+    # analytic Jacobian of "CMB_multi_gaussian" (can be used as 'jac' in scipy's "curve_fit")
+    return batched_multi_fibmodel_with_amp_jac(np.atleast_2d(x), np.atleast_2d(p), varbeta=False)[0]
+
+def CMB_multi_gaussian_with_offset_jac(x, *p):
+    return batched_multi_fibmodel_with_amp_jac(np.atleast_2d(x), np.atleast_2d(p), varbeta=False, offset=True)[0]
 
 def CMB_pure_gaussian(x, mu, sig, amp):
     return (amp * np.exp(-np.power(x - mu, 2.) / (2 * np.power(sig, 2.))))
@@ -149,6 +160,13 @@ def multi_fibmodel_with_amp_and_offset(x, *p):
         f += fibmodel_with_amp(x, *p[i*4:i*4+4])
     return f + p[-1]
 
+def multi_fibmodel_with_amp_jac(x, *p):
+    # analytic Jacobian of "multi_fibmodel_with_amp" (can be used as 'jac' in scipy's "curve_fit")
+    return batched_multi_fibmodel_with_amp_jac(np.atleast_2d(x), np.atleast_2d(p))[0]
+
+def multi_fibmodel_with_amp_and_offset_jac(x, *p):
+    return batched_multi_fibmodel_with_amp_jac(np.atleast_2d(x), np.atleast_2d(p), offset=True)[0]
+
 def fibmodel_with_offset(x, mu, sigma, beta, offset):
     return fibmodel(x, mu, sigma, beta=beta, alpha=0, norm=0) + offset
 
@@ -169,6 +187,261 @@ def gausslike_with_amp_and_offset_and_slope(x, mu, sigma, amp, beta, offset, slo
 
 
 
+def batched_fibmodel_with_amp(x, p):
+    """
+    Same as "fibmodel_with_amp", but for a whole batch of independent fits at once.
+    'x' has shape (nbatch, npts), 'p' has shape (nbatch, 4), with p[:,:] = [mu, sigma, amp, beta].
+    """
+    mu, sigma, amp, beta = [p[:,k,np.newaxis] for k in range(4)]
+    return amp * np.exp(- (np.absolute(x - mu) / (np.sqrt(2.) * sigma)) ** beta)
+
+def batched_fibmodel_with_amp_jac(x, p):
+    """
+    Analytic Jacobian of "batched_fibmodel_with_amp" wrt [mu, sigma, amp, beta]; has shape (nbatch, npts, 4).
+    With u = |x - mu| / (sqrt(2)*sigma) and f = amp * exp(-u**beta):
+    df/dmu = f * beta * u**(beta-1) * sign(x-mu) / (sqrt(2)*sigma),   df/dsigma = f * beta * u**beta / sigma,
+    df/damp = exp(-u**beta),   df/dbeta = -f * u**beta * ln(u)
+    """
+    mu, sigma, amp, beta = [p[:,k,np.newaxis] for k in range(4)]
+    u = np.absolute(x - mu) / (np.sqrt(2.) * sigma)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ub = u ** beta
+        phi = np.exp(-ub)
+        f = amp * phi
+        jac = np.empty(x.shape + (4,))
+        jac[...,0] = np.where(u > 0, f * beta * ub / u * np.sign(x - mu) / (np.sqrt(2.) * sigma), 0.)
+        jac[...,1] = f * beta * ub / sigma
+        jac[...,2] = phi
+        jac[...,3] = np.where(u > 0, -f * ub * np.log(u), 0.)
+    return jac
+
+def batched_gaussian(x, p):
+    """
+    Same as "CMB_pure_gaussian", but for a whole batch of independent fits at once.
+    'x' has shape (nbatch, npts), 'p' has shape (nbatch, 3), with p[:,:] = [mu, sigma, amp].
+    """
+    mu, sigma, amp = [p[:,k,np.newaxis] for k in range(3)]
+    return amp * np.exp(-(x - mu)**2 / (2. * sigma**2))
+
+def batched_gaussian_jac(x, p):
+    """
+    Analytic Jacobian of "batched_gaussian" wrt [mu, sigma, amp]; has shape (nbatch, npts, 3).
+    With g = exp(-(x-mu)**2 / (2*sigma**2)):
+    df/dmu = amp * g * (x-mu) / sigma**2,   df/dsigma = amp * g * (x-mu)**2 / sigma**3,   df/damp = g
+    """
+    mu, sigma, amp = [p[:,k,np.newaxis] for k in range(3)]
+    dx = x - mu
+    g = np.exp(-dx**2 / (2. * sigma**2))
+    jac = np.empty(x.shape + (3,))
+    jac[...,0] = amp * g * dx / sigma**2
+    jac[...,1] = amp * g * dx**2 / sigma**3
+    jac[...,2] = g
+    return jac
+
+def batched_multi_fibmodel_with_amp(x, p, varbeta=True, offset=False):
+    """
+    Same as "multi_fibmodel_with_amp" (or "multi_fibmodel_with_amp_and_offset" if 'offset' is set to TRUE), but for a whole batch
+    of independent fits at once. 'x' has shape (nbatch, npts), 'p' has shape (nbatch, 4*nfib(+1)).
+    If 'varbeta' is set to FALSE, there are only 3 parameters per fibre ([mu, sigma, amp]), and beta = 2 (ie plain Gaussians, as in
+    "CMB_multi_gaussian").
+    """
+    npf = 4 if varbeta else 3
+    nfib = p.shape[1] // npf
+    f = np.zeros(x.shape)
+    for i in range(nfib):
+        if varbeta:
+            f += batched_fibmodel_with_amp(x, p[:,i*4:i*4+4])
+        else:
+            f += batched_fibmodel_with_amp(x, np.c_[p[:,i*3:i*3+3], np.repeat(2., len(p))])
+    if offset:
+        f += p[:,-1,np.newaxis]
+    return f
+
+def batched_multi_fibmodel_with_amp_jac(x, p, varbeta=True, offset=False):
+    """
+    Analytic Jacobian of "batched_multi_fibmodel_with_amp"; has shape (nbatch, npts, npar). Every fibre's parameters only enter 
+    its own term, so the Jacobian is assembled from the single-fibre Jacobians (see "batched_fibmodel_with_amp_jac").
+    """
+    npf = 4 if varbeta else 3
+    nfib = p.shape[1] // npf
+    jac = np.zeros(x.shape + (p.shape[1],))
+    for i in range(nfib):
+        if varbeta:
+            jac[...,i*4:i*4+4] = batched_fibmodel_with_amp_jac(x, p[:,i*4:i*4+4])
+        else:
+            jac[...,i*3:i*3+3] = batched_fibmodel_with_amp_jac(x, np.c_[p[:,i*3:i*3+3], np.repeat(2., len(p))])[...,:3]
+    if offset:
+        jac[...,-1] = 1.
+    return jac
+
+def batched_tied_multi_fibmodel(x, p, slit_pattern, varbeta=True, offset=False):
+    """
+    Multi-fibre model with tied parameters, for a whole batch of independent fits at once: all fibres share the same sigma
+    (and beta), and their positions follow a fixed pseudo-slit pattern, ie mu_k = pos + scale * slit_pattern[k]. Only the
+    amplitudes are free for every fibre.
+    'x' has shape (nbatch, npts), 'p' has shape (nbatch, npar), with
+    p[:,:] = [pos, scale, sigma, beta, amp_1, ..., amp_nfib, (offset)]   (no beta if 'varbeta' is set to FALSE, in which case beta = 2)
+    """
+    nfib = len(slit_pattern)
+    namp = 4 if varbeta else 3
+    beta = p[:,3] if varbeta else np.repeat(2., len(p))
+    f = np.zeros(x.shape)
+    for k in range(nfib):
+        f += batched_fibmodel_with_amp(x, np.c_[p[:,0] + p[:,1] * slit_pattern[k], p[:,2], p[:,namp+k], beta])
+    if offset:
+        f += p[:,-1,np.newaxis]
+    return f
+
+def batched_tied_multi_fibmodel_jac(x, p, slit_pattern, varbeta=True, offset=False):
+    """
+    Analytic Jacobian of "batched_tied_multi_fibmodel"; has shape (nbatch, npts, npar). The derivatives wrt the shared 
+    parameters are sums over the single-fibre derivatives (chain rule for pos and scale).
+    """
+    nfib = len(slit_pattern)
+    namp = 4 if varbeta else 3
+    beta = p[:,3] if varbeta else np.repeat(2., len(p))
+    jac = np.zeros(x.shape + (p.shape[1],))
+    for k in range(nfib):
+        jk = batched_fibmodel_with_amp_jac(x, np.c_[p[:,0] + p[:,1] * slit_pattern[k], p[:,2], p[:,namp+k], beta])
+        jac[...,0] += jk[...,0]
+        jac[...,1] += jk[...,0] * slit_pattern[k]
+        jac[...,2] += jk[...,1]
+        if varbeta:
+            jac[...,3] += jk[...,3]
+        jac[...,namp+k] = jk[...,2]
+    if offset:
+        jac[...,-1] = 1.
+    return jac
+
+
+
+def batched_lm_fit(fun, x, data, p0, weights=None, jac=None, lower=None, upper=None, maxiter=200, ftol=1e-10, xtol=1e-10,
+                   lam0=1e-3, return_stats=False, debug_level=0, timit=False):
+    """
+    Levenberg-Marquardt fitting of a whole batch of independent (non-linear) least-squares problems at once, ie minimize
+    sum_k (w_k * (data_k - fun(x_k, p)))**2 for every row of 'data'. Residuals, Jacobians and the damped normal equations are
+    evaluated for all rows simultaneously, every row keeps its own damping parameter, and rows that have converged are
+    removed from the active set (so they are not evaluated again). Bounds are enforced by projecting every step onto the box.
+
+    INPUT:
+    'fun'          : model function, fun(x, p), where 'x' is (nbatch, npts) and 'p' is (nbatch, npar); returns (nbatch, npts)
+    'x'            : the independent variable (nbatch, npts)
+    'data'         : the data points (nbatch, npts)
+    'p0'           : the initial guesses for the parameters (nbatch, npar)
+    'weights'      : weights for the residuals (same convention as lmfit, ie the weights multiply the residuals); points
+                     with zero weight (eg padding) do not contribute to the fit
+    'jac'          : function returning the Jacobian of 'fun' (nbatch, npts, npar); if not provided, forward differences are used
+    'lower'        : lower bounds for the parameters (either (npar,) or (nbatch, npar)) - default is no bounds
+    'upper'        : upper bounds for the parameters (ditto)
+    'maxiter'      : maximum number of iterations
+    'ftol'         : convergence criterion for the relative decrease of chi2
+    'xtol'         : convergence criterion for the relative change in the parameters
+    'lam0'         : initial value for the damping parameter
+    'return_stats' : boolean - do you want to return chi2, the convergence mask, and the number of iterations as well?
+    'debug_level'  : for debugging...
+    'timit'        : boolean - do you want to measure execution run time?
+
+    OUTPUT:
+    'p'            : the best-fit parameters (nbatch, npar)
+    'chi2'         : the sum of the squared weighted residuals for each row (only if 'return_stats' is set to TRUE)
+    'converged'    : boolean array - did the fit converge for that row? (only if 'return_stats' is set to TRUE)
+    'niter'        : number of iterations for each row (only if 'return_stats' is set to TRUE)
+    """
+
+    if timit:
+        start_time = time.time()
+
+    x = np.asarray(x, dtype='float64')
+    data = np.asarray(data, dtype='float64')
+    nbatch, npar = np.shape(p0)
+    if weights is None:
+        weights = np.ones(data.shape)
+    weights = np.asarray(weights, dtype='float64')
+    # make sure bad data points (and padding) cannot do any harm
+    weights = np.where(np.isfinite(weights) & np.isfinite(data) & np.isfinite(x), weights, 0.)
+    data = np.where(weights != 0, data, 0.)
+    x = np.where(weights != 0, x, 0.)
+    lower = np.broadcast_to(-np.inf if lower is None else np.asarray(lower, dtype='float64'), (nbatch, npar))
+    upper = np.broadcast_to(np.inf if upper is None else np.asarray(upper, dtype='float64'), (nbatch, npar))
+
+    if jac is None:
+        def jac(xx, pp):
+            f0 = fun(xx, pp)
+            J = np.empty(xx.shape + (npar,))
+            for k in range(npar):
+                h = 1e-7 * np.maximum(np.abs(pp[:,k]), 1e-3)
+                p_h = pp.copy()
+                p_h[:,k] += h
+                J[...,k] = (fun(xx, p_h) - f0) / h[:,np.newaxis]
+            return J
+
+    p = np.clip(np.asarray(p0, dtype='float64'), lower, upper)
+    resid = weights * (data - fun(x, p))
+    chi2 = np.sum(resid**2, axis=1)
+    lam = np.full(nbatch, lam0)
+    active = np.ones(nbatch, dtype='bool')
+    converged = np.zeros(nbatch, dtype='bool')
+    niter = np.zeros(nbatch, dtype='int')
+
+    for it in range(maxiter):
+        ix = np.nonzero(active)[0]
+        if len(ix) == 0:
+            break
+        niter[ix] += 1
+
+        # damped normal equations for all active rows
+        J = jac(x[ix], p[ix]) * weights[ix,:,np.newaxis]
+        JT = J.transpose(0,2,1)
+        JTJ = np.matmul(JT, J)
+        JTr = np.matmul(JT, resid[ix,:,np.newaxis])[:,:,0]
+        diag = np.diagonal(JTJ, axis1=1, axis2=2)
+        # parameters that currently have no influence on the model (eg the position of a zero-amplitude peak) get a unit damping term
+        damp = np.where(diag > 0, diag, 1.) * lam[ix,np.newaxis]
+        A = JTJ + damp[:,:,np.newaxis] * np.eye(npar)
+        try:
+            dp = np.linalg.solve(A, JTr[:,:,np.newaxis])[:,:,0]
+        except np.linalg.LinAlgError:
+            dp = np.array([np.linalg.lstsq(A[b], JTr[b], rcond=None)[0] for b in range(len(ix))])
+
+        # trial step (projected onto the bounds)
+        p_trial = np.clip(p[ix] + dp, lower[ix], upper[ix])
+        resid_trial = weights[ix] * (data[ix] - fun(x[ix], p_trial))
+        chi2_trial = np.sum(resid_trial**2, axis=1)
+        better = np.isfinite(chi2_trial) & (chi2_trial <= chi2[ix])
+
+        # convergence checks (before overwriting the old values)
+        small_dchi2 = (chi2[ix] - chi2_trial) <= ftol * chi2[ix]
+        small_dp = np.all(np.abs(p_trial - p[ix]) <= xtol * (np.abs(p[ix]) + xtol), axis=1)
+
+        # accept / reject step per row and adjust the damping accordingly
+        acc = ix[better]
+        p[acc] = p_trial[better]
+        resid[acc] = resid_trial[better]
+        chi2[acc] = chi2_trial[better]
+        lam[acc] = np.maximum(lam[acc] / 10., 1e-12)
+        lam[ix[~better]] *= 10.
+
+        # rows where even a heavily damped (ie negligible) step cannot reduce chi2 any further are at the minimum as well
+        done = (better & (small_dchi2 | small_dp)) | (chi2[ix] == 0) | (~better & (lam[ix] > 1e12))
+        converged[ix[done]] = True
+        active[ix[done]] = False
+
+        if debug_level >= 2:
+            print('iteration ' + str(it+1) + ': ' + str(np.sum(active)) + ' of ' + str(nbatch) + ' fits still active')
+
+    if debug_level >= 1 and np.sum(~converged) > 0:
+        print('WARNING: ' + str(np.sum(~converged)) + ' of ' + str(nbatch) + ' fits did not converge!')
+
+    if timit:
+        print('Time elapsed: '+np.round(time.time() - start_time,2).astype(str)+' seconds...')
+
+    if return_stats:
+        return p, chi2, converged, niter
+    else:
+        return p
+
+
+
 
 def make_norm_profiles(x, o, col, fibparms, fibs='stellar', slope=False, offset=False):  
     
@@ -483,18 +756,27 @@ def make_norm_profiles_5(x, col, fppo, integrate=False, fibs='stellar', slope=Fa
     phi = np.zeros((len(x), nfib + addfibs))
 
     # NOTE: need to turn fibre numbers around here to be correct
-    for k, fib in enumerate(sorted(fppo.keys())[::-1]):
-        mu = fppo[fib]['mu_fit'][col]
-        sigma = fppo[fib]['sigma_fit'][col]
-        beta = fppo[fib]['beta_fit'][col]
-        # now, I think we actually don't want to evaluate the functional form of the profiles as declared by "fibmodel" at the respective locations,
-        # but rather we want to integrate the (highly non-linear) function from the left edge to the right edge of the pixels (co-ordinates are pixel centres!!!)
-        if integrate:
+    if 'mu_fit' in fppo:
+        # compact format (see "get_order_fibparms"), ie (nfib x nx) arrays
+        mus = fppo['mu_fit'][::-1, col]
+        sigmas = fppo['sigma_fit'][::-1, col]
+        betas = fppo['beta_fit'][::-1, col]
+    else:
+        fibs_sorted = sorted(fppo.keys())[::-1]
+        mus = np.array([fppo[fib]['mu_fit'][col] for fib in fibs_sorted])
+        sigmas = np.array([fppo[fib]['sigma_fit'][col] for fib in fibs_sorted])
+        betas = np.array([fppo[fib]['beta_fit'][col] for fib in fibs_sorted])
+    
+    # now, I think we actually don't want to evaluate the functional form of the profiles as declared by "fibmodel" at the respective locations,
+    # but rather we want to integrate the (highly non-linear) function from the left edge to the right edge of the pixels (co-ordinates are pixel centres!!!)
+    if integrate:
+        for k in range(len(mus)):
             for i in np.arange(len(x)):
                 # phi[i,k] = fixed_quad(fibmodel, x[i] - 0.5, x[i] + 0.5, args=(mu, sigma, beta))[0]   # factor of ~4 faster, but not as accurate (fails for simple Gaussian test)
-                phi[i, k] = quad(fibmodel, x[i] - 0.5, x[i] + 0.5, args=(mu, sigma, beta))[0]
-        else:
-            phi[:, k] = fibmodel(x, mu, sigma, beta=beta, alpha=0, norm=0)
+                phi[i, k] = quad(fibmodel, x[i] - 0.5, x[i] + 0.5, args=(mus[k], sigmas[k], betas[k]))[0]
+    else:
+        # all fibres at once
+        phi[:, :len(mus)] = fibmodel(np.asarray(x)[:, np.newaxis], mus, sigmas, beta=betas, alpha=0, norm=0)
 
     if offset and not slope:
         phi[:, -1] = 1.
@@ -526,6 +808,8 @@ def make_norm_profiles_6(x, col, fppo, integrate=False, fibs='stellar', slope=Fa
     
     UPDATE:
     This version now takes the fibparms in explicit form, rather than as a function to apply to 'pix'.
+    'fppo' can also be in the compact array-based format (see "get_profile_parameters.get_order_fibparms"), in which case all
+    fibres are evaluated without any dictionary lookups.
     """
     
     nfib = 26
@@ -571,18 +855,27 @@ def make_norm_profiles_6(x, col, fppo, integrate=False, fibs='stellar', slope=Fa
     phi = np.zeros((len(x), nfib + addfibs))
 
     # NOTE: need to turn fibre numbers around here to be correct
-    for k, fib in enumerate(sorted(fppo.keys())[::-1]):
-        mu = fppo[fib]['mu_fit'][col]
-        sigma = fppo[fib]['sigma_fit'][col]
-        beta = fppo[fib]['beta_fit'][col]
-        # now, I think we actually don't want to evaluate the functional form of the profiles as declared by "fibmodel" at the respective locations,
-        # but rather we want to integrate the (highly non-linear) function from the left edge to the right edge of the pixels (co-ordinates are pixel centres!!!)
-        if integrate:
+    if 'mu_fit' in fppo:
+        # compact format (see "get_order_fibparms"), ie (nfib x nx) arrays
+        mus = fppo['mu_fit'][::-1, col]
+        sigmas = fppo['sigma_fit'][::-1, col]
+        betas = fppo['beta_fit'][::-1, col]
+    else:
+        fibs_sorted = sorted(fppo.keys())[::-1]
+        mus = np.array([fppo[fib]['mu_fit'][col] for fib in fibs_sorted])
+        sigmas = np.array([fppo[fib]['sigma_fit'][col] for fib in fibs_sorted])
+        betas = np.array([fppo[fib]['beta_fit'][col] for fib in fibs_sorted])
+    
+    # now, I think we actually don't want to evaluate the functional form of the profiles as declared by "fibmodel" at the respective locations,
+    # but rather we want to integrate the (highly non-linear) function from the left edge to the right edge of the pixels (co-ordinates are pixel centres!!!)
+    if integrate:
+        for k in range(len(mus)):
             for i in np.arange(len(x)):
                 # phi[i,k] = fixed_quad(fibmodel, x[i] - 0.5, x[i] + 0.5, args=(mu, sigma, beta))[0]   # factor of ~4 faster, but not as accurate (fails for simple Gaussian test)
-                phi[i, k] = quad(fibmodel, x[i] - 0.5, x[i] + 0.5, args=(mu, sigma, beta))[0]
-        else:
-            phi[:, k] = fibmodel(x, mu, sigma, beta=beta, alpha=0, norm=0)
+                phi[i, k] = quad(fibmodel, x[i] - 0.5, x[i] + 0.5, args=(mus[k], sigmas[k], betas[k]))[0]
+    else:
+        # all fibres at once
+        phi[:, :len(mus)] = fibmodel(np.asarray(x)[:, np.newaxis], mus, sigmas, beta=betas, alpha=0, norm=0)
 
     if offset and not slope:
         phi[:, -1] = 1.
@@ -690,17 +983,137 @@ def center(df, width, height):
 
 
 
-def polyfit2d(x, y, z, order=3, return_res=False):
+def poly_basis_1D(x, deg, polytype='polynomial'):
+    """
+    Returns the 1-dim pseudo-Vandermonde matrix (ie the basis functions evaluated at x) of shape (len(x), deg+1) for 
+    standard polynomials, Chebyshev polynomials, or Legendre polynomials.
+    """
+    if polytype.lower() in ['p','polynomial']:
+        return polynomial.polyvander(x, deg)
+    elif polytype.lower() in ['c','chebyshev']:
+        return chebyshev.chebvander(x, deg)
+    elif polytype.lower() in ['l','legendre']:
+        return legendre.legvander(x, deg)
+    else:
+        print("ERROR: polytype not recognised ['(P)olynomial' / '(C)hebyshev' / '(L)egendre']")
+        return
+
+
+
+def get_poly_surface_terms(deg_x, deg_y=None, triangular=False):
+    """
+    Returns the list of (i,j) tuples (i = power in x, j = power in y) describing the terms of a 2-dim polynomial surface.
+    The default ordering is the same as in "polyfit2d", ie [(0,0),(0,1),...,(0,deg_y),(1,0),...]. If "triangular" is set to TRUE, only
+    terms with i+j <= deg_x are used (ie [(0,0),(1,0),...,(deg_x,0),(0,1),(1,1),...]).
+    """
+    if deg_y is None:
+        deg_y = deg_x
+    if triangular:
+        terms = [(i,0) for i in range(deg_x+1)] + [(i,j) for j in range(1,deg_x+1) for i in range(deg_x+1-j)]
+    else:
+        terms = list(itertools.product(range(deg_x+1), range(deg_y+1)))
+    return terms
+
+
+
+def fit_poly_surface_chunked(x, y, z, deg_x=3, deg_y=None, weights=None, polytype='polynomial', triangular=False, clip=None, maxiter=10,
+                             chunksize=2**18, return_mask=False, timit=False):
+    """
+    Linear least-squares fit of a 2-dim polynomial surface (standard polynomials, Chebyshev, or Legendre), without ever building the full 
+    design matrix. Instead, the normal equations (A^T W A) c = A^T W z are accumulated over chunks of the data points (so the memory 
+    usage is set by "chunksize", not by the number of data points), and only the small (n_terms x n_terms) system is solved.
+    Optionally, outliers are iteratively clipped; this only requires re-accumulating the normal equations, but not re-building A.
+    
+    INPUT:
+    'x'           : x-values of the data points (should be normalized to [-1,+1], especially for Chebyshev/Legendre polynomials)
+    'y'           : y-values of the data points (ditto)
+    'z'           : the 'observed' values
+    'deg_x'       : degree of the polynomials in x
+    'deg_y'       : degree of the polynomials in y (default is deg_y = deg_x)
+    'weights'     : weights to use in the fitting (ie the weighted sum of squared residuals, sum_k w_k (f(x_k,y_k) - z_k)^2, is minimized)
+    'polytype'    : types of polynomials to use (either '(p)olynomial' (default), '(l)egendre', or '(c)hebyshev' are accepted)
+    'triangular'  : boolean - if TRUE, only terms x^i*y^j with i+j <= deg_x are used (as in astropy's Polynomial2D)
+    'clip'        : threshold for the iterative clipping of outliers (in units of the RMS of the residuals) - default is no clipping
+    'maxiter'     : maximum number of clipping iterations
+    'chunksize'   : number of data points processed at a time
+    'return_mask' : boolean - do you want to return the mask of the unclipped data points as well?
+    'timit'       : boolean - do you want to measure execution run time?
+    
+    OUTPUT:
+    'coeffs'    : the best-fit coefficients (in the ordering of "get_poly_surface_terms")
+    'goodmask'  : boolean mask of the unclipped data points (only if 'return_mask' is set to TRUE)
+    """
+    
+    if timit:
+        start_time = time.time()
+    
+    if deg_y is None:
+        deg_y = deg_x
+    
+    x = np.asarray(x, dtype='float64').ravel()
+    y = np.asarray(y, dtype='float64').ravel()
+    z = np.asarray(z, dtype='float64').ravel()
+    if weights is None:
+        weights = np.ones(len(z))
+    else:
+        weights = np.asarray(weights, dtype='float64').ravel()
+    
+    terms = get_poly_surface_terms(deg_x, deg_y, triangular=triangular)
+    ix = np.array([t[0] for t in terms])
+    iy = np.array([t[1] for t in terms])
+    
+    goodmask = np.ones(len(z), dtype='bool')
+    niter = 0
+    
+    while True:
+        # accumulate the normal equations (and the residuals of the previous solution if clipping)
+        AtWA = np.zeros((len(terms), len(terms)))
+        AtWz = np.zeros(len(terms))
+        for k in range(0, len(z), chunksize):
+            A = poly_basis_1D(x[k:k+chunksize], deg_x, polytype)[:,ix] * poly_basis_1D(y[k:k+chunksize], deg_y, polytype)[:,iy]
+            w = weights[k:k+chunksize] * goodmask[k:k+chunksize]
+            AtWA += np.dot(A.T, A * w[:,np.newaxis])
+            AtWz += np.dot(A.T, w * z[k:k+chunksize])
+        try:
+            coeffs = np.linalg.solve(AtWA, AtWz)
+        except np.linalg.LinAlgError:
+            coeffs = np.linalg.lstsq(AtWA, AtWz, rcond=None)[0]
+        
+        niter += 1
+        if clip is None or niter > maxiter:
+            break
+        
+        # residuals (chunk by chunk again)
+        resid = np.zeros(len(z))
+        for k in range(0, len(z), chunksize):
+            A = poly_basis_1D(x[k:k+chunksize], deg_x, polytype)[:,ix] * poly_basis_1D(y[k:k+chunksize], deg_y, polytype)[:,iy]
+            resid[k:k+chunksize] = z[k:k+chunksize] - np.dot(A, coeffs)
+        rms = np.std(resid[goodmask])
+        new_goodmask = np.abs(resid) <= clip * rms
+        if np.array_equal(new_goodmask, goodmask):
+            break
+        goodmask = new_goodmask
+    
+    if timit:
+        print('Time elapsed: '+np.round(time.time() - start_time,2).astype(str)+' seconds...')
+    
+    if return_mask:
+        return coeffs, goodmask
+    else:
+        return coeffs
+
+
+
+def polyfit2d(x, y, z, order=3, weights=None, return_res=False):
     """The result (m) is an array of the polynomial coefficients in the model f  = sum_i sum_j a_ij x^i y^j, 
        has the form m = [a00,a01,a02,a03,a10,a11,a12,a13,a20,.....,a33] for order=3
+       If 'weights' are provided, the weighted sum of squared residuals, sum_k w_k (f(x_k,y_k) - z_k)^2, is minimized.
+       The fit is done by accumulating the normal equations in chunks (see "fit_poly_surface_chunked"), so the full design matrix
+       is never built (that would be ~1.2 GB for a 2k x 2k quadrant of the detector).
     """
-    ncols = (order + 1)**2
-    G = np.zeros((x.size, ncols))
-    ij = itertools.product(range(order+1), range(order+1))
-    for k, (i,j) in enumerate(ij):
-        G[:,k] = x**i * y**j
-    m, res, rank, s = np.linalg.lstsq(G, z, rcond=-1)
+    m = fit_poly_surface_chunked(x, y, z, deg_x=order, weights=weights)
     if return_res:
+        res = np.array([np.sum((z - polyval2d(np.asarray(x, dtype='float64'), y, m))**2 * (1. if weights is None else weights))])
         return m, res
     else:
         return m
@@ -734,10 +1147,77 @@ def polyval2d(x, y, m):
 
 
 
-def fit_poly_surface_2D(x_norm, y_norm, z, weights=None, polytype = 'chebyshev', poly_deg_x=5, poly_deg_y=None, timit=False, debug_level=0):
+def polyval2d_grid(x, y, m, polytype='polynomial', dtype='float64', rowsize=None):
+    """
+    Evaluates a 2-dim polynomial surface on the full grid spanned by the 1-dim coordinate arrays 'x' (along the columns) and 'y' (along 
+    the rows), ie the result is the same as polyval2d(X, Y, m) (or m(X,Y) for astropy models) with X,Y = np.meshgrid(x,y). However, 
+    no meshgrids are created; instead the 1-dim basis matrices Vx (nx x (deg_x+1)) and Vy (ny x (deg_y+1)) are computed and the surface
+    is formed as Vy * C * Vx^T with a single matrix product (optionally in row tiles).
+    
+    INPUT:
+    'x'         : 1-dim array of (normalized) x-coordinates
+    'y'         : 1-dim array of (normalized) y-coordinates
+    'm'         : either the coefficients from "polyfit2d" (ie [a00,a01,a02,a03,a10,a11,a12,a13,a20,.....,a33] for order=3), or an 
+                  astropy Polynomial2D / Chebyshev2D / Legendre2D model (eg from "fit_poly_surface_2D")
+    'polytype'  : types of polynomials the coefficients refer to (only used if 'm' is an array of coefficients) ['(p)olynomial' (default), 
+                  '(l)egendre', or '(c)hebyshev']
+    'dtype'     : data type of the output array (eg 'float32' to halve the memory footprint)
+    'rowsize'   : if given, the matrix product is done in tiles of this number of rows
+    
+    OUTPUT:
+    'z'  : 2-dim array of shape (len(y), len(x)) containing the values of the polynomial surface
+    """
+    
+    x = np.asarray(x, dtype='float64').ravel()
+    y = np.asarray(y, dtype='float64').ravel()
+    
+    if hasattr(m, 'param_names'):
+        # astropy model
+        modeltype = m.__class__.__name__
+        if modeltype == 'Polynomial2D':
+            polytype = 'polynomial'
+            deg_x = deg_y = m.degree
+        elif modeltype in ['Chebyshev2D', 'Legendre2D']:
+            polytype = modeltype[:-2].lower()
+            deg_x = m.x_degree
+            deg_y = m.y_degree
+        else:
+            print('ERROR: model type not supported: ' + modeltype)
+            return
+        C = np.zeros((deg_x+1, deg_y+1))
+        for name in m.param_names:
+            i,j = [int(k) for k in name[1:].split('_')]
+            C[i,j] = getattr(m, name).value
+        # apply the mapping from domain to window, if the model has one
+        if getattr(m, 'x_domain', None) is not None:
+            x = polynomial.polyval(x, polyutils.mapparms(m.x_domain, m.x_window))
+        if getattr(m, 'y_domain', None) is not None:
+            y = polynomial.polyval(y, polyutils.mapparms(m.y_domain, m.y_window))
+    else:
+        deg = int(np.sqrt(len(m))) - 1
+        deg_x = deg_y = deg
+        C = np.asarray(m, dtype='float64').reshape((deg+1, deg+1))
+    
+    # (deg_y+1) x nx
+    B = np.dot(C.T, poly_basis_1D(x, deg_x, polytype).T).astype(dtype)
+    Vy = poly_basis_1D(y, deg_y, polytype).astype(dtype)
+    
+    if rowsize is None:
+        return np.dot(Vy, B)
+    else:
+        z = np.empty((len(y), len(x)), dtype=dtype)
+        for r in range(0, len(y), rowsize):
+            np.dot(Vy[r:r+rowsize], B, out=z[r:r+rowsize])
+        return z
+
+
+
+def fit_poly_surface_2D(x_norm, y_norm, z, weights=None, polytype = 'chebyshev', poly_deg_x=5, poly_deg_y=None, use_astropy_fitter=False, timit=False, debug_level=0):
     """
     Calculate 2D polynomial fit to normalized x and y values.
-    Wrapper function for using the astropy fitting library.
+    Wrapper function for using the astropy modelling library. As these models are linear in their parameters, the best-fit 
+    parameters are by default obtained directly from the linear least-squares solution (using "fit_poly_surface_chunked"), which
+    is much faster than the astropy LevMar fitter.
     
     INPUT:
     'x_norm'      : x-values (pixels) of all the lines, re-normalized to [-1,+1]
@@ -746,6 +1226,7 @@ def fit_poly_surface_2D(x_norm, y_norm, z, weights=None, polytype = 'chebyshev',
     'weights'     : weights to use in the fitting
     'polytype'    : types of polynomials to use (either '(p)olynomial' (default), '(l)egendre', or '(c)hebyshev' are accepted)
     'poly_deg'    : degree of the polynomials
+    'use_astropy_fitter' : boolean - do you want to use the (slow) astropy LevMarLSQFitter instead?
     'timit'       : boolean - do you want to measure execution run time?
     'debug_level' : for debugging... 
         
@@ -775,12 +1256,24 @@ def fit_poly_surface_2D(x_norm, y_norm, z, weights=None, polytype = 'chebyshev',
         print("ERROR: polytype not recognised ['(P)olynomial' / '(C)hebyshev' / '(L)egendre']")    
         return
     
-    fit_p = fitting.LevMarLSQFitter()  
-
-    with warnings.catch_warnings():
-        # Ignore model linearity warning from the fitter
-        warnings.simplefilter('ignore')
-        p = fit_p(p_init, x_norm, y_norm, z, weights=weights)
+    if use_astropy_fitter:
+        fit_p = fitting.LevMarLSQFitter()  
+    
+        with warnings.catch_warnings():
+            # Ignore model linearity warning from the fitter
+            warnings.simplefilter('ignore')
+            p = fit_p(p_init, x_norm, y_norm, z, weights=weights)
+    else:
+        # NOTE: astropy's weights multiply the residuals, so they need to be squared here
+        if weights is not None:
+            weights = np.asarray(weights)**2
+        triangular = polytype.lower() in ['p','polynomial']
+        terms = get_poly_surface_terms(poly_deg_x, poly_deg_y, triangular=triangular)
+        coeffs = fit_poly_surface_chunked(x_norm, y_norm, z, deg_x=poly_deg_x, deg_y=poly_deg_y, weights=weights, polytype=polytype,
+                                          triangular=triangular)
+        p = p_init.copy()
+        for (i,j),c in zip(terms, coeffs):
+            setattr(p, 'c'+str(i)+'_'+str(j), c)
         
     if timit:
         print('Time elapsed: '+np.round(time.time() - start_time,2).astype(str)+' seconds...')
@@ -789,6 +1282,145 @@ def fit_poly_surface_2D(x_norm, y_norm, z, weights=None, polytype = 'chebyshev',
 
 
 
+def share_array(arr):
+    """
+    Copies an array into a newly created block of shared memory, so that worker processes can access it without it being pickled 
+    and sent to every one of them. The caller is responsible for calling shm.close() and shm.unlink() when done.
+    
+    INPUT:
+    'arr'  : the array to be shared
+    
+    OUTPUT:
+    'shm'  : the SharedMemory instance
+    'ref'  : a (small, picklable) reference to the shared array, ie (name, shape, dtype), to be used with "attach_shared_array"
+    """
+    arr = np.ascontiguousarray(arr)
+    shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+    shared = np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)
+    shared[...] = arr
+    del shared
+    return shm, (shm.name, arr.shape, arr.dtype.str)
+
+
+
+def attach_shared_array(ref):
+    """
+    Counterpart of "share_array": returns the SharedMemory instance and the array for a reference (name, shape, dtype). Anything that 
+    is not such a reference (eg an array that is passed directly) is returned unchanged, with shm = None. All views of the array must
+    be deleted before calling shm.close().
+    """
+    if not isinstance(ref, tuple):
+        return None, ref
+    name, shape, dtype = ref
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+
+def timed_call(func, args, kwargs):
+    # wrapper that also returns the run time of a function call (used by "run_orders_in_parallel")
+    start_time = time.time()
+    result = func(*args, **kwargs)
+    return result, time.time() - start_time
+
+
+
+def run_orders_in_parallel(func, args, kwargs=None, nthreads=4, use_processes=True):
+    """
+    Runs a function independently for every order in a pool of workers, and reports the progress and run time for every order
+    as soon as it is done.
+    
+    INPUT:
+    'func'          : the function to be run for every order (needs to be defined at module level if 'use_processes' is TRUE)
+    'args'          : dictionary (keys = orders) containing the tuples of positional arguments for every order
+    'kwargs'        : dictionary of keyword arguments (the same for all orders)
+    'nthreads'      : number of parallel workers
+    'use_processes' : boolean - use a pool of processes rather than a pool of threads
+    
+    OUTPUT:
+    'results'       : dictionary (keys = orders) containing the return values of 'func'
+    """
+    
+    if kwargs is None:
+        kwargs = {}
+    
+    if use_processes:
+        executor = ProcessPoolExecutor(max_workers=nthreads)
+    else:
+        executor = ThreadPoolExecutor(max_workers=nthreads)
+    
+    results = {}
+    with executor:
+        futures = {executor.submit(timed_call, func, args[ord], kwargs): ord for ord in sorted(args.keys())}
+        for n,future in enumerate(as_completed(futures)):
+            ord = futures[future]
+            results[ord], delta_t = future.result()
+            print('OK, finished ' + str(ord) + ' (' + str(n+1) + '/' + str(len(futures)) + ') in ' + np.round(delta_t,1).astype(str) + ' seconds')
+    
+    # same ordering as the serial version
+    return {ord: results[ord] for ord in sorted(results.keys())}
+
+
+
+def stack_median_and_min(imgs, scales=None, median=True, minimum=False, max_mem=5e8, timit=False):
+    """
+    Calculates the (scaled) median image and/or the (scaled) element-wise minimum image of a stack of images, at bounded memory.
+    Instead of building the full (n_img x ny x nx) cube, the stack is processed in bands of rows, so that the temporary cube never
+    exceeds "max_mem" bytes. The result is identical to np.median(np.array(imgs) / scales.reshape(-1,1,1), axis=0) etc.
+    
+    INPUT:
+    'imgs'     : sequence of 2-dim images with identical dimensions (eg a list of arrays, or an (n_img x ny x nx) np.memmap, as
+                 created by "make_calibrated_stack")
+    'scales'   : the images are divided by these scale factors before the statistics are computed (eg relative exposure times)
+    'median'   : boolean - do you want the median image?
+    'minimum'  : boolean - do you want the element-wise minimum image?
+    'max_mem'  : maximum size of the temporary cube [bytes]
+    'timit'    : boolean - do you want to measure execution run time?
+    
+    OUTPUT:
+    'medimg'   : the median image (if 'median' is set to TRUE)
+    'minimg'   : the minimum image (if 'minimum' is set to TRUE)
+    """
+    
+    if timit:
+        start_time = time.time()
+    
+    n_img = len(imgs)
+    ny, nx = imgs[0].shape
+    if scales is None:
+        scales = np.ones(n_img)
+    scales = np.asarray(scales, dtype='float64').reshape(n_img, 1, 1)
+    
+    # number of rows per band so that we don't exceed the memory limit
+    nrows = int(np.clip(max_mem // (n_img * nx * 8), 1, ny))
+    
+    if median:
+        medimg = np.zeros((ny, nx))
+    if minimum:
+        minimg = np.zeros((ny, nx))
+    
+    for y0 in range(0, ny, nrows):
+        band = np.array([img[y0:y0+nrows,:] for img in imgs], dtype='float64') / scales
+        if median:
+            medimg[y0:y0+nrows,:] = np.median(band, axis=0)
+        if minimum:
+            minimg[y0:y0+nrows,:] = np.min(band, axis=0)
+        del band
+    
+    if timit:
+        print('Time elapsed: '+np.round(time.time() - start_time,2).astype(str)+' seconds...')
+    
+    if median and minimum:
+        return medimg, minimg
+    elif median:
+        return medimg
+    elif minimum:
+        return minimg
+    else:
+        return
+
+
+
 def find_blaze_peaks(flux,P_id):
     """ find the peaks of the blaze function for each order """
     
@@ -957,6 +1589,128 @@ def sigma_clip(x, tl, th=None, centre='median', return_indices=False):
     
     
     
+def sigma_clip_rows(x, tl, th=None, centre='median'):
+    """
+    Vectorized version of "sigma_clip" for all rows of an array at once (ie along the last axis). Rows containing non-finite values
+    are left unclipped (same as in "sigma_clip", where the RMS of such rows is NaN). The result is the same as from "sigma_clip", 
+    except for round-off in cases where a data point lies exactly on the threshold (which can only happen for thresholds <= 1).
+    
+    INPUT:
+    'x'              : the array to be sigma-clipped (any shape, the clipping is done along the last axis)
+    'tl'             : lower threshold (in terms of sigma)
+    'th'             : higher threshold (in terms of sigma) (if only one threshold is given then th=tl=t)
+    'centre'         : method to determine the centre ('median' or 'mean')
+    
+    OUTPUT:
+    'goodmask'  : boolean mask with the same shape as x, where True identifies the unclipped data points
+    """
+    
+    # make sure both boundaries are defined
+    if th is None:
+        th = tl
+    
+    if centre.lower() not in ['median', 'mean']:
+        print('ERROR: Method for computing centre must be "median" or "mean"')
+        return
+    
+    x2 = np.asarray(x).reshape(-1, x.shape[-1])
+    goodmask = np.ones(x2.shape, dtype='bool')
+    # only rows with finite values can be clipped
+    active = np.where(np.all(np.isfinite(x2), axis=-1))[0]
+    if len(active) == 0:
+        return goodmask.reshape(x.shape)
+    
+    # The data points are only ever clipped from the two ends of the distribution, so in a sorted row the unclipped data points are
+    # always one contiguous window [lo, hi), which can only shrink. We therefore only need to sort once; the sums over the windows 
+    # are then taken in one "reduceat" call each (the RMS from the deviations from the median of the row, to avoid round-off errors), 
+    # and the new edges of the windows follow from a binary search. Rows that have converged are dropped from the working set.
+    s = np.sort(x2[active], axis=-1)
+    n_all = s.shape[1]
+    dev = s - s[:, n_all // 2][:,np.newaxis]
+    # (padded, so that the end of the last window is a valid index)
+    s_flat = np.r_[s.ravel(), 0.]
+    dev_flat = np.r_[dev.ravel(), 0.]
+    dev2_flat = dev_flat * dev_flat
+    lo = np.zeros(len(active), dtype=int)
+    hi = np.full(len(active), n_all)
+    rows = np.arange(len(active))
+    
+    while len(rows) > 0:
+        l = lo[rows]
+        h = hi[rows]
+        n = h - l
+        edges = np.ravel(np.column_stack((rows * n_all + l, rows * n_all + h)))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean_dev = np.where(n > 0, np.add.reduceat(dev_flat, edges)[::2], np.nan) / n
+            rms = np.sqrt(np.maximum(np.add.reduceat(dev2_flat, edges)[::2] / n - mean_dev**2, 0.))
+            if centre.lower() == 'median':
+                cen = 0.5 * (s[rows, np.clip(l + (n - 1) // 2, 0, n_all - 1)] + s[rows, np.clip(l + n // 2, 0, n_all - 1)])
+            else:
+                cen = np.add.reduceat(s_flat, edges)[::2] / n
+        # new edges of the windows (same conditions as in "sigma_clip"), ie the first point that is not too low, and the first point 
+        # that is too high
+        new_lo = bisect_rows(s, rows, l, h, lambda v: cen - v > tl*rms)
+        new_hi = bisect_rows(s, rows, new_lo, h, lambda v: ~(v - cen > th*rms))
+        changed = (new_lo != l) | (new_hi != h)
+        lo[rows] = new_lo
+        hi[rows] = new_hi
+        rows = rows[changed]
+    
+    # translate the windows back to the unsorted rows (equal values are either all clipped or all kept, so this is unambiguous)
+    ix = np.arange(len(active))
+    lowval = s[ix, np.clip(lo, 0, n_all - 1)][:,np.newaxis]
+    highval = s[ix, np.clip(hi - 1, 0, n_all - 1)][:,np.newaxis]
+    goodmask[active] = (x2[active] >= lowval) & (x2[active] <= highval) & (hi > lo)[:,np.newaxis]
+    
+    return goodmask.reshape(x.shape)
+    
+    
+    
+def bisect_rows(s, rows, lo, hi, cond):
+    """
+    Vectorized binary search in the rows 'rows' of 's': for every row, returns the first index i in [lo, hi) for which cond(s[row,i])
+    is FALSE (or hi if there is none), where cond must be TRUE for the first and FALSE for the last part of [lo, hi) (eg for sorted rows).
+    """
+    lo = np.array(lo)
+    hi = np.array(hi)
+    while True:
+        todo = lo < hi
+        if not np.any(todo):
+            return lo
+        mid = (lo + hi) // 2
+        c = cond(s[rows, np.minimum(mid, s.shape[1] - 1)])
+        lo = np.where(todo & c, mid + 1, lo)
+        hi = np.where(todo & ~c, mid, hi)
+    
+    
+    
+def weighted_median_rows(x, w):
+    """
+    Weighted median of all rows of an array at once (ie along the last axis), ie the smallest value of x for which the cumulative
+    weight reaches half of the total weight of that row. Data points with zero weight are ignored. Rows with zero total weight return NaN.
+
+    INPUT:
+    'x'  : the data (any shape, the median is taken along the last axis)
+    'w'  : the (non-negative) weights (same shape as x)
+
+    OUTPUT:
+    'wmed'  : the weighted medians (shape x.shape[:-1])
+    """
+
+    w = np.where(np.isfinite(x), w, 0.)
+    x = np.where(w > 0, x, np.inf)
+    ix = np.argsort(x, axis=-1)
+    xs = np.take_along_axis(x, ix, axis=-1)
+    cw = np.cumsum(np.take_along_axis(w, ix, axis=-1), axis=-1)
+    total = cw[..., -1:]
+    # first point for which the cumulative weight reaches half the total weight
+    k = np.argmax(cw >= 0.5 * total, axis=-1)
+    wmed = np.take_along_axis(xs, k[..., np.newaxis], axis=-1)[..., 0]
+
+    return np.where(total[..., 0] > 0, wmed, np.nan)
+    
+    
+    
 def offset_pseudo_gausslike(x, G_amplitude, L_amplitude, G_center, L_center, G_sigma, L_sigma, beta):
     """ similar to Pseudo-Voigt-Model (e.g. see here: https://lmfit.github.io/lmfit-py/builtin_models.html), 
         but allows for offset between two functions and allows for beta to vary """
@@ -1358,7 +2112,7 @@ def jdnow():
 
 def laser_on(img, chipmask, thresh=1000, count=3000):
     """check if the LFC was on for a given exposure"""
-    n_high = np.sum(img[chipmask['lfc']] > thresh)
+    n_high = np.sum(img[get_chipmask_plane(chipmask, 'lfc')] > thresh)
     ison = n_high >= count
     return ison
 
@@ -1366,7 +2120,7 @@ def laser_on(img, chipmask, thresh=1000, count=3000):
 
 def thxe_on(img, chipmask, thresh=1000, count=1500):
     """check if the sim ThXe lamp was on for a given exposure"""
-    n_high = np.sum(img[chipmask['thxe']] > thresh)
+    n_high = np.sum(img[get_chipmask_plane(chipmask, 'thxe')] > thresh)
     ison = n_high >= count
     return ison
 
@@ -11,6 +11,7 @@ import scipy.sparse as sparse
 import time
 
 from veloce_reduction.veloce_reduction.helper_functions import sigma_clip
+from veloce_reduction.veloce_reduction.background import get_order_intervals, get_interval_pixels
 
 
 
@@ -88,77 +89,68 @@ def find_stripes(flat, deg_polynomial=2, gauss_filter_sigma=3., min_peak=0.05, m
     orders = np.zeros((n_order, nx))
     # because we only want to use good pixels in the fit later on
     mask = np.ones((n_order, nx), dtype=bool)
-
-    # walk through to the left and right along the maximum of the order
-    # loop over all orders:
-    for m, row in enumerate(maxima):
-        column = int(nx / 2)
-        orders[m, column] = row
-        start_row = row
-        # walk right
-        while (column + 1 < nx):
-            column += 1
-            args = np.array(np.linspace(max(1, start_row - 1), min(start_row + 1, ny - 1), 3), dtype=int)
-            args = args[np.logical_and(args < ny, args > 0)]     #deal with potential edge effects
+    
+    # walk through to the left and right along the maximum of the order (all orders are traced simultaneously, one column at a time);
+    # in each column, the new trace position is the brightest of the three pixels around the trace position in the previous column
+    ordix = np.arange(n_order)
+    steps = np.array([0., 0.5, 1.])
+    for direction in [1,-1]:
+        start_row = maxima.copy()
+        orders[:, int(nx / 2)] = start_row
+        if direction == 1:
+            columns = range(int(nx / 2) + 1, nx)
+        else:
+            columns = range(int(nx / 2) - 1, -1, -1)
+        for column in columns:
+            lower = np.maximum(1, start_row - 1)
+            upper = np.minimum(start_row + 1, ny - 1)
+            args = (lower[:,np.newaxis] + (upper - lower)[:,np.newaxis] * steps).astype(int)
             p = filtered_flat[args, column]
             # new maximum (apply only when there are actually flux values in p, ie not when eg p=[0,0,0]), otherwise leave start_row unchanged
-            if ~(p[0]==p[1] and p[0]==p[2]):
-                start_row = args[np.argmax(p)]
-            orders[m, column] = start_row
+            flatp = (p[:,0] == p[:,1]) & (p[:,0] == p[:,2])
+            start_row = np.where(flatp, start_row, args[ordix, np.argmax(p, axis=1)])
+            orders[:, column] = start_row
             #build mask - exclude pixels at upper/lower end of chip; also exclude peaks that do not lie at least 5 sigmas above rms of 3-sigma clipped background (+/- cliprange pixels from peak location)
-            #if ((p < 10).all()) or ((column > 3500) and (mask[m,column-1]==False)) or (start_row in (0,nx-1)) or (m==42 and (p < 100).all()):
             if slowmask:
                 cliprange = 25
-                bg = filtered_flat[start_row-cliprange:start_row+cliprange+1, column]
-                clipped = sigma_clip(bg,3.)
-                if (filtered_flat[start_row,column] - np.median(clipped) < 5.*np.std(clipped)) or (start_row in (0,nx-1)):
-                    mask[m,column] = False
+                for m in range(n_order):
+                    bg = filtered_flat[start_row[m]-cliprange:start_row[m]+cliprange+1, column]
+                    clipped = sigma_clip(bg,3.)
+                    if (filtered_flat[start_row[m],column] - np.median(clipped) < 5.*np.std(clipped)) or (start_row[m] in (0,nx-1)):
+                        mask[m,column] = False
             else:
-                if ((p < maskthresh).all()) or (start_row in (0,ny-1)):
-                    mask[m,column] = False
-        # walk left
-        column = int(nx / 2)
-        start_row = row
-        while (column > 0):
-            column -= 1
-            args = np.array(np.linspace(max(1, start_row - 1), min(start_row + 1, ny - 1), 3), dtype=int)
-            args = args[np.logical_and(args < ny, args > 0)]     #deal with potential edge effects
-            p = filtered_flat[args, column]
-            # new maximum (apply only when there are actually flux values in p, ie not when eg p=[0,0,0]), otherwise leave start_row unchanged
-            if ~(p[0]==p[1] and p[0]==p[2]):
-                start_row = args[np.argmax(p)]
-            orders[m, column] = start_row
-            #build mask - exclude pixels at upper/lower end of chip; also exclude peaks that do not lie at least 5 sigmas above rms of 3-sigma clipped bcakground (+/- cliprange pixels from peak location)
-            #if ((p < 10).all()) or ((column < 500) and (mask[m,column+1]==False)) or (start_row in (0,nx-1)) or (m==42 and (p < 100).all()):
-            if slowmask:
-                cliprange = 25
-                bg = filtered_flat[start_row-cliprange:start_row+cliprange+1, column]
-                clipped = sigma_clip(bg,3.)
-                if (filtered_flat[start_row,column] - np.median(clipped) < 5.*np.std(clipped)) or (start_row in (0,nx-1)):
-                    mask[m,column] = False
-            else:
-                if ((p < maskthresh).all()) or (start_row in (0,ny-1)) or (simu==True and m==0 and column < 1300) or (simu==False and m==0 and column < 900):
-                    mask[m,column] = False
-    # do Polynomial fit for each order
+                mask[:, column] &= ~((p < maskthresh).all(axis=1) | (start_row == 0) | (start_row == ny-1))
+                if direction == -1 and n_order > 0:
+                    # the bad-column region in the first (incomplete) order
+                    if (simu==True and column < 1300) or (simu==False and column < 900):
+                        mask[0, column] = False
+    
+    # do Polynomial fit for each order (all at once, by solving the (weighted) normal equations for all orders simultaneously)
     #logging.info('Fit polynomial of order %d to each stripe' % deg_polynomial)
     print('Fit polynomial of order %d to each stripe...' % deg_polynomial)
-    P = []
     xx = np.arange(nx)
-    for i in range(len(orders)):
-        if not weighted_fits:
-            #unweighted
-            p = np.poly1d(np.polyfit(xx[mask[i,:]], orders[i,mask[i,:]], deg_polynomial))
-        else:
-            #weighted
-            filtered_flux_along_order = np.zeros(nx)
-            for j in range(nx):
-                #filtered_flux_along_order[j] = filtered_flat[o[j].astype(int),j]    #that was when the loop reas: "for o in orders:"
-                filtered_flux_along_order[j] = filtered_flat[orders[i,j].astype(int),j]
-            filtered_flux_along_order[filtered_flux_along_order < 1] = 1   
-            #w = 1. / np.sqrt(filtered_flux_along_order)   this would weight the order centres less!!!
-            w = np.sqrt(filtered_flux_along_order)
-            p = np.poly1d(np.polyfit(xx[mask[i,:]], orders[i,mask[i,:]], deg_polynomial, w=w[mask[i,:]]))
-        P.append(p)
+    if not weighted_fits:
+        #unweighted
+        w = mask.astype(float)
+    else:
+        #weighted
+        filtered_flux_along_order = filtered_flat[orders.astype(int), xx]
+        filtered_flux_along_order[filtered_flux_along_order < 1] = 1   
+        #w = 1. / np.sqrt(filtered_flux_along_order)   this would weight the order centres less!!!
+        # (np.polyfit's weights multiply the residuals, so the weights in the normal equations are the squares of those)
+        w = filtered_flux_along_order * mask
+    # use a normalized x-coordinate for numerical stability
+    xnorm = (xx - nx/2.) / (nx/2.)
+    V = np.vander(xnorm, deg_polynomial + 1, increasing=True)
+    AtWA = np.einsum('ox,xk,xl->okl', w, V, V)
+    AtWy = np.einsum('ox,xk->ok', w * orders, V)
+    try:
+        coeffs = np.linalg.solve(AtWA, AtWy[:,:,np.newaxis])[:,:,0]
+    except np.linalg.LinAlgError:
+        coeffs = np.array([np.linalg.lstsq(AtWA[i], AtWy[i], rcond=None)[0] for i in range(n_order)])
+    # convert back to polynomials in the actual pixel coordinates
+    xnorm_poly = np.poly1d([1. / (nx/2.), -1.])
+    P = [np.poly1d(c[::-1])(xnorm_poly) for c in coeffs]
 
     if debug_level > 0:
         plt.figure()
@@ -414,8 +406,50 @@ def make_order_traces_from_fibparms(fibparms, from_simcalibs=False, degpol=7):
         traces['allfib'][ord] = allfib_trace_fit
     
     return traces
-        
-        
+
+
+
+def make_trace_tables(P_id, nx=4112):
+    """
+    Evaluates the order traces once for all pixel columns, so that routines that work through an order column by column can simply
+    index these tables, rather than evaluating the trace polynomials over and over. The trace polynomials of all orders are evaluated
+    simultaneously (Horner's scheme on the stacked coefficients).
+    (The positions of the individual fibres are available as contiguous (n_fib, nx) arrays from "get_order_fibparms".)
+
+    INPUT:
+    'P_id'      : dictionary of the form of {order: np.poly1d, ...} (as returned by "identify_stripes")
+    'nx'        : number of pixel columns
+
+    OUTPUT:
+    'trace_tables'  : dictionary containing:
+                      'orders'  : list of the orders (sorted, ie row i of the tables belongs to order trace_tables['orders'][i])
+                      'centres' : (n_ord, nx)-array of the trace centres
+    """
+
+    orders = sorted(P_id.keys())
+    xx = np.arange(nx, dtype='f8')
+
+    # stack the polynomial coefficients (highest power first, padded to the same degree)
+    coeffs = [np.atleast_1d(np.asarray(P_id[ord], dtype='f8')) for ord in orders]
+    deg = np.max([len(c) for c in coeffs]) - 1
+    coeffs = np.array([np.r_[np.zeros(deg + 1 - len(c)), c] for c in coeffs])
+    centres = np.zeros((len(orders), nx))
+    for c in coeffs.T:
+        centres = centres * xx + c[:,np.newaxis]
+
+    trace_tables = {'orders':orders, 'centres':centres}
+
+    return trace_tables
+
+
+
+def get_order_trace(trace_tables, ord):
+    """
+    Returns the trace centres for one order from the output of "make_trace_tables".
+    """
+    return trace_tables['centres'][trace_tables['orders'].index(ord)]
+
+
 
 def extract_single_stripe(img, p, slit_height=25, return_indices=False, indonly=False, debug_level=0):
     """
@@ -439,16 +473,12 @@ def extract_single_stripe(img, p, slit_height=25, return_indices=False, indonly=
     #start_time = time.time()
     
     ny, nx = img.shape
-    #xx = np.arange(nx, dtype=img.dtype)
-    xx = np.arange(nx, dtype='f8')
-    #yy = np.arange(ny, dtype=img.dtype)
-    yy = np.arange(ny, dtype='f8')
 
-    y = np.poly1d(p)(xx)
-    x_grid, y_grid = np.meshgrid(xx, yy, copy=False)
-
-    distance = y_grid - y.repeat(ny).reshape((nx, ny)).T
-    indices = abs(distance) <= slit_height
+    # the stripe consists of all pixels within slit_height of the trace, ie one interval of rows in each column
+    starts, stops = get_order_intervals({'order': p}, nx, slit_height=slit_height)
+    rows, cols = get_interval_pixels(np.clip(starts, 0, ny), np.clip(stops, 0, ny))
+    indices = np.zeros((ny, nx), dtype=bool)
+    indices[rows, cols] = True
 
     if debug_level >= 2:
         plt.figure()
@@ -456,7 +486,7 @@ def extract_single_stripe(img, p, slit_height=25, return_indices=False, indonly=
         plt.imshow(indices, origin='lower', alpha=0.5)
         plt.show()
 
-    mat = sparse.coo_matrix((img[indices], (y_grid[indices], x_grid[indices])), shape=(ny, nx))
+    mat = sparse.coo_matrix((np.asarray(img)[rows, cols], (rows, cols)), shape=(ny, nx))
     # return mat.tocsr()
     
     #print('Elapsed time: ',time.time() - start_time,' seconds')
@@ -551,6 +581,133 @@ def extract_stripes(img, P_id, slit_height=25, return_indices=True, savefiles=Fa
 
 
 
+def make_trace_drift_reference(white, P_id, nbands=8, bandwidth=32, slit_height=40):
+    """
+    Prepares the reference for measuring the drift of the traces in the spatial direction (see "measure_trace_drift"), ie the 
+    profiles of all orders in a handful of bands of columns of the (master) white, from which the traces (P_id) were determined. 
+    This only needs to be done once per night.
+    
+    INPUT:
+    'white'        : the (master) white [2-dim np.array]
+    'P_id'         : dictionary of the form of {order: np.poly1d, ...} (as returned by "identify_stripes")
+    'nbands'       : number of bands of columns
+    'bandwidth'    : number of columns in each band
+    'slit_height'  : half the height of the window around the trace used for each order (the window has to contain the entire fibre bundle,
+                     with a margin of at least the largest expected shift, otherwise the measured shifts are biased low)
+    
+    OUTPUT:
+    'drift_ref'  : dictionary containing the reference profiles (n_ord x nbands x (2*slit_height+1)) and everything needed to 
+                   extract the corresponding profiles from other images
+    """
+    
+    ny, nx = white.shape
+    orders = sorted(P_id.keys())
+    
+    # columns of the bands (evenly spread across the chip)
+    band_starts = np.round(np.linspace(0, nx - bandwidth, nbands + 2)[1:-1]).astype(int)
+    cols = band_starts[:,np.newaxis] + np.arange(bandwidth)
+    
+    # first rows of the windows around the traces in each column (so that the profiles are not smeared out by the curvature of 
+    # the orders when the columns of a band are added up); windows not entirely on the chip are not used
+    rows0 = np.array([np.round(np.poly1d(P_id[o])(cols)).astype(int) - slit_height for o in orders])
+    valid = np.all((rows0 >= 0) & (rows0 + 2*slit_height + 1 <= ny), axis=-1)
+    rows0 = np.clip(rows0, 0, ny - (2*slit_height + 1))
+    
+    drift_ref = {'orders':orders, 'cols':cols, 'slit_height':slit_height, 'rows0':rows0, 'valid':valid}
+    drift_ref['profiles'] = get_band_profiles(white, drift_ref)
+    
+    return drift_ref
+
+
+
+def get_band_profiles(img, drift_ref):
+    """
+    Cuts out the windows around the traces of all orders in the bands of columns defined by "make_trace_drift_reference", and adds 
+    up the columns of each band.
+    
+    OUTPUT:
+    'profiles'  : (n_ord x nbands x (2*slit_height+1))-array of the profiles
+    """
+    rows = drift_ref['rows0'][...,np.newaxis] + np.arange(2*drift_ref['slit_height'] + 1)
+    return np.sum(img[rows, drift_ref['cols'][np.newaxis,:,:,np.newaxis]], axis=2)
+
+
+
+def measure_trace_drift(img, drift_ref, maxshift=1, highpass=5, osf=20, timit=False):
+    """
+    Measures the drift of the spectrum in the spatial direction (ie perpendicular to the dispersion direction) with respect to the
+    (master) white that was used to determine the traces and fibre profiles. The summed profiles in a handful of bands of columns are
+    cross-correlated (via FFTs, for all orders and bands at once) against the corresponding profiles of the white. The cross-correlation
+    function is oversampled by zero-padding in Fourier space, and the location of its peak is refined to sub-pixel precision by fitting a 
+    parabola to its three highest points.
+    The profiles are high-pass filtered first, so that the cross-correlation is dominated by the structure of the individual fibres
+    rather than by the overall envelope (which depends on how the fibres are illuminated, and hence differs between the white and
+    eg a stellar exposure). For the same reason, 'maxshift' should be smaller than about half the fibre separation.
+    The cost is dominated by summing the bands of columns, so this is very cheap.
+    
+    INPUT:
+    'img'        : the (bias-, dark-, and background-corrected) image [2-dim np.array]
+    'drift_ref'  : the reference profiles (as returned by "make_trace_drift_reference")
+    'maxshift'   : maximum shift considered [pixels]
+    'highpass'   : width of the running mean that is subtracted from the profiles before cross-correlating them [pixels] (None for no filtering)
+    'osf'        : oversampling factor for the cross-correlation function
+    'timit'      : boolean - do you want to measure execution run time?
+    
+    OUTPUT:
+    'drift'         : dictionary (keys = orders) containing the shifts of the orders [pixels] (positive shifts mean the spectrum moved towards 
+                      higher row numbers); orders without a valid measurement get the global shift
+    'global_drift'  : the median shift of all valid measurements [pixels]
+    """
+    
+    if timit:
+        start_time = time.time()
+    
+    ref = drift_ref['profiles']
+    prof = get_band_profiles(img, drift_ref)
+    L = ref.shape[-1]
+    
+    # (oversampled) cross-correlation function (zero-padded to avoid wrap-around) for all orders and bands at once
+    if highpass is not None:
+        ref = ref - ndimage.uniform_filter1d(ref, highpass, axis=-1, mode='nearest')
+        prof = prof - ndimage.uniform_filter1d(prof, highpass, axis=-1, mode='nearest')
+    ref = ref - np.mean(ref, axis=-1, keepdims=True)
+    prof = prof - np.mean(prof, axis=-1, keepdims=True)
+    ccf = np.fft.irfft(np.fft.rfft(prof, n=2*L) * np.conj(np.fft.rfft(ref, n=2*L)), n=2*L*osf)
+    lagix = np.arange(-int(maxshift*osf)-1, int(maxshift*osf)+2)
+    ccf = ccf[..., lagix % (2*L*osf)]
+    lags = lagix / float(osf)
+    
+    # find peak (ignoring the outermost lags, which are only needed for the parabola fit) and refine with a parabola
+    k = np.argmax(ccf[..., 1:-1], axis=-1) + 1
+    c0 = np.take_along_axis(ccf, k[...,np.newaxis], axis=-1)[...,0]
+    cm = np.take_along_axis(ccf, k[...,np.newaxis]-1, axis=-1)[...,0]
+    cp = np.take_along_axis(ccf, k[...,np.newaxis]+1, axis=-1)[...,0]
+    denom = cm - 2.*c0 + cp
+    with np.errstate(invalid='ignore', divide='ignore'):
+        shifts = lags[k] + 0.5 * (cm - cp) / denom / osf
+    # only accept measurements from windows on the chip, with a proper peak inside the search range, and with signal in the white
+    good = drift_ref['valid'] & (denom < 0) & (c0 > 0) & (np.abs(shifts) <= maxshift) & np.isfinite(shifts)
+    
+    if np.sum(good) > 0:
+        global_drift = np.median(shifts[good])
+    else:
+        print('WARNING: trace drift could not be measured!!!')
+        global_drift = 0.
+    
+    drift = {}
+    for i,o in enumerate(drift_ref['orders']):
+        if np.sum(good[i]) > 0:
+            drift[o] = np.median(shifts[i, good[i]])
+        else:
+            drift[o] = global_drift
+    
+    if timit:
+        print('Time elapsed: ' + str(np.round(time.time() - start_time, 3)) + ' seconds')
+    
+    return drift, global_drift
+
+
+
 def flatten_single_stripe(stripe, slit_height=25, timit=False):
     """
     CMB 06/09/2017
@@ -7,14 +7,37 @@ import scipy.optimize as op
 
 from veloce_reduction.veloce_reduction.wavelength_solution import find_suitable_peaks
 from veloce_reduction.veloce_reduction.helper_functions import multi_fibmodel_with_amp, CMB_multi_gaussian, \
-    central_parts_of_mask, multi_fibmodel_with_amp_and_offset, CMB_multi_gaussian_with_offset
-from veloce_reduction.veloce_reduction.order_tracing import flatten_single_stripe, flatten_single_stripe_from_indices
+    central_parts_of_mask, multi_fibmodel_with_amp_and_offset, CMB_multi_gaussian_with_offset, batched_multi_fibmodel_with_amp, \
+    batched_multi_fibmodel_with_amp_jac, batched_lm_fit, multi_fibmodel_with_amp_jac, multi_fibmodel_with_amp_and_offset_jac, \
+    CMB_multi_gaussian_jac, CMB_multi_gaussian_with_offset_jac, batched_tied_multi_fibmodel, batched_tied_multi_fibmodel_jac, \
+    share_array, attach_shared_array, run_orders_in_parallel
+from veloce_reduction.veloce_reduction.order_tracing import flatten_single_stripe, flatten_single_stripe_from_indices, make_trace_tables, get_order_trace
 
 
 
 
+def get_pseudo_slit_pattern(nfib=24):
+    """
+    Returns the nominal relative positions of the fibres along the pseudo-slit (in units of the fibre pitch, and centred on zero), 
+    in the order of the array indices used for the fibre profiles, ie from red to blue:
+    
+    pseudo-slit layout:   ThXe S5  S2   X   7  18  17   6  16  15   5  14  13   1  12  11   4  10   9   3   8  19   2   X  S4  S3  S1 LFC
+    array indices     :         0   1       2   3   4   5   6   7   8   9  10  11  12  13  14  15  16  17  18  19  20      21  22  23
+    
+    For nfib=24 (19 object fibres plus 5 sky fibres) the two empty slots are taken into account; for any other number of 
+    fibres, equidistant positions are returned.
+    """
+    if nfib == 24:
+        slots = np.r_[0, 1, np.arange(3, 22), 23, 24, 25].astype(float)
+    else:
+        slots = np.arange(nfib).astype(float)
+    return slots - np.mean(slots)
+
+
+
 def get_multiple_fibre_profiles_single_order(sc, sr, err_sc, ordpol, ordmask=None, nfib=24, sampling_size=25, step_size=None,
-                                             varbeta=True, offset=True, return_snr=True, lfc=False, debug_level=0, timit=False):
+                                             varbeta=True, offset=True, return_snr=True, lfc=False, batched=True, tied=False,
+                                             slit_pattern=None, ordpos=None, debug_level=0, timit=False):
     """
     INPUT:
     'sc'             : the flux in the extracted, flattened stripe
@@ -32,6 +55,15 @@ def get_multiple_fibre_profiles_single_order(sc, sr, err_sc, ordpol, ordmask=Non
     'offset'         : boolean - do you want to fit an offset as well?
     'return_snr'     : boolean - do you want to return SNR of the collapsed super-pixel at each location in 'userange'?
     'lfc'            : boolean - is this LFC data? (in which case we only want to use the pixels near a peak to determine the fibre profiles)
+    'batched'        : boolean - if TRUE, the fits for all locations in 'userange' are performed simultaneously (see 
+                       "fit_multiple_fibre_profiles_batched"), rather than one "curve_fit" call per location
+    'tied'           : boolean - if TRUE, all fibres share the same sigma (and beta), and their positions follow a fixed pattern
+                       along the pseudo-slit with a common offset and scale (ie only nfib+4(+1) instead of 4*nfib(+1) free
+                       parameters per location); implies 'batched'
+    'slit_pattern'   : relative positions of the fibres along the pseudo-slit for the tied model (default is the nominal 
+                       pattern from "get_pseudo_slit_pattern"; measured positions, eg from an untied fit, can be used as well)
+    'ordpos'         : the trace centres of that order for all pixel columns (eg from "make_trace_tables"); if not provided,
+                       they are evaluated from 'ordpol'
     'debug_level'    : for debugging...
     'timit'          : boolean - do you want to measure execution run-time?
 
@@ -60,6 +92,10 @@ def get_multiple_fibre_profiles_single_order(sc, sr, err_sc, ordpol, ordmask=Non
     if ordmask is None:
         ordmask = np.ones(npix, dtype='bool')
 
+    # trace centres for all pixel columns
+    if ordpos is None:
+        ordpos = np.polyval(ordpol, xx)
+
     if step_size is None:
         step_size = 2 * sampling_size
     userange = np.arange(np.arange(npix)[ordmask][0] + sampling_size, np.arange(npix)[ordmask][-1], step_size)
@@ -67,7 +103,7 @@ def get_multiple_fibre_profiles_single_order(sc, sr, err_sc, ordpol, ordmask=Non
     userange = userange[np.logical_and(userange > 200, userange < npix - 200)]
     # now we also need to mask out a region of +/- 100 pixels around the "maximum" of the order trace,
     # i.e. where the order has close to zero curvature
-    order_peak_location = np.argwhere(ordpol(xx) == np.max(ordpol(xx)))[0]
+    order_peak_location = np.argwhere(ordpos == np.max(ordpos))[0]
     userange = userange[np.logical_or(userange < order_peak_location - 100, userange > order_peak_location + 100)]
 
     # prepare output dictionary
@@ -82,6 +118,12 @@ def get_multiple_fibre_profiles_single_order(sc, sr, err_sc, ordpol, ordmask=Non
         fibre_profiles_ord['offset'] = []
     if return_snr:
         fibre_profiles_ord['SNR'] = []
+    if tied:
+        batched = True
+        if slit_pattern is None:
+            slit_pattern = get_pseudo_slit_pattern(nfib)
+    # collect the stacked profiles if the fitting is done simultaneously for all columns
+    batch_ix, batch_grid, batch_data, batch_guess, batch_lower, batch_upper = [], [], [], [], [], []
 
     # loop over all columns for one order and do the profile fitting
     for i, pix in enumerate(userange):
@@ -143,13 +185,13 @@ def get_multiple_fibre_profiles_single_order(sc, sr, err_sc, ordpol, ordmask=Non
             normdata = []
             # errors = []
             weights = []
-            refpos = ordpol(pix)
+            refpos = ordpos[pix]
             for j in np.arange(np.max([0, pix - sampling_size]), np.min([npix - 1, pix + sampling_size]) + 1):
                 
                 colcounts = np.sum(sc[:, j])           
                 
                 if (colcounts >= 500) or (not lfc):
-                    grid.append(sr[:, j] - ordpol(j) + refpos)
+                    grid.append(sr[:, j] - ordpos[j] + refpos)
                     # data.append(sc[:,j])
                     normdata.append(sc[:, j] / np.sum(sc[:, j]))
                     # make sure we do not divide by zero by adding 1 plus the min. colcounts across all j's, so that the smallest number we are dividing by is 1
@@ -167,7 +209,7 @@ def get_multiple_fibre_profiles_single_order(sc, sr, err_sc, ordpol, ordmask=Non
                     # weights.append(1./((np.sqrt(sc[:,j] + RON**2)) / sc[:,j])**2)
                     if debug_level >= 3:
                         # plt.plot(sr[:,j] - ordpol(j),sc[:,j],'.')
-                        plt.plot(sr[:, j] - ordpol(j), sc[:, j] / np.sum(sc[:, j]), '.')
+                        plt.plot(sr[:, j] - ordpos[j], sc[:, j] / np.sum(sc[:, j]), '.')
                         # plt.xlim(-5,5)
                         plt.xlim(-sc.shape[0] / 2, sc.shape[0] / 2)
 
@@ -225,19 +267,47 @@ def get_multiple_fibre_profiles_single_order(sc, sr, err_sc, ordpol, ordmask=Non
                 guess = np.array(guess).flatten()
                 lower_bounds = np.array(lower_bounds).flatten()
                 upper_bounds = np.array(upper_bounds).flatten()
+                if tied:
+                    # common offset and scale of the pseudo-slit pattern from a linear fit to the peak positions
+                    scale, pos = np.polyfit(slit_pattern, peaks, 1)
+                    amps = normdata[goodpeaks]
+                    if varbeta:
+                        guess = np.r_[pos, scale, 0.7, 2., amps]
+                        lower_bounds = np.r_[pos - 1, scale - 0.1*np.abs(scale), 0, 1, np.zeros(npeaks)]
+                        upper_bounds = np.r_[pos + 1, scale + 0.1*np.abs(scale), np.inf, 4, np.repeat(np.inf, npeaks)]
+                    else:
+                        guess = np.r_[pos, scale, 1., amps]
+                        lower_bounds = np.r_[pos - 1, scale - 0.1*np.abs(scale), 0, np.zeros(npeaks)]
+                        upper_bounds = np.r_[pos + 1, scale + 0.1*np.abs(scale), np.inf, np.repeat(np.inf, npeaks)]
+                if batched:
+                    # defer the fit until all columns have been stacked
+                    batch_ix.append(i)
+                    batch_grid.append(grid)
+                    batch_data.append(normdata)
+                    if offset:
+                        batch_guess.append(np.r_[guess, 0])
+                        batch_lower.append(np.r_[lower_bounds, 0])
+                        batch_upper.append(np.r_[upper_bounds, np.max(normdata)])
+                        fibre_profiles_ord['offset'].append(-1.)
+                    else:
+                        batch_guess.append(guess)
+                        batch_lower.append(lower_bounds)
+                        batch_upper.append(upper_bounds)
+                    continue
+
                 if offset:
                     if varbeta:
-                        popt, pcov = op.curve_fit(multi_fibmodel_with_amp_and_offset, grid, normdata, p0=np.r_[guess,0],
+                        popt, pcov = op.curve_fit(multi_fibmodel_with_amp_and_offset, grid, normdata, p0=np.r_[guess,0], jac=multi_fibmodel_with_amp_and_offset_jac,
                                                   bounds=(np.r_[lower_bounds,0], np.r_[upper_bounds,np.max(normdata)]), maxfev=100000)
                     else:
-                        popt, pcov = op.curve_fit(CMB_multi_gaussian_with_offset, grid, normdata, p0=np.r_[guess,0],
+                        popt, pcov = op.curve_fit(CMB_multi_gaussian_with_offset, grid, normdata, p0=np.r_[guess,0], jac=CMB_multi_gaussian_with_offset_jac,
                                                   bounds=(np.r_[lower_bounds,0], np.r_[upper_bounds, np.max(normdata)]), maxfev=100000)
                 else:
                     if varbeta:
-                        popt, pcov = op.curve_fit(multi_fibmodel_with_amp, grid, normdata, p0=guess,
+                        popt, pcov = op.curve_fit(multi_fibmodel_with_amp, grid, normdata, p0=guess, jac=multi_fibmodel_with_amp_jac,
                                                   bounds=(lower_bounds, upper_bounds), maxfev=100000)
                     else:
-                        popt, pcov = op.curve_fit(CMB_multi_gaussian, grid, normdata, p0=guess,
+                        popt, pcov = op.curve_fit(CMB_multi_gaussian, grid, normdata, p0=guess, jac=CMB_multi_gaussian_jac,
                                                   bounds=(lower_bounds, upper_bounds), maxfev=100000)
 
 
@@ -272,6 +342,28 @@ def get_multiple_fibre_profiles_single_order(sc, sr, err_sc, ordpol, ordmask=Non
                 #     full_model += CMB_pure_gaussian(grid, *popt)
 
 
+    # now fit all the stacked profiles simultaneously
+    if batched and len(batch_ix) > 0:
+        popts = fit_multiple_fibre_profiles_batched(batch_grid, batch_data, batch_guess, batch_lower, batch_upper, varbeta=varbeta,
+                                                    offset=offset, slit_pattern=slit_pattern if tied else None, debug_level=debug_level)
+        for i, popt in zip(batch_ix, popts):
+            if offset:
+                fibre_profiles_ord['offset'][i] = popt[-1]
+                popt = popt[:-1]
+            if tied:
+                # expand the shared parameters to the per-fibre format
+                namp = 4 if varbeta else 3
+                popt_arr = np.c_[popt[0] + popt[1] * slit_pattern, np.repeat(popt[2], nfib), popt[namp:]]
+                if varbeta:
+                    popt_arr = np.c_[popt_arr, np.repeat(popt[3], nfib)]
+            else:
+                popt_arr = np.reshape(popt, (nfib, -1))
+            fibre_profiles_ord['mu'][i, :] = popt_arr[:, 0]
+            fibre_profiles_ord['sigma'][i, :] = popt_arr[:, 1]
+            fibre_profiles_ord['amp'][i, :] = popt_arr[:, 2]
+            if varbeta:
+                fibre_profiles_ord['beta'][i, :] = popt_arr[:, 3]
+
     if timit:
         print('Elapsed time for retrieving relative intensities: ' + np.round(time.time() - start_time, 2).astype(str) + ' seconds...')
 
@@ -279,8 +371,74 @@ def get_multiple_fibre_profiles_single_order(sc, sr, err_sc, ordpol, ordmask=Non
 
 
 
+def fit_multiple_fibre_profiles_batched(grids, data, guesses, lower_bounds, upper_bounds, varbeta=True, offset=True, slit_pattern=None,
+                                        maxiter=200, debug_level=0, timit=False):
+    """
+    Fit the multi-fibre model to the stacked profiles of many pixel columns simultaneously, using the batched Levenberg-Marquardt
+    solver "batched_lm_fit" (with analytic Jacobians). The stacked profiles can have different lengths; they are padded with zero-weight points.
+    As with "curve_fit" in "get_multiple_fibre_profiles_single_order", all (real) data points have equal weights.
+
+    INPUT:
+    'grids'          : list of the (stacked) grids, one for each pixel column
+    'data'           : list of the (stacked) normalized data, one for each pixel column
+    'guesses'        : list of initial guesses for the parameters (in the format of "multi_fibmodel_with_amp(_and_offset)"
+                       or "CMB_multi_gaussian(_with_offset)", or of "batched_tied_multi_fibmodel" if 'slit_pattern' is provided)
+    'lower_bounds'   : list of the lower bounds for the parameters
+    'upper_bounds'   : list of the upper bounds for the parameters
+    'varbeta'        : boolean - if set to TRUE, use Gauss-like function for fitting, if set to FALSE use plain Gaussian
+    'offset'         : boolean - do you want to fit an offset as well?
+    'slit_pattern'   : if provided, the tied model is used, ie all fibres share the same sigma (and beta), and their positions 
+                       are given by pos + scale * slit_pattern
+    'maxiter'        : maximum number of Levenberg-Marquardt iterations
+    'debug_level'    : for debugging...
+    'timit'          : boolean - do you want to measure execution run-time?
+
+    OUTPUT:
+    'popt'           : the best-fit parameters (nbatch, npar)
+    """
+
+    if timit:
+        start_time = time.time()
+
+    nbatch = len(grids)
+    maxlen = np.max([len(g) for g in grids])
+    x = np.zeros((nbatch, maxlen))
+    y = np.zeros((nbatch, maxlen))
+    w = np.zeros((nbatch, maxlen))
+    for b in range(nbatch):
+        x[b, :len(grids[b])] = grids[b]
+        y[b, :len(data[b])] = data[b]
+        w[b, :len(data[b])] = 1.
+
+    # keep the widths strictly positive (a lower bound of zero is fine for curve_fit's interior-point method, but the projected
+    # steps of "batched_lm_fit" can land exactly on the bound)
+    lower_bounds = np.array(lower_bounds, dtype='float64')
+    sigma_ix = [2] if slit_pattern is not None else np.arange(1, lower_bounds.shape[1] - int(offset), 4 if varbeta else 3)
+    lower_bounds[:, sigma_ix] = np.maximum(lower_bounds[:, sigma_ix], 1e-3)
+
+    if slit_pattern is None:
+        def model(xx, pp):
+            return batched_multi_fibmodel_with_amp(xx, pp, varbeta=varbeta, offset=offset)
+        def jac(xx, pp):
+            return batched_multi_fibmodel_with_amp_jac(xx, pp, varbeta=varbeta, offset=offset)
+    else:
+        def model(xx, pp):
+            return batched_tied_multi_fibmodel(xx, pp, slit_pattern, varbeta=varbeta, offset=offset)
+        def jac(xx, pp):
+            return batched_tied_multi_fibmodel_jac(xx, pp, slit_pattern, varbeta=varbeta, offset=offset)
+
+    popt = batched_lm_fit(model, x, y, np.array(guesses), weights=w, jac=jac, lower=lower_bounds, upper=np.array(upper_bounds),
+                          maxiter=maxiter, debug_level=debug_level)
+
+    if timit:
+        print('Elapsed time for batched multi-fibre fits: ' + np.round(time.time() - start_time, 2).astype(str) + ' seconds...')
+
+    return popt
+
+
+
 def fit_multiple_profiles(P_id, stripes, err_stripes, mask=None, slit_height=25, nfib=24, varbeta=True, offset=True,
-                          debug_level=0, timit=False):
+                          tied=False, slit_pattern=None, nthreads=1, use_processes=True, trace_tables=None, debug_level=0, timit=False):
     """
     This routine determines the profiles of the fibres in spatial direction. This is an extremely crucial step, as the
     pre-defined profiles are then used during the optimal extraction, as well as during the determination of the
@@ -295,6 +453,12 @@ def fit_multiple_profiles(P_id, stripes, err_stripes, mask=None, slit_height=25,
     'nfib'          : number of fibres
     'varbeta'       : boolean - if set to TRUE, use Gauss-like function for fitting, if set to FALSE use plain Gaussian
     'offset'        : boolean - do you want to fit an offset as well?
+    'tied'          : boolean - if TRUE, all fibres share the same sigma (and beta), and their positions follow a fixed pattern along
+                      the pseudo-slit with a common offset and scale (see "get_multiple_fibre_profiles_single_order")
+    'slit_pattern'  : relative positions of the fibres along the pseudo-slit for the tied model (default from "get_pseudo_slit_pattern")
+    'nthreads'      : number of orders to process in parallel (default is 1, ie one order after the other)
+    'use_processes' : boolean - use a pool of processes rather than a pool of threads (only if 'nthreads' > 1)
+    'trace_tables'  : the trace centres for all orders and pixel columns from "make_trace_tables" (they are created here if not provided)
     'debug_level'   : for debugging...
     'timit'         : boolean - do you want to measure execution run-time?
 
@@ -317,35 +481,26 @@ def fit_multiple_profiles(P_id, stripes, err_stripes, mask=None, slit_height=25,
         #we also only want to use the central TRUE parts of the masks, ie want ONE consecutive stretch per order
         cenmask = central_parts_of_mask(mask)
 
-    # loop over all orders
-    #for ord in sorted(P_id.iterkeys()):
-    for ord in sorted(P_id.keys()):
-        print('OK, now processing ' + str(ord))
-
-        ordpol = P_id[ord]
-
-        # define stripe
-        stripe = stripes[ord]
-        err_stripe = err_stripes[ord]
-        # find the "order-box"
-        sc, sr = flatten_single_stripe(stripe, slit_height=slit_height, timit=False)
-        err_sc, err_sr = flatten_single_stripe(err_stripe, slit_height=slit_height, timit=False)
+    kwargs = {'slit_height':slit_height, 'nfib':nfib, 'sampling_size':25, 'varbeta':varbeta, 'offset':offset, 'tied':tied,
+              'slit_pattern':slit_pattern, 'debug_level':debug_level}
 
-        if mask is None:
-            cenmask[ord] = np.ones(sc.shape[1], dtype='bool')
+    # evaluate the order traces only once for all orders and pixel columns
+    if trace_tables is None:
+        trace_tables = make_trace_tables(P_id, nx=stripes[sorted(P_id.keys())[0]].shape[1])
 
-        # fit profile for single order and save result in "global" parameter dictionary for entire chip
-        fpo = get_multiple_fibre_profiles_single_order(sc, sr, err_sc, ordpol, ordmask=cenmask[ord], nfib=nfib,
-                                                       sampling_size=25, varbeta=varbeta, offset=offset,
-                                                       return_snr=True, debug_level=debug_level, timit=timit)
-
-        # if stacking:
-        #     colfits = determine_spatial_profiles_single_order(sc, sr, err_sc, ordpol, ordmask=mask[ord], model=model,
-        #                                                       return_stats=return_stats, timit=timit)
-        # else:
-        #     colfits = fit_profiles_single_order(sr, sc, ordpol, osf=1, silent=True, timit=timit)
-
-        fibre_profiles[ord] = fpo
+    if nthreads > 1:
+        # every order only needs its own stripes, so no need for shared memory here
+        args = {ord: (P_id[ord], stripes[ord], err_stripes[ord], None, cenmask.get(ord), get_order_trace(trace_tables, ord))
+                for ord in P_id.keys()}
+        fibre_profiles = run_orders_in_parallel(get_multiple_fibre_profiles_worker, args, kwargs=kwargs, nthreads=nthreads,
+                                                use_processes=use_processes)
+    else:
+        # loop over all orders
+        for ord in sorted(P_id.keys()):
+            print('OK, now processing ' + str(ord))
+            # fit profile for single order and save result in "global" parameter dictionary for entire chip
+            fibre_profiles[ord] = get_multiple_fibre_profiles_worker(P_id[ord], stripes[ord], err_stripes[ord], None, cenmask.get(ord),
+                                                                     get_order_trace(trace_tables, ord), timit=timit, **kwargs)
 
     if timit:
         print('Time elapsed: ' + str(int(time.time() - start_time)) + ' seconds...')
@@ -355,7 +510,8 @@ def fit_multiple_profiles(P_id, stripes, err_stripes, mask=None, slit_height=25,
 
 
 def fit_multiple_profiles_from_indices(P_id, img, err_img, stripe_indices, mask=None, slit_height=30, nfib=24, lfc=False,
-                                       sampling_size=25, step_size=None, varbeta=True, offset=True, debug_level=0, timit=False):
+                                       sampling_size=25, step_size=None, varbeta=True, offset=True, tied=False, slit_pattern=None,
+                                       nthreads=1, use_processes=True, trace_tables=None, debug_level=0, timit=False):
     """
     This routine determines the profiles of the fibres in spatial direction. This is an extremely crucial step, as the
     pre-defined profiles are then used during the optimal extraction, as well as during the determination of the
@@ -376,6 +532,12 @@ def fit_multiple_profiles_from_indices(P_id, img, err_img, stripe_indices, mask=
     'step_size'     : only calculate the relative intensities every so and so many pixels (should not change, plus it takes ages...)
     'varbeta'       : boolean - if set to TRUE, use Gauss-like function for fitting, if set to FALSE use plain Gaussian
     'offset'        : boolean - do you want to fit an offset as well?
+    'tied'          : boolean - if TRUE, all fibres share the same sigma (and beta), and their positions follow a fixed pattern along
+                      the pseudo-slit with a common offset and scale (see "get_multiple_fibre_profiles_single_order")
+    'slit_pattern'  : relative positions of the fibres along the pseudo-slit for the tied model (default from "get_pseudo_slit_pattern")
+    'nthreads'      : number of orders to process in parallel (default is 1, ie one order after the other)
+    'use_processes' : boolean - use a pool of processes rather than a pool of threads (only if 'nthreads' > 1)
+    'trace_tables'  : the trace centres for all orders and pixel columns from "make_trace_tables" (they are created here if not provided)
     'debug_level'   : for debugging...
     'timit'         : boolean - do you want to measure execution run time?
 
@@ -398,38 +560,89 @@ def fit_multiple_profiles_from_indices(P_id, img, err_img, stripe_indices, mask=
         # we also only want to use the central TRUE parts of the masks, ie want ONE consecutive stretch per order
         cenmask = central_parts_of_mask(mask)
 
-    # loop over all orders
-    for ord in sorted(P_id.iterkeys()):
-        print('OK, now processing ' + str(ord))
+    kwargs = {'slit_height':slit_height, 'nfib':nfib, 'lfc':lfc, 'sampling_size':sampling_size, 'step_size':step_size,
+              'varbeta':varbeta, 'offset':offset, 'tied':tied, 'slit_pattern':slit_pattern, 'debug_level':debug_level}
 
-        ordpol = P_id[ord]
+    # evaluate the order traces only once for all orders and pixel columns
+    if trace_tables is None:
+        trace_tables = make_trace_tables(P_id, nx=img.shape[1])
 
-        # define stripe
-        indices = stripe_indices[ord]
-        # find the "order-box"
-        sc, sr = flatten_single_stripe_from_indices(img, indices, slit_height=slit_height, timit=False)
-        err_sc, err_sr = flatten_single_stripe_from_indices(err_img, indices, slit_height=slit_height, timit=False)
+    if nthreads > 1:
+        # place the images in shared memory, so that they are not copied to every worker process
+        if use_processes:
+            img_shm, img_ref = share_array(img)
+            err_shm, err_ref = share_array(err_img)
+        else:
+            img_ref, err_ref = img, err_img
+        try:
+            args = {ord: (P_id[ord], img_ref, err_ref, stripe_indices[ord], cenmask.get(ord), get_order_trace(trace_tables, ord))
+                    for ord in P_id.keys()}
+            fibre_profiles = run_orders_in_parallel(get_multiple_fibre_profiles_worker, args, kwargs=kwargs, nthreads=nthreads,
+                                                    use_processes=use_processes)
+        finally:
+            if use_processes:
+                for shm in (img_shm, err_shm):
+                    shm.close()
+                    shm.unlink()
+    else:
+        # loop over all orders
+        for ord in sorted(P_id.keys()):
+            print('OK, now processing ' + str(ord))
+            # fit profile for single order and save result in "global" parameter dictionary for entire chip
+            fibre_profiles[ord] = get_multiple_fibre_profiles_worker(P_id[ord], img, err_img, stripe_indices[ord], cenmask.get(ord),
+                                                                     get_order_trace(trace_tables, ord), timit=timit, **kwargs)
 
-        if mask is None:
-            cenmask[ord] = np.ones(sc.shape[1], dtype='bool')
+    if timit:
+        print('Time elapsed: ' + str(int(time.time() - start_time)) + ' seconds...')
 
-        # fit profile for single order and save result in "global" parameter dictionary for entire chip
-        fpo = get_multiple_fibre_profiles_single_order(sc, sr, err_sc, ordpol, ordmask=cenmask[ord], nfib=nfib, lfc=lfc,
-                                                       sampling_size=sampling_size, step_size=step_size, varbeta=varbeta, offset=offset,
-                                                       return_snr=True, debug_level=debug_level, timit=timit)
+    return fibre_profiles
 
-        # if stacking:
-        #     colfits = determine_spatial_profiles_single_order(sc, sr, err_sc, ordpol, ordmask=mask[ord], model=model,
-        #                                                       return_stats=return_stats, timit=timit)
-        # else:
-        #     colfits = fit_profiles_single_order(sr, sc, ordpol, osf=1, silent=True, timit=timit)
 
-        fibre_profiles[ord] = fpo
 
-    if timit:
-        print('Time elapsed: ' + str(int(time.time() - start_time)) + ' seconds...')
+def get_multiple_fibre_profiles_worker(ordpol, img, err_img, indices=None, ordmask=None, ordpos=None, slit_height=30, timit=False, **kwargs):
+    """
+    Determines the multi-fibre profiles for a single order. This is the unit of work of "fit_multiple_profiles(_from_indices)", both
+    for the serial and the order-parallel processing.
 
-    return fibre_profiles
+    INPUT:
+    'ordpol'        : set of polynomial coefficients from P_id for that order (ie p = P_id[ord])
+    'img'           : either the stripe (if 'indices' is None) or the 2-dim input image, or a reference to the image in shared memory
+                      (see "share_array")
+    'err_img'       : ditto for the errors
+    'indices'       : the stripe-indices for that order (if None, 'img' and 'err_img' are the stripes)
+    'ordmask'       : the (central part of the) mask for that order (default is to use all pixel columns)
+    'ordpos'        : the trace centres of that order for all pixel columns (eg from "make_trace_tables")
+    'slit_height'   : height of the extraction slit (ie the pixel columns are 2*slit_height pixels long)
+    'timit'         : boolean - do you want to measure execution run time?
+    (all other keywords are passed on to "get_multiple_fibre_profiles_single_order")
+
+    OUTPUT:
+    'fpo'           : the fibre profiles for that order (as returned by "get_multiple_fibre_profiles_single_order")
+    """
+
+    img_shm, img = attach_shared_array(img)
+    err_shm, err_img = attach_shared_array(err_img)
+
+    # find the "order-box"
+    if indices is None:
+        sc, sr = flatten_single_stripe(img, slit_height=slit_height, timit=False)
+        err_sc, err_sr = flatten_single_stripe(err_img, slit_height=slit_height, timit=False)
+    else:
+        sc, sr = flatten_single_stripe_from_indices(img, indices, slit_height=slit_height, timit=False)
+        err_sc, err_sr = flatten_single_stripe_from_indices(err_img, indices, slit_height=slit_height, timit=False)
+
+    # release the shared memory (the cutouts are copies)
+    del img, err_img
+    for shm in (img_shm, err_shm):
+        if shm is not None:
+            shm.close()
+
+    if ordmask is None:
+        ordmask = np.ones(sc.shape[1], dtype='bool')
+
+    fpo = get_multiple_fibre_profiles_single_order(sc, sr, err_sc, ordpol, ordmask=ordmask, return_snr=True, ordpos=ordpos, timit=timit, **kwargs)
+
+    return fpo
 
 
 
@@ -6,6 +6,7 @@ Created on 14 Jun. 2018
 
 import matplotlib.pyplot as plt
 import time
+import hashlib
 import numpy as np
 import astropy.io.fits as pyfits
 import scipy.optimize as op
@@ -17,14 +18,21 @@ import scipy.optimize as op
 # from lmfit.minimizer import *
 
 from veloce_reduction.veloce_reduction.linalg import linalg_extract_column
-from veloce_reduction.veloce_reduction.helper_functions import make_norm_profiles_2, central_parts_of_mask, CMB_pure_gaussian
-from veloce_reduction.veloce_reduction.order_tracing import flatten_single_stripe, flatten_single_stripe_from_indices
+from veloce_reduction.veloce_reduction.helper_functions import make_norm_profiles_2, central_parts_of_mask, CMB_pure_gaussian, fibmodel, \
+    batched_lm_fit, batched_gaussian, batched_gaussian_jac, weighted_median_rows
+from veloce_reduction.veloce_reduction.order_tracing import flatten_single_stripe, flatten_single_stripe_from_indices, make_trace_tables, get_order_trace
 from veloce_reduction.veloce_reduction.wavelength_solution import find_suitable_peaks
+from veloce_reduction.veloce_reduction.get_profile_parameters import get_order_fibparms, fibparms_arrays_to_dict
 
 
+# in-process cache of the profile cubes used in "get_relints_normal_equations", ie one dictionary (keys = hashes) per night (keys = dates)
+PROFILE_CACHE = {}
 
 
-def get_relints_single_order(sc, sr, err_sc, ordpol, fppo, ordmask=None, nfib=19, sampling_size=25, step_size=None, return_full=False, return_snr=True, debug_level=0, timit=False):
+
+
+def get_relints_single_order(sc, sr, err_sc, ordpol, fppo, ordmask=None, nfib=19, sampling_size=25, step_size=None, return_full=False, return_snr=True, 
+                             ordpos=None, debug_level=0, timit=False):
     """
     INPUT:
     'sc'             : the flux in the extracted, flattened stripe
@@ -41,6 +49,8 @@ def get_relints_single_order(sc, sr, err_sc, ordpol, fppo, ordmask=None, nfib=19
     'step_size'      : only calculate the relative intensities every so and so many pixels (should not change, plus it takes ages...)
     'return_full'    : boolean - do you want to also return the full model (if FALSE, then only the relative intensities are returned)
     'return_snr'     : boolean - do you want to return the SNR of the collapsed super-pixel at each location in 'userange'?
+    'ordpos'         : the trace centres of that order for all pixel columns (eg from "make_trace_tables"); if not provided, 
+                       they are evaluated from 'ordpol'
     'debug_level'    : for debugging...
     
     OUTPUT:
@@ -67,6 +77,10 @@ def get_relints_single_order(sc, sr, err_sc, ordpol, fppo, ordmask=None, nfib=19
     if ordmask is None:
         ordmask = np.ones(npix, dtype='bool')
     
+    # trace centres for all pixel columns
+    if ordpos is None:
+        ordpos = np.polyval(ordpol, np.arange(npix))
+    
     if step_size is None:
         step_size = 2 * sampling_size
     userange = np.arange(np.arange(npix)[ordmask][0]+sampling_size, np.arange(npix)[ordmask][-1], step_size)
@@ -115,9 +129,9 @@ def get_relints_single_order(sc, sr, err_sc, ordpol, fppo, ordmask=None, nfib=19
             normdata = []
             #errors = []
             weights = []
-            refpos = ordpol(pix)
+            refpos = ordpos[pix]
             for j in np.arange(np.max([0,pix-sampling_size]),np.min([npix-1,pix+sampling_size])+1):
-                grid.append(sr[:,j] - ordpol(j) + refpos)
+                grid.append(sr[:,j] - ordpos[j] + refpos)
                 #data.append(sc[:,j])
                 normdata.append(sc[:,j] / np.sum(sc[:,j]))
                 # assign weights for flux (and take care of NaNs and INFs)
@@ -134,14 +148,14 @@ def get_relints_single_order(sc, sr, err_sc, ordpol, fppo, ordmask=None, nfib=19
                 #weights.append(1./((np.sqrt(sc[:,j] + RON**2)) / sc[:,j])**2)    
                 if debug_level >= 2:
                     #plt.plot(sr[:,j] - ordpol(j),sc[:,j],'.')
-                    plt.plot(sr[:,j] - ordpol(j),sc[:,j]/np.sum(sc[:,j]),'.')
+                    plt.plot(sr[:,j] - ordpos[j],sc[:,j]/np.sum(sc[:,j]),'.')
                     #plt.xlim(-5,5)
                     plt.xlim(-sc.shape[0]/2,sc.shape[0]/2)
                 
             # data = np.array(data)
-            normdata = np.array(normdata)
-            weights = np.array(weights)
-            grid = np.array(grid)
+            normdata = np.array(normdata).flatten()
+            weights = np.array(weights).flatten()
+            grid = np.array(grid).flatten()
             # data = data[grid.argsort()]
             normdata = normdata[grid.argsort()]
             weights = weights[grid.argsort()]
@@ -164,7 +178,7 @@ def get_relints_single_order(sc, sr, err_sc, ordpol, fppo, ordmask=None, nfib=19
             v = v[5:24]
             #that's the model if we need it (the combined model is "np.sum(fmodel,axis=1)" )
             if return_full:
-                fmodel = f * phi
+                fmodel = f * phi[:,5:24]
                 #full_model[i,:] = np.sum(fmodel,axis=1)
                 full_model.append(np.sum(fmodel,axis=1))
                 modgrid.append(grid)
@@ -191,6 +205,267 @@ def get_relints_single_order(sc, sr, err_sc, ordpol, fppo, ordmask=None, nfib=19
 
 
 
+def get_fppo_parameters(fppo, cols):
+    """
+    Returns the fibre profile parameters (mu, sigma, beta) of all fibres of one order at the pixel columns 'cols', for all the
+    flavours of "fppo" (fibre profiles given as polynomials, as arrays, or as the compact array-based format from "get_order_fibparms").
+    The fibres are in the same (sorted) order as in "make_norm_profiles_2". The output arrays have shape (n_fib, len(cols)).
+    """
+    if 'mu_fit' in fppo:
+        # compact array-based format, ie (n_fib, nx) arrays
+        return [np.asarray(fppo[par])[:,cols] for par in ('mu_fit', 'sigma_fit', 'beta_fit')]
+    pars = []
+    for par in ('mu_fit', 'sigma_fit', 'beta_fit'):
+        vals = []
+        for fib in sorted(fppo.keys()):
+            p = fppo[fib][par]
+            vals.append(p(cols) if callable(p) else np.asarray(p)[cols])
+        pars.append(np.array(vals, dtype='f8'))
+    return pars
+
+
+
+def stack_sampling_windows(sc, sr, err_sc, ordpos, pixs, sampling_size=25):
+    """
+    Stacks the cutouts of the (2*sampling_size+1) pixel columns around each of the sampling locations 'pixs' of the rectified order 
+    (ie the flattened stripe) onto a common grid relative to the trace at that location, in one fancy-indexing step. The cutouts 
+    are normalized to unit flux, and their weights are calculated from the relative errors, exactly as in "get_relints_single_order". 
+    The stacked grid of every location is sorted. Windows that are truncated at the edges of the chip are padded (with zero weights).
+    
+    INPUT:
+    'sc'             : the flux in the extracted, flattened stripe
+    'sr'             : row-indices (ie in spatial direction) of the cutouts in 'sc'
+    'err_sc'         : the error in the extracted, flattened stripe
+    'ordpos'         : the trace centres of that order for all pixel columns (eg from "make_trace_tables")
+    'pixs'           : the pixel columns of the sampling locations
+    'sampling_size'  : how many pixels (in dispersion direction) either side of each location do you want to consider?
+    
+    OUTPUT:
+    'grid'      : the stacked (and sorted) grid (n_loc, (2*sampling_size+1)*nrows)
+    'normdata'  : the normalized cutouts on that grid
+    'weights'   : the corresponding weights
+    'valid'     : boolean array - which grid points are real (ie not padding)
+    """
+    
+    nrows, npix = sc.shape
+    colsum = np.sum(sc, axis=0)
+    
+    # pixel columns of all sampling windows (the windows are truncated at the edges of the chip, as in "get_relints_single_order")
+    cols = pixs[:,np.newaxis] + np.arange(-sampling_size, sampling_size+1)
+    valid = np.logical_and(cols >= 0, cols <= npix-1)
+    cols = np.clip(cols, 0, npix-1)
+    
+    # stack the cutouts, ie arrays of shape (n_loc, (2*sampling_size+1)*nrows)
+    grid = (sr[:,cols] - ordpos[cols] + ordpos[pixs][:,np.newaxis]).transpose(1,2,0).reshape(len(pixs), cols.shape[1]*nrows)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        normdata = (sc[:,cols] / colsum[cols]).transpose(1,2,0).reshape(len(pixs), cols.shape[1]*nrows)
+        normerr = ((err_sc[:,cols] / sc[:,cols]) / colsum[cols]).transpose(1,2,0).reshape(len(pixs), cols.shape[1]*nrows)
+        weights = 1. / (normerr * normerr)
+    weights[np.isinf(weights)] = 0.
+    valid = np.repeat(valid, nrows, axis=1)
+    weights[~valid] = 0.
+    normdata[~valid] = 0.
+    
+    # sort the grid
+    ix = np.argsort(grid, axis=1)
+    grid = np.take_along_axis(grid, ix, axis=1)
+    normdata = np.take_along_axis(normdata, ix, axis=1)
+    weights = np.take_along_axis(weights, ix, axis=1)
+    valid = np.take_along_axis(valid, ix, axis=1)
+    
+    return grid, normdata, weights, valid
+
+
+
+def get_relints_normal_equations(sc, sr, err_sc, fppo, ordpos, ordmask=None, sampling_size=25, step_size=None, profile_cache=None,
+                                 return_full=False):
+    """
+    Sets up the linear least-squares problems of "get_relints_single_order" for all sampling locations of one order at once. The
+    (2*sampling_size+1) pixel columns around every location are taken from the rectified order (ie the flattened stripe) in one
+    fancy-indexing step, and the normalized fibre profiles of all fibres at all locations are evaluated in one broadcast call
+    (the "profile cube"). Windows that are truncated at the edges of the chip are padded with zero weights.
+
+    INPUT:
+    'sc'             : the flux in the extracted, flattened stripe
+    'sr'             : row-indices (ie in spatial direction) of the cutouts in 'sc'
+    'err_sc'         : the error in the extracted, flattened stripe
+    'fppo'           : Fibre Profile Parameters by Order (see "get_fppo_parameters")
+    'ordpos'         : the trace centres of that order for all pixel columns (eg from "make_trace_tables")
+    'ordmask'        : gives user the option to provide a mask (eg from "find_stripes")
+    'sampling_size'  : how many pixels (in dispersion direction) either side of current i-th pixel do you want to consider?
+    'step_size'      : only calculate the relative intensities every so and so many pixels (default is 2*sampling_size)
+    'profile_cache'  : dictionary for re-using the profile cubes (eg for all flats of one night); the cubes only depend on the
+                       trace, the stripe geometry, and the fibre profile parameters, and are stored under a hash of those
+                       (NOTE: one cube takes about 60 MB for a full-size Veloce order; see "get_profile_cache" for a per-night cache)
+    'return_full'    : boolean - do you want to also return the profile cube and the sampling grid?
+
+    OUTPUT:
+    'neq'  : dictionary containing:
+             'userange' : the pixel columns of the sampling locations
+             'good'     : boolean array - which locations are not masked and fully on the chip
+             'snr'      : SNR of the collapsed super-pixel at each location
+             'C', 'b'   : the stacked normal equations (C * eta = b) for the good locations, with shapes (n_good, n_fib, n_fib) and (n_good, n_fib)
+             'phi', 'grid', 'valid' : the profile cube, the sampling grid, and which grid points are real (only if 'return_full' is TRUE)
+    """
+
+    nrows, npix = sc.shape
+
+    if ordmask is None:
+        ordmask = np.ones(npix, dtype='bool')
+    if step_size is None:
+        step_size = 2 * sampling_size
+    userange = np.arange(np.arange(npix)[ordmask][0]+sampling_size, np.arange(npix)[ordmask][-1], step_size)
+
+    colsum = np.sum(sc, axis=0)
+    snr = colsum[userange] / np.sqrt(np.sum(err_sc[:,userange]**2, axis=0))
+
+    # check if the cutouts fall fully onto CCD (exclude the first row number, as that can legitimately be zero)
+    # NOTE: This also covers row numbers > ny, as in these cases 'sr' is set to zero in "flatten_single_stripe(_from_indices)"
+    onchip = np.all(sr[1:,userange] != 0, axis=0)
+    for pix in userange[np.logical_and(ordmask[userange], ~onchip)]:
+        if np.sum(sr[:,pix]) == 0:
+            print('WARNING: the entire cutout lies outside the chip!!!')
+        else:
+            print('WARNING: parts of the cutout lie outside the chip!!!')
+    good = np.logical_and(ordmask[userange], onchip)
+    pixs = userange[good]
+
+    # stack the cutouts (sorting the grid does not change the solution, but the full model is then on a monotonic grid as in "get_relints_single_order")
+    grid, normdata, weights, valid = stack_sampling_windows(sc, sr, err_sc, ordpos, pixs, sampling_size=sampling_size)
+
+    # the profile cube, ie the normalized fibre profiles of all fibres at all grid points, shape (n_good, n_points, n_fib)
+    mus, sigmas, betas = get_fppo_parameters(fppo, pixs)
+    phi = None
+    if profile_cache is not None:
+        key = hashlib.sha1(b''.join([np.ascontiguousarray(a).tobytes() for a in (grid, valid, mus, sigmas, betas)])).hexdigest()
+        phi = profile_cache.get(key)
+    if phi is None:
+        phi = fibmodel(grid[:,:,np.newaxis], mus.T[:,np.newaxis,:], sigmas.T[:,np.newaxis,:], beta=betas.T[:,np.newaxis,:])
+        phi[~valid] = 0.
+        phi /= np.sum(phi, axis=1)[:,np.newaxis,:]
+        if profile_cache is not None:
+            profile_cache[key] = phi
+
+    # normal equations of the weighted linear least-squares problems (same as in "linalg_extract_column")
+    wphi = weights[:,:,np.newaxis] * phi
+    C = np.matmul(np.transpose(phi, (0,2,1)), wphi)
+    b = np.matmul(np.transpose(wphi, (0,2,1)), normdata[:,:,np.newaxis])[:,:,0]
+
+    neq = {'userange':userange, 'good':good, 'snr':snr, 'C':C, 'b':b}
+    if return_full:
+        neq['phi'] = phi
+        neq['grid'] = grid
+        neq['valid'] = valid
+
+    return neq
+
+
+
+def get_profile_cache(date, maxnights=1):
+    """
+    Returns the dictionary (from the in-process cache) in which the profile cubes of one night are stored, for use as the 'profile_cache' 
+    in "get_relints_normal_equations". The profile cubes of a full night take up a lot of memory (about 60 MB per order), so only the
+    'maxnights' most recently added nights are kept, ie the cubes of the oldest nights are evicted when a new night is added.
+    """
+    if date not in PROFILE_CACHE:
+        while len(PROFILE_CACHE) >= max(maxnights, 1):
+            del PROFILE_CACHE[next(iter(PROFILE_CACHE))]
+        PROFILE_CACHE[date] = {}
+    return PROFILE_CACHE[date]
+
+
+
+def clear_profile_cache(date=None):
+    """
+    Removes the profile cubes of one night (or of all nights if 'date' is not provided) from the in-process cache.
+    """
+    if date is None:
+        PROFILE_CACHE.clear()
+    else:
+        PROFILE_CACHE.pop(date, None)
+    return
+
+
+
+def solve_relints_normal_equations(C, b):
+    """
+    Solves the stacked normal equations C * eta = b (shapes (n, n_fib, n_fib) and (n, n_fib)) for the fibre amplitudes 'eta'
+    in one go. If any of the systems is singular, the pseudo-inverse is used instead.
+    """
+    if len(b) == 0:
+        return np.zeros(b.shape)
+    try:
+        eta = np.linalg.solve(C, b[:,:,np.newaxis])[:,:,0]
+    except np.linalg.LinAlgError:
+        eta = np.matmul(np.linalg.pinv(C), b[:,:,np.newaxis])[:,:,0]
+    return eta
+
+
+
+def get_relints_single_order_batched(sc, sr, err_sc, ordpol, fppo, ordmask=None, nfib=19, sampling_size=25, step_size=None, return_full=False,
+                                     return_snr=True, ordpos=None, profile_cache=None, debug_level=0, timit=False):
+    """
+    Same as "get_relints_single_order", but the linear least-squares problems for all sampling locations of the order are set up
+    (see "get_relints_normal_equations") and solved simultaneously, rather than one location at a time. Inputs and outputs are
+    the same as for "get_relints_single_order", plus:
+
+    'profile_cache'  : dictionary for re-using the profile cubes (see "get_relints_normal_equations")
+    """
+
+    if timit:
+        start_time = time.time()
+    if debug_level >= 1:
+        print('Fitting relative intensities for one order (batched)...')
+
+    if ordpos is None:
+        ordpos = np.polyval(ordpol, np.arange(sc.shape[1]))
+
+    neq = get_relints_normal_equations(sc, sr, err_sc, fppo, ordpos, ordmask=ordmask, sampling_size=sampling_size, step_size=step_size,
+                                       profile_cache=profile_cache, return_full=return_full)
+    eta = solve_relints_normal_equations(neq['C'], neq['b'])
+
+    output = fill_relints_from_eta(neq, eta, nfib=nfib, return_full=return_full)
+
+    if timit:
+        print('Elapsed time for retrieving relative intensities: '+np.round(time.time() - start_time,2).astype(str)+' seconds...')
+
+    if return_full:
+        relints,relints_norm,full_model,modgrid = output
+        if return_snr:
+            return relints,relints_norm,full_model,modgrid,list(neq['snr'])
+        else:
+            return relints,relints_norm,full_model,modgrid
+    else:
+        relints,relints_norm = output
+        if return_snr:
+            return relints,relints_norm,list(neq['snr'])
+        else:
+            return relints,relints_norm
+
+
+
+def fill_relints_from_eta(neq, eta, nfib=19, return_full=False):
+    """
+    Fills the output arrays of "get_relints_single_order(_batched)" from the solutions 'eta' of the normal equations 'neq'
+    (from "get_relints_normal_equations") of one order. Only the 19 stellar fibres are kept (ie fibres 5-23 of all 28 fibres).
+    """
+    relints = np.zeros((len(neq['userange']),nfib))
+    relints_norm = np.zeros((len(neq['userange']),nfib))
+    f = eta[:,5:24]
+    relints[neq['good'],:] = f
+    relints_norm[neq['good'],:] = f / np.sum(f, axis=1)[:,np.newaxis]
+
+    if return_full:
+        # the combined model of the stellar fibres at every good location, evaluated on the (real points of the) sampling grid
+        fmodel = np.matmul(neq['phi'][:,:,5:24], f[:,:,np.newaxis])[:,:,0]
+        full_model = [fmodel[i][neq['valid'][i]] for i in range(len(eta))]
+        modgrid = [neq['grid'][i][neq['valid'][i]] for i in range(len(eta))]
+        return relints,relints_norm,full_model,modgrid
+    else:
+        return relints,relints_norm
+
+
+
 
 
 def old_get_relints_single_order(sc, sr, ordpol, fppo, ordmask=None, nfib=19, slit_height=25, sampling_size=25, step_size=None, RON=0., gain=1., return_full=False, return_snr=True, debug_level=0, timit=False):
@@ -358,7 +633,8 @@ def old_get_relints_single_order(sc, sr, ordpol, fppo, ordmask=None, nfib=19, sl
 
 
 
-def get_relints(P_id, stripes, err_stripes, mask=None, sampling_size=25, slit_height=32, return_full=False, simu=False, debug_level=0, timit=False):
+def get_relints(P_id, stripes, err_stripes, mask=None, pathdict=None, sampling_size=25, slit_height=32, return_full=False, simu=False, trace_tables=None, 
+                fibparms=None, batched=True, profile_cache=None, date=None, debug_level=0, timit=False):
     """
     This routine computes the relative intensities in the individual fibres of a Veloce spectrum.
     
@@ -373,6 +649,13 @@ def get_relints(P_id, stripes, err_stripes, mask=None, sampling_size=25, slit_he
     'slit_height'    : height of the extraction slit (ie the pixel columns are 2*slit_height pixels long)
     'return_full'    : boolean - do you want to return the full model as well?
     'simu'           : boolean - are you using simulated spectra?
+    'trace_tables'   : the trace centres for all orders and pixel columns from "make_trace_tables" (they are created here if not provided)
+    'fibparms'       : the fibre profile parameters (if not provided, they are read from the directory given in 'pathdict')
+    'batched'        : boolean - if TRUE, the relative intensities at all sampling locations of all orders are obtained from one stacked
+                       linear least-squares problem (see "get_relints_normal_equations"), rather than one location at a time
+    'profile_cache'  : dictionary for re-using the profile cubes between calls, eg for all flats of one night (only if 'batched' is TRUE)
+    'date'           : the date of the observations in format 'YYYYMMDD' - if provided (and 'profile_cache' is not), the profile cubes are re-used
+                       from / stored in the in-process cache for that night (see "get_profile_cache")
     'debug_level'    : for debugging...
     'timit'          : boolean - do you want to measure execution run time?
     
@@ -384,17 +667,22 @@ def get_relints(P_id, stripes, err_stripes, mask=None, sampling_size=25, slit_he
     'model_grid'    : "x-grid" for the full model (only if 'return_full' is set to TRUE)
     """
 
-    assert pathdict is not None, 'ERROR: pathdict not provided!!!'
-    fibparms_path = pathdict['fp']
-
     print('Fitting relative intensities of fibres...')
     
     #read in polynomial coefficients of best-fit individual-fibre-profile parameters
-    if simu:
-        fibparms = np.load(fibparms_path + 'sim/fibparms_by_ord.npy').item()
-    else:
-        #fibparms = np.load(fibparms_path + 'real/first_real_veloce_test_fps.npy').item()
-        fibparms = np.load(fibparms_path + 'real/from_master_white_40orders.npy').item()
+    if fibparms is None:
+        assert pathdict is not None, 'ERROR: pathdict not provided!!!'
+        fibparms_path = pathdict['fp']
+        if simu:
+            fibparms = np.load(fibparms_path + 'sim/fibparms_by_ord.npy').item()
+        else:
+            #fibparms = np.load(fibparms_path + 'real/first_real_veloce_test_fps.npy').item()
+            fibparms = np.load(fibparms_path + 'real/from_master_white_40orders.npy').item()
+    if not batched and 'orders' in fibparms:
+        # "make_norm_profiles_2" needs the dictionary format, with the parameters as functions of pixel number
+        fibparms = fibparms_arrays_to_dict(fibparms, callables=True)
+    if batched and profile_cache is None and date is not None:
+        profile_cache = get_profile_cache(date)
     
     if timit:
         start_time = time.time()
@@ -406,21 +694,28 @@ def get_relints(P_id, stripes, err_stripes, mask=None, sampling_size=25, slit_he
     if return_full:
         fmodel = {}
         model_grid = {}
+    if batched:
+        neqs = {}
     
     if mask is None:
         cenmask = {}
     else:
         #we also only want to use the central TRUE parts of the masks, ie want ONE consecutive stretch per order
         cenmask = central_parts_of_mask(mask)
+    
+    # evaluate the order traces only once for all orders and pixel columns
+    if trace_tables is None:
+        trace_tables = make_trace_tables(P_id, nx=stripes[sorted(P_id.keys())[0]].shape[1])
         
     #loop over all orders
-    for ord in sorted(P_id.iterkeys()):
+    for ord in sorted(P_id.keys()):
         print('OK, now processing '+str(ord))
         
         #fibre profile parameters for that order
-        fppo = fibparms[ord]
+        fppo = get_order_fibparms(fibparms, ord)
         
         ordpol = P_id[ord]
+        ordpos = get_order_trace(trace_tables, ord)
         
         # define stripe
         stripe = stripes[ord]
@@ -432,13 +727,19 @@ def get_relints(P_id, stripes, err_stripes, mask=None, sampling_size=25, slit_he
         if mask is None:
             cenmask[ord] = np.ones(sc.shape[1], dtype='bool')
         
+        if batched:
+            # only set up the least-squares problems here, they are solved for all orders at once below
+            neqs[ord] = get_relints_normal_equations(sc, sr, err_sc, fppo, ordpos, ordmask=cenmask[ord], sampling_size=sampling_size, 
+                                                     profile_cache=profile_cache, return_full=return_full)
+            continue
+        
         # fit profile for single order and save result in "global" parameter dictionary for entire chip
         if return_full:
             relints_ord,relints_ord_norm,fmodel_ord,modgrid_ord,snr_ord = get_relints_single_order(sc, sr, err_sc, ordpol, fppo, ordmask=cenmask[ord], 
-                                                                                                   nfib=19, sampling_size=sampling_size, return_full=return_full)
+                                                                                                   nfib=19, sampling_size=sampling_size, return_full=return_full, ordpos=ordpos)
         else:
             relints_ord,relints_ord_norm,snr_ord = get_relints_single_order(sc, sr, err_sc, ordpol, fppo, ordmask=cenmask[ord], nfib=19, 
-                                                                            sampling_size=sampling_size, return_full=return_full)
+                                                                            sampling_size=sampling_size, return_full=return_full, ordpos=ordpos)
         
         if debug_level >= 2:
             #try to find cause for NaNs
@@ -454,6 +755,21 @@ def get_relints(P_id, stripes, err_stripes, mask=None, sampling_size=25, slit_he
         if return_full:
             fmodel[ord] = fmodel_ord
             model_grid[ord] = modgrid_ord
+    
+    if batched:
+        # solve the least-squares problems of all sampling locations of all orders in one go
+        eta = solve_relints_normal_equations(np.concatenate([neqs[ord]['C'] for ord in sorted(neqs.keys())]), 
+                                             np.concatenate([neqs[ord]['b'] for ord in sorted(neqs.keys())]))
+        n = 0
+        for ord in sorted(neqs.keys()):
+            neq = neqs[ord]
+            ngood = np.sum(neq['good'])
+            output = fill_relints_from_eta(neq, eta[n:n+ngood], nfib=19, return_full=return_full)
+            n += ngood
+            relints[ord],relints_norm[ord] = output[:2]
+            snr[ord] = list(neq['snr'])
+            if return_full:
+                fmodel[ord],model_grid[ord] = output[2:]
             
     
     #get weighted mean of all relints (weights = SNRs)
@@ -465,7 +781,7 @@ def get_relints(P_id, stripes, err_stripes, mask=None, sampling_size=25, slit_he
             allrelints = np.vstack((allrelints, relints_norm[ord]))
         except:
             allrelints = relints_norm[ord]
-    wm_relints = np.average(allrelints, axis=0, weights=np.array(allsnr), returned=False)
+    wm_relints = np.average(allrelints, axis=0, weights=np.concatenate(allsnr), returned=False)
         
     
     if timit:
@@ -480,7 +796,8 @@ def get_relints(P_id, stripes, err_stripes, mask=None, sampling_size=25, slit_he
 
 
 
-def get_relints_from_indices(P_id, img, err_img, stripe_indices, mask=None, pathdict=None, sampling_size=25, slit_height=32, return_full=False, simu=False, debug_level=0, timit=False):
+def get_relints_from_indices(P_id, img, err_img, stripe_indices, mask=None, pathdict=None, sampling_size=25, slit_height=32, return_full=False, simu=False, 
+                             trace_tables=None, fibparms=None, batched=True, profile_cache=None, date=None, debug_level=0, timit=False):
     """
     This routine computes the relative intensities in the individual fibres of a Veloce spectrum.
     
@@ -498,6 +815,13 @@ def get_relints_from_indices(P_id, img, err_img, stripe_indices, mask=None, path
     'slit_height'    : height of the extraction slit (ie the pixel columns are 2*slit_height pixels long)
     'return_full'    : boolean - do you want to return the full model as well?
     'simu'           : boolean - are you using simulated spectra?
+    'trace_tables'   : the trace centres for all orders and pixel columns from "make_trace_tables" (they are created here if not provided)
+    'fibparms'       : the fibre profile parameters (if not provided, they are read from the directory given in 'pathdict')
+    'batched'        : boolean - if TRUE, the relative intensities at all sampling locations of all orders are obtained from one stacked
+                       linear least-squares problem (see "get_relints_normal_equations"), rather than one location at a time
+    'profile_cache'  : dictionary for re-using the profile cubes between calls, eg for all flats of one night (only if 'batched' is TRUE)
+    'date'           : the date of the observations in format 'YYYYMMDD' - if provided (and 'profile_cache' is not), the profile cubes are re-used
+                       from / stored in the in-process cache for that night (see "get_profile_cache")
     'debug_level'    : for debugging...
     'timit'          : boolean - do you want to measure execution run time?
     
@@ -509,20 +833,25 @@ def get_relints_from_indices(P_id, img, err_img, stripe_indices, mask=None, path
     'model_grid'    : "x-grid" for the full model (only if 'return_full' is set to TRUE)
     """
 
-    assert pathdict is not None, 'ERROR: pathdict not provided!!!'
-    fibparms_path = pathdict['fp']
-
     print('Fitting relative intensities of fibres...')
 
     if timit:
         start_time = time.time()
         
     #read in polynomial coefficients of best-fit individual-fibre-profile parameters
-    if simu:
-        fibparms = np.load(fibparms_path + 'sim/fibparms_by_ord.npy').item()
-    else:
-        #fibparms = np.load(fibparms_path + 'real/first_real_veloce_test_fps.npy').item()
-        fibparms = np.load(fibparms_path + 'real/from_master_white_40orders.npy').item()
+    if fibparms is None:
+        assert pathdict is not None, 'ERROR: pathdict not provided!!!'
+        fibparms_path = pathdict['fp']
+        if simu:
+            fibparms = np.load(fibparms_path + 'sim/fibparms_by_ord.npy').item()
+        else:
+            #fibparms = np.load(fibparms_path + 'real/first_real_veloce_test_fps.npy').item()
+            fibparms = np.load(fibparms_path + 'real/from_master_white_40orders.npy').item()
+    if not batched and 'orders' in fibparms:
+        # "make_norm_profiles_2" needs the dictionary format, with the parameters as functions of pixel number
+        fibparms = fibparms_arrays_to_dict(fibparms, callables=True)
+    if batched and profile_cache is None and date is not None:
+        profile_cache = get_profile_cache(date)
         
     #create output dictionaries
     relints = {}
@@ -531,21 +860,28 @@ def get_relints_from_indices(P_id, img, err_img, stripe_indices, mask=None, path
     if return_full:
         fmodel = {}
         model_grid = {}
+    if batched:
+        neqs = {}
     
     if mask is None:
         cenmask = {}
     else:
         #we also only want to use the central TRUE parts of the masks, ie want ONE consecutive stretch per order
         cenmask = central_parts_of_mask(mask)
+    
+    # evaluate the order traces only once for all orders and pixel columns
+    if trace_tables is None:
+        trace_tables = make_trace_tables(P_id, nx=img.shape[1])
         
     #loop over all orders
-    for ord in sorted(P_id.iterkeys()):
+    for ord in sorted(P_id.keys()):
         print('OK, now processing '+str(ord))
         
         #fibre profile parameters for that order
-        fppo = fibparms[ord]
+        fppo = get_order_fibparms(fibparms, ord)
         
         ordpol = P_id[ord]
+        ordpos = get_order_trace(trace_tables, ord)
         
         # define stripe
         indices = stripe_indices[ord]
@@ -556,13 +892,19 @@ def get_relints_from_indices(P_id, img, err_img, stripe_indices, mask=None, path
         if mask is None:
             cenmask[ord] = np.ones(sc.shape[1], dtype='bool')
         
+        if batched:
+            # only set up the least-squares problems here, they are solved for all orders at once below
+            neqs[ord] = get_relints_normal_equations(sc, sr, err_sc, fppo, ordpos, ordmask=cenmask[ord], sampling_size=sampling_size, 
+                                                     profile_cache=profile_cache, return_full=return_full)
+            continue
+        
         # fit profile for single order and save result in "global" parameter dictionary for entire chip
         if return_full:
             relints_ord,relints_ord_norm,fmodel_ord,modgrid_ord,snr_ord = get_relints_single_order(sc, sr, err_sc, ordpol, fppo, ordmask=cenmask[ord], nfib=19, 
-                                                                                                   sampling_size=sampling_size, return_full=return_full)
+                                                                                                   sampling_size=sampling_size, return_full=return_full, ordpos=ordpos)
         else:
             relints_ord,relints_ord_norm,snr_ord = get_relints_single_order(sc, sr, err_sc, ordpol, fppo, ordmask=cenmask[ord], nfib=19, 
-                                                                            sampling_size=sampling_size, return_full=return_full)
+                                                                            sampling_size=sampling_size, return_full=return_full, ordpos=ordpos)
         
         
         if debug_level >= 2:
@@ -579,6 +921,21 @@ def get_relints_from_indices(P_id, img, err_img, stripe_indices, mask=None, path
         if return_full:
             fmodel[ord] = fmodel_ord
             model_grid[ord] = modgrid_ord
+    
+    if batched:
+        # solve the least-squares problems of all sampling locations of all orders in one go
+        eta = solve_relints_normal_equations(np.concatenate([neqs[ord]['C'] for ord in sorted(neqs.keys())]), 
+                                             np.concatenate([neqs[ord]['b'] for ord in sorted(neqs.keys())]))
+        n = 0
+        for ord in sorted(neqs.keys()):
+            neq = neqs[ord]
+            ngood = np.sum(neq['good'])
+            output = fill_relints_from_eta(neq, eta[n:n+ngood], nfib=19, return_full=return_full)
+            n += ngood
+            relints[ord],relints_norm[ord] = output[:2]
+            snr[ord] = list(neq['snr'])
+            if return_full:
+                fmodel[ord],model_grid[ord] = output[2:]
             
     
     #get weighted mean of all relints (weights = SNRs)
@@ -590,7 +947,7 @@ def get_relints_from_indices(P_id, img, err_img, stripe_indices, mask=None, path
             allrelints = np.vstack((allrelints,relints_norm[ord]))
         except:
             allrelints = relints_norm[ord]
-    wm_relints = np.average(allrelints, axis=0, weights=np.array(allsnr), returned=False)
+    wm_relints = np.average(allrelints, axis=0, weights=np.concatenate(allsnr), returned=False)
             
     
     if timit:
@@ -606,7 +963,7 @@ def get_relints_from_indices(P_id, img, err_img, stripe_indices, mask=None, path
 
 
 def get_relints_single_order_gaussian(sc, sr, err_sc, ordpol, ordmask=None, nfib=24, sampling_size=25, step_size=None,
-                                      return_snr=True, debug_level=0, timit=False):
+                                      return_snr=True, ordpos=None, debug_level=0, timit=False):
     """
     INPUT:
     'sc'             : the flux in the extracted, flattened stripe
@@ -622,6 +979,8 @@ def get_relints_single_order_gaussian(sc, sr, err_sc, ordpol, ordmask=None, nfib
     'step_size'      : only calculate the relative intensities every so and so many pixels (should not change, plus it takes ages...)
     'return_full'    : boolean - do you want to also return the full model (if FALSE, then only the relative intensities are returned)
     'return_snr'     : boolean - do you want to return the SNR of the collapsed super-pixel at each location in 'userange'?
+    'ordpos'         : the trace centres of that order for all pixel columns (eg from "make_trace_tables"); if not provided,
+                       they are evaluated from 'ordpol'
     'debug_level'    : for debugging...
 
     OUTPUT:
@@ -650,6 +1009,10 @@ def get_relints_single_order_gaussian(sc, sr, err_sc, ordpol, ordmask=None, nfib
     if ordmask is None:
         ordmask = np.ones(npix, dtype='bool')
 
+    # trace centres for all pixel columns
+    if ordpos is None:
+        ordpos = np.polyval(ordpol, np.arange(npix))
+
     if step_size is None:
         step_size = 2 * sampling_size
     userange = np.arange(np.arange(npix)[ordmask][0] + sampling_size, np.arange(npix)[ordmask][-1], step_size)
@@ -704,9 +1067,9 @@ def get_relints_single_order_gaussian(sc, sr, err_sc, ordpol, ordmask=None, nfib
             normdata = []
             # errors = []
             weights = []
-            refpos = ordpol(pix)
+            refpos = ordpos[pix]
             for j in np.arange(np.max([0, pix - sampling_size]), np.min([npix - 1, pix + sampling_size]) + 1):
-                grid.append(sr[:, j] - ordpol(j) + refpos)
+                grid.append(sr[:, j] - ordpos[j] + refpos)
                 # data.append(sc[:,j])
                 normdata.append(sc[:, j] / np.sum(sc[:, j]))
                 # assign weights for flux (and take care of NaNs and INFs)
@@ -723,7 +1086,7 @@ def get_relints_single_order_gaussian(sc, sr, err_sc, ordpol, ordmask=None, nfib
                 # weights.append(1./((np.sqrt(sc[:,j] + RON**2)) / sc[:,j])**2)
                 if debug_level >= 2:
                     # plt.plot(sr[:,j] - ordpol(j),sc[:,j],'.')
-                    plt.plot(sr[:, j] - ordpol(j), sc[:, j] / np.sum(sc[:, j]), '.')
+                    plt.plot(sr[:, j] - ordpos[j], sc[:, j] / np.sum(sc[:, j]), '.')
                     # plt.xlim(-5,5)
                     plt.xlim(-sc.shape[0] / 2, sc.shape[0] / 2)
 
@@ -843,10 +1206,122 @@ def get_relints_single_order_gaussian(sc, sr, err_sc, ordpol, ordmask=None, nfib
 
 
 
+def get_relints_single_order_gaussian_batched(sc, sr, err_sc, ordpol, ordmask=None, nfib=24, sampling_size=25, step_size=None,
+                                              return_snr=True, ordpos=None, maxiter=200, debug_level=0, timit=False):
+    """
+    Same as "get_relints_single_order_gaussian", but instead of one "curve_fit" call (with numerical derivatives) per fibre and
+    sampling location, the single-Gaussian fits to all fibres at all sampling locations of the order are performed simultaneously
+    with a batched Levenberg-Marquardt solver with analytic Jacobians (see "batched_lm_fit"). Every fit converges independently
+    (fits that have converged are dropped from the active set). The stacking of the cutouts, the peak finding, the fitting windows,
+    the initial guesses and the bounds are the same as in "get_relints_single_order_gaussian", and so is the output.
+
+    INPUT:
+    (same as for "get_relints_single_order_gaussian", plus)
+    'maxiter'        : maximum number of Levenberg-Marquardt iterations
+
+    OUTPUT:
+    'relints'        : relative intensities in the fibres
+    'relints_norm'   : relative intensities in the fibres re-normalized to a sum of 1
+    'positions'      : the fitted positions of the fibres
+    'snr'            : SNR of the collapsed super-pixel at each location in 'userange' (only if 'return_snr' is set to TRUE)
+    """
+
+    fitwidth = 30
+
+    if timit:
+        start_time = time.time()
+    if debug_level >= 1:
+        print('Fitting fibre profiles (pure Gaussians) for one order (batched)...')
+
+    npix = sc.shape[1]
+
+    if ordmask is None:
+        ordmask = np.ones(npix, dtype='bool')
+
+    # trace centres for all pixel columns
+    if ordpos is None:
+        ordpos = np.polyval(ordpol, np.arange(npix))
+
+    if step_size is None:
+        step_size = 2 * sampling_size
+    userange = np.arange(np.arange(npix)[ordmask][0] + sampling_size, np.arange(npix)[ordmask][-1], step_size)
+    # don't use pixel columns 200 pixels from either end of the chip
+    userange = userange[np.logical_and(userange > 200, userange < npix - 200)]
+
+    # prepare output arrays (locations without a successful fit get -1, as in "get_relints_single_order_gaussian")
+    positions = -np.ones((len(userange), nfib))
+    relints = -np.ones((len(userange), nfib))
+
+    snr = np.sum(sc[:,userange], axis=0) / np.sqrt(np.sum(err_sc[:,userange]**2, axis=0))
+
+    # check if the cutouts fall fully onto CCD (exclude the first row number, as that can legitimately be zero)
+    # NOTE: This also covers row numbers > ny, as in these cases 'sr' is set to zero in "flatten_single_stripe(_from_indices)"
+    onchip = np.all(sr[1:,userange] != 0, axis=0)
+    for pix in userange[np.logical_and(ordmask[userange], ~onchip)]:
+        if np.sum(sr[:,pix]) == 0:
+            print('WARNING: the entire cutout lies outside the chip!!!')
+        else:
+            print('WARNING: parts of the cutout lie outside the chip!!!')
+    good = np.nonzero(np.logical_and(ordmask[userange], onchip))[0]
+
+    # stack the cutouts for all good locations at once
+    grid, normdata, weights, valid = stack_sampling_windows(sc, sr, err_sc, ordpos, userange[good], sampling_size=sampling_size)
+
+    # find the fibres at each location, and set up one fit per fibre and location
+    fitloc = []
+    xx = []
+    yy = []
+    ww = []
+    p0 = []
+    offsets = np.arange(-fitwidth, fitwidth + 1)
+    for k,i in enumerate(good):
+        gridk = grid[k][valid[k]]
+        normdatak = normdata[k][valid[k]]
+        dynrange = np.max(normdatak) - np.min(normdatak)
+        goodpeaks, mostpeaks, allpeaks = find_suitable_peaks(normdatak, thresh=np.min(normdatak)+0.5*dynrange, bgthresh=np.min(normdatak)+0.25*dynrange,
+                                                             clip_edges=False, gauss_filter_sigma=10, slope=1e-8)
+        if len(goodpeaks) != nfib:
+            print('WARNING: found '+str(len(goodpeaks))+' instead of '+str(nfib)+' fibres at pix = '+str(userange[i]))
+            continue
+        # fitting windows of +/- fitwidth points around each peak (truncated at the ends of the stacked grid)
+        ix = goodpeaks[:,np.newaxis] + offsets
+        inside = np.logical_and(ix >= 0, ix < len(gridk))
+        ix = np.clip(ix, 0, len(gridk) - 1)
+        fitloc.append(i)
+        xx.append(gridk[ix])
+        yy.append(normdatak[ix])
+        ww.append(inside.astype(float))
+        p0.append(np.c_[gridk[goodpeaks], np.full(nfib, 0.6), normdatak[goodpeaks]])
+
+    if len(fitloc) > 0:
+        xx = np.concatenate(xx)
+        yy = np.concatenate(yy)
+        ww = np.concatenate(ww)
+        p0 = np.concatenate(p0)
+        # same bounds as in "get_relints_single_order_gaussian" (except for sigma, which must not become exactly zero)
+        lower = np.c_[p0[:,0] - 1, np.full(len(p0), 1e-3), np.zeros(len(p0))]
+        upper = np.c_[p0[:,0] + 1, np.full(len(p0), np.inf), np.full(len(p0), np.inf)]
+        popt = batched_lm_fit(batched_gaussian, xx, yy, p0, weights=ww, jac=batched_gaussian_jac, lower=lower, upper=upper,
+                              maxiter=maxiter, debug_level=debug_level)
+        positions[fitloc,:] = popt[:,0].reshape(len(fitloc), nfib)
+        relints[fitloc,:] = popt[:,2].reshape(len(fitloc), nfib)
+
+    relints_norm = relints / np.sum(relints, axis=1)[:,np.newaxis]
+
+    if timit:
+        print('Elapsed time for retrieving relative intensities: ' + np.round(time.time() - start_time, 2).astype(str) + ' seconds...')
+
+    if return_snr:
+        return relints, relints_norm, positions, list(snr)
+    else:
+        return relints, relints_norm, positions
+
+
+
 
 
 def get_relints_from_indices_gaussian(P_id, img, err_img, stripe_indices, mask=None, nfib=24, sampling_size=25, slit_height=32,
-                                      debug_level=0, timit=False):
+                                      trace_tables=None, batched=True, debug_level=0, timit=False):
     """
     This routine computes the relative intensities in the individual fibres of a Veloce spectrum.
 
@@ -862,6 +1337,9 @@ def get_relints_from_indices_gaussian(P_id, img, err_img, stripe_indices, mask=N
     'sampling_size'  : 'sampling_size'  : how many pixels (in dispersion direction) either side of current i-th pixel do you want to consider?
                        (ie stack profiles for a total of 2*sampling_size+1 pixels in dispersion direction...)
     'slit_height'    : height of the extraction slit (ie the pixel columns are 2*slit_height pixels long)
+    'trace_tables'   : the trace centres for all orders and pixel columns from "make_trace_tables" (they are created here if not provided)
+    'batched'        : boolean - if TRUE, the Gaussian fits for all fibres and sampling locations of an order are performed simultaneously
+                       (see "get_relints_single_order_gaussian_batched"), rather than one "curve_fit" call at a time
     'debug_level'    : for debugging...
     'timit'          : boolean - do you want to measure execution run time?
 
@@ -888,14 +1366,19 @@ def get_relints_from_indices_gaussian(P_id, img, err_img, stripe_indices, mask=N
         # we also only want to use the central TRUE parts of the masks, ie want ONE consecutive stretch per order
         cenmask = central_parts_of_mask(mask)
 
+    # evaluate the order traces only once for all orders and pixel columns
+    if trace_tables is None:
+        trace_tables = make_trace_tables(P_id, nx=img.shape[1])
+
     # loop over all orders
-    for ord in sorted(P_id.iterkeys()):
+    for ord in sorted(P_id.keys()):
         print('OK, now processing ' + str(ord))
 
         # # fibre profile parameters for that order
         # fppo = fibparms[ord]
 
         ordpol = P_id[ord]
+        ordpos = get_order_trace(trace_tables, ord)
 
         # define stripe
         indices = stripe_indices[ord]
@@ -909,7 +1392,12 @@ def get_relints_from_indices_gaussian(P_id, img, err_img, stripe_indices, mask=N
             cenmask[ord] = np.ones(sc.shape[1], dtype='bool')
 
         # fit profile for single order and save result in "global" parameter dictionary for entire chip
-        relints_ord, relints_ord_norm, positions, snr_ord = get_relints_single_order_gaussian(sc, sr, err_sc, ordpol, ordmask=cenmask[ord], nfib=nfib, sampling_size=sampling_size)
+        if batched:
+            relints_ord, relints_ord_norm, positions, snr_ord = get_relints_single_order_gaussian_batched(sc, sr, err_sc, ordpol, ordmask=cenmask[ord], nfib=nfib, 
+                                                                                                          sampling_size=sampling_size, ordpos=ordpos)
+        else:
+            relints_ord, relints_ord_norm, positions, snr_ord = get_relints_single_order_gaussian(sc, sr, err_sc, ordpol, ordmask=cenmask[ord], nfib=nfib, 
+                                                                                                  sampling_size=sampling_size, ordpos=ordpos)
         
         # debugging...
         if debug_level >= 2:
@@ -953,7 +1441,194 @@ def get_relints_from_indices_gaussian(P_id, img, err_img, stripe_indices, mask=N
 
 
 
-def append_relints_to_FITS(relints, fn):
+def make_synthetic_gaussian_stripe(nfib=24, npix=4112, slit_height=32, fibsep=2.4, sigma=0.8, flux=2e4, RON=4., seed=None):
+    """
+    Creates a synthetic, flattened stripe (as from "flatten_single_stripe") of 'nfib' Gaussian fibre profiles along a gently curved trace.
+
+    INPUT:
+    'nfib'         : number of fibres
+    'npix'         : number of pixel columns
+    'slit_height'  : the cutouts are 2*slit_height+1 rows high
+    'fibsep'       : separation of the fibres (in pixels)
+    'sigma'        : width of the fibre profiles (in pixels)
+    'flux'         : total flux per pixel column
+    'RON'          : read-out noise (in electrons)
+    'seed'         : seed for the random number generator
+
+    OUTPUT:
+    'sc'           : the flux in the stripe (2*slit_height+1, npix)
+    'sr'           : row-indices of the cutouts (2*slit_height+1, npix)
+    'err_sc'       : the errors in the stripe
+    'ordpol'       : the polynomial coefficients of the trace
+    'true_relints' : the input relative intensities of the fibres (normalized to a sum of 1)
+    """
+
+    rng = np.random.RandomState(seed)
+
+    ordpol = np.array([-2e-5, 0.08, 1000.])
+    ordpos = np.polyval(ordpol, np.arange(npix))
+    fibpos = (np.arange(nfib) - (nfib - 1) / 2.) * fibsep
+
+    true_relints = rng.uniform(0.7, 1.3, nfib)
+    true_relints /= np.sum(true_relints)
+
+    sr = np.round(ordpos).astype(int) + np.arange(-slit_height, slit_height + 1)[:,np.newaxis]
+    dy = sr - ordpos
+    model = np.sum(true_relints[:,np.newaxis,np.newaxis] * np.exp(-0.5 * ((dy - fibpos[:,np.newaxis,np.newaxis]) / sigma)**2), axis=0)
+    model *= flux / np.sum(model, axis=0)
+
+    err_sc = np.sqrt(model + RON**2)
+    sc = model + err_sc * rng.standard_normal(model.shape)
+
+    return sc, sr, err_sc, ordpol, true_relints
+
+
+
+def relints_gaussian_timing_test(nfib=24, npix=4112, sampling_size=25, step_size=None, seed=None):
+    """
+    Compares run time and results of "get_relints_single_order_gaussian" and "get_relints_single_order_gaussian_batched" on a synthetic stripe
+    (from "make_synthetic_gaussian_stripe").
+
+    INPUT:
+    'nfib'           : number of fibres
+    'npix'           : number of pixel columns
+    'sampling_size'  : how many pixels (in dispersion direction) either side of current i-th pixel do you want to consider?
+    'step_size'      : only calculate the relative intensities every so and so many pixels
+    'seed'           : seed for the random number generator
+
+    OUTPUT:
+    'timings'        : dictionary containing the run times (in seconds) and the maximum differences between the two methods
+    """
+
+    sc, sr, err_sc, ordpol, true_relints = make_synthetic_gaussian_stripe(nfib=nfib, npix=npix, seed=seed)
+
+    start_time = time.time()
+    relints, relints_norm, positions, snr = get_relints_single_order_gaussian(sc, sr, err_sc, ordpol, nfib=nfib, sampling_size=sampling_size,
+                                                                              step_size=step_size)
+    delta_t = time.time() - start_time
+
+    start_time = time.time()
+    relints_b, relints_norm_b, positions_b, snr_b = get_relints_single_order_gaussian_batched(sc, sr, err_sc, ordpol, nfib=nfib, sampling_size=sampling_size,
+                                                                                              step_size=step_size)
+    delta_t_b = time.time() - start_time
+
+    timings = {'loop':delta_t, 'batched':delta_t_b, 'speedup':delta_t / delta_t_b,
+               'max_diff_relints_norm':np.max(np.abs(relints_norm_b - relints_norm)),
+               'max_diff_positions':np.max(np.abs(positions_b - positions)),
+               'max_diff_true_relints':np.max(np.abs(np.mean(relints_norm_b[relints_b[:,0] != -1], axis=0) - true_relints))}
+
+    print('Time taken for one order (one fit at a time): ' + np.round(delta_t, 2).astype(str) + ' seconds')
+    print('Time taken for one order (batched fits):      ' + np.round(delta_t_b, 2).astype(str) + ' seconds')
+    print('max |difference| in relints_norm: ' + str(timings['max_diff_relints_norm']))
+    print('max |difference| in positions:    ' + str(timings['max_diff_positions']))
+
+    return timings
+
+
+
+
+
+def get_relints_from_etas(flux, err, fibs='all', nfib=19, mask=None, return_full=False, debug_level=0, timit=False):
+    """
+    Derives the relative intensities in the fibres directly from the per-column fibre amplitudes (ie the "eta's") of an optimal extraction
+    of individual fibres (method (3a) in "extract_spectrum(_from_indices)"), so that no separate pass over the image is needed. For every
+    pixel column the amplitudes are normalized to a sum of 1, and the normalized amplitudes are then reduced to one value per fibre and order
+    by taking their weighted median (weights = inverse variance of the normalized amplitudes, propagated from the extraction errors).
+    The results from all orders are combined by an inverse-variance weighted mean.
+
+    INPUT:
+    'flux'         : dictionary (keys = orders) containing the extracted flux for each fibre (keys = 'fibre_01', 'fibre_02', ...)
+    'err'          : dictionary (keys = orders) containing the uncertainties in the extracted flux for each fibre
+    'fibs'         : the 'fibs' keyword used for the extraction (['all' / 'stellar'])
+    'nfib'         : number of fibres for which to retrieve the relative intensities (19 for the stellar fibres only, or 24 for the stellar plus sky fibres)
+    'mask'         : dictionary (keys = orders) of boolean masks for the pixel columns to use (eg from "find_stripes") - default is to use all columns
+    'return_full'  : boolean - do you also want to return the relative intensities (and their errors) for the individual orders?
+    'debug_level'  : for debugging...
+    'timit'        : boolean - do you want to measure execution run time?
+
+    OUTPUT:
+    'wm_relints'       : the relative intensities in the fibres (normalized to a sum of 1)
+    'err_wm_relints'   : the uncertainties in 'wm_relints'
+    'relints'          : dictionary (keys = orders) containing the relative intensities for each order (only if 'return_full' is set to TRUE)
+    'err_relints'      : dictionary (keys = orders) containing the uncertainties in 'relints' (only if 'return_full' is set to TRUE)
+    """
+
+    if timit:
+        start_time = time.time()
+
+    assert nfib in [19, 24], 'ERROR: relative intensities can only be derived for exactly 19 or exactly 24 fibres!!!'
+
+    # which fibres do we need (see "make_norm_profiles_6" for the fibre layout)?
+    if fibs.lower() == 'all':
+        if nfib == 19:
+            userange = np.arange(3, 22)
+        else:
+            userange = np.arange(1, 25)
+    elif fibs.lower() in ['stellar', 'object']:
+        assert nfib == 19, 'ERROR: only the stellar fibres have been extracted!!!'
+        userange = np.arange(19)
+    else:
+        print('ERROR: relative intensities can only be derived from extractions with fibs="all" or fibs="stellar"!!!')
+        return
+
+    relints = {}
+    err_relints = {}
+
+    for ord in sorted(flux.keys()):
+
+        fibkeys = sorted(flux[ord].keys())
+        f = np.array([flux[ord][fibkeys[j]] for j in userange], dtype=float)
+        e = np.array([err[ord][fibkeys[j]] for j in userange], dtype=float)
+
+        # normalize the amplitudes of every pixel column to a sum of 1
+        tot = np.sum(f, axis=0)
+        var_tot = np.sum(e**2, axis=0)
+        good = np.logical_and(tot > 0, np.all(e > 0, axis=0))
+        good = np.logical_and(good, np.all(np.isfinite(f), axis=0))
+        if mask is not None:
+            good = np.logical_and(good, mask[ord][:f.shape[1]])
+        if np.sum(good) == 0:
+            if debug_level >= 1:
+                print('WARNING: no useful pixel columns in ' + ord)
+            continue
+        r = f[:,good] / tot[good]
+        # error propagation for r_i = f_i / sum_j(f_j):  var(r_i) = ((1 - 2*r_i) * var(f_i) + r_i**2 * sum_j(var(f_j))) / (sum_j(f_j))**2
+        var_r = ((1. - 2.*r) * e[:,good]**2 + r**2 * var_tot[good]) / tot[good]**2
+        w = np.zeros(r.shape)
+        w[var_r > 0] = 1. / var_r[var_r > 0]
+
+        # robust estimate for this order (the uncertainty of the median is larger than that of the mean by a factor of sqrt(pi/2))
+        relints[ord] = weighted_median_rows(r, w)
+        err_relints[ord] = np.sqrt(np.pi / 2. / np.sum(w, axis=1))
+
+        if debug_level >= 1:
+            print(ord + ': relints derived from ' + str(np.sum(good)) + ' pixel columns')
+
+    # inverse-variance weighted mean of all orders
+    allrelints = np.array([relints[ord] for ord in sorted(relints.keys())])
+    allweights = 1. / np.array([err_relints[ord] for ord in sorted(relints.keys())])**2
+    allweights[~np.isfinite(allrelints)] = 0.
+    allrelints[~np.isfinite(allrelints)] = 0.
+    wm_relints = np.sum(allweights * allrelints, axis=0) / np.sum(allweights, axis=0)
+    err_wm_relints = 1. / np.sqrt(np.sum(allweights, axis=0))
+    # re-normalize to a sum of 1
+    normfac = np.sum(wm_relints)
+    wm_relints /= normfac
+    err_wm_relints /= normfac
+
+    if timit:
+        print('Time elapsed: ' + str(np.round(time.time() - start_time, 2)) + ' seconds...')
+
+    if return_full:
+        return wm_relints, err_wm_relints, relints, err_relints
+    else:
+        return wm_relints, err_wm_relints
+
+
+
+
+
+def append_relints_to_FITS(relints, fn, err_relints=None):
     
     nfib = len(relints)
     
@@ -983,6 +1658,8 @@ def append_relints_to_FITS(relints, fn):
     #loop over all fibres
     for i in np.arange(nfib):
         pyfits.setval(fn, 'RELINT'+str(i+1).zfill(2), value=relints[i], comment='fibre '+str(fibnums[i])+'   ('+fibinfo[i]+' fibre)')
+        if err_relints is not None:
+            pyfits.setval(fn, 'RELERR'+str(i+1).zfill(2), value=err_relints[i], comment='uncertainty in RELINT'+str(i+1).zfill(2))
         
     return
 
@@ -11,14 +11,16 @@ from scipy import ndimage
 import matplotlib.pyplot as plt
 import time
 
-from veloce_reduction.veloce_reduction.helper_functions import find_maxima, fibmodel, fibmodel_with_amp, offset_pseudo_gausslike, fibmodel_with_amp_and_offset, norm_fibmodel_with_amp, norm_fibmodel_with_amp_and_offset
-from veloce_reduction.veloce_reduction.order_tracing import flatten_single_stripe, flatten_single_stripe_from_indices
+from veloce_reduction.veloce_reduction.helper_functions import find_maxima, fibmodel, fibmodel_with_amp, offset_pseudo_gausslike, fibmodel_with_amp_and_offset, norm_fibmodel_with_amp, norm_fibmodel_with_amp_and_offset, \
+    batched_fibmodel_with_amp, batched_fibmodel_with_amp_jac, batched_lm_fit, share_array, attach_shared_array, run_orders_in_parallel
+from veloce_reduction.veloce_reduction.order_tracing import flatten_single_stripe, flatten_single_stripe_from_indices, make_trace_tables, get_order_trace
 
 
 
 
 
-def determine_spatial_profiles_single_order(sc, sr, err_sc, ordpol, ordmask=None, model='gausslike', sampling_size=50, return_stats=False, debug_level=0, timit=False):
+def determine_spatial_profiles_single_order(sc, sr, err_sc, ordpol, ordmask=None, model='gausslike', sampling_size=50, return_stats=False, batched=True, 
+                                            ordpos=None, debug_level=0, timit=False):
     """
     Calculate the spatial-direction profiles of the fibres for a single order.
     
@@ -34,6 +36,10 @@ def determine_spatial_profiles_single_order(sc, sr, err_sc, ordpol, ordmask=None
                        (ie stack profiles for a total of 2*sampling_size+1 pixels...)
     'RON'            : read-out noise per pixel
     'return_stats'   : boolean - do you want to return goodness-of-fit statistics (ie AIC, BIC, CHISQ and REDCHISQ)?
+    'batched'        : boolean - if TRUE (and model='gausslike'), all pixel columns are fitted simultaneously 
+                       (see "determine_spatial_profiles_single_order_batched"), instead of one lmfit call per column
+    'ordpos'         : the trace centres of that order for all pixel columns (eg from "make_trace_tables"); if not provided, 
+                       they are evaluated from 'ordpol'
     'debug_level'    : for debugging...
     'timit'          : boolean - do you want to measure execution run time?
     
@@ -41,6 +47,10 @@ def determine_spatial_profiles_single_order(sc, sr, err_sc, ordpol, ordmask=None
     'colfits'        : instance of "best_values" from "lmfit" fitting of order profiles
     """
     
+    if batched and model.lower() == 'gausslike':
+        return determine_spatial_profiles_single_order_batched(sc, sr, err_sc, ordpol, ordmask=ordmask, sampling_size=sampling_size,
+                                                               return_stats=return_stats, ordpos=ordpos, debug_level=debug_level, timit=timit)
+    
     if timit:
         start_time = time.time()
     if debug_level >= 1:
@@ -53,6 +63,9 @@ def determine_spatial_profiles_single_order(sc, sr, err_sc, ordpol, ordmask=None
     if ordmask is None:
         ordmask = np.ones(npix, dtype='bool')
     
+    # trace centres for all pixel columns
+    if ordpos is None:
+        ordpos = np.polyval(ordpol, np.arange(npix))
     
     for i in range(npix):
     #for i in range(2000,2500,1):
@@ -96,9 +109,9 @@ def determine_spatial_profiles_single_order(sc, sr, err_sc, ordpol, ordmask=None
             normdata = []
             # errors = []
             weights = []
-            refpos = ordpol(i)
+            refpos = ordpos[i]
             for j in np.arange(np.max([0,i-sampling_size]),np.min([npix-1,i+sampling_size])+1):
-                grid.append(sr[:,j] - ordpol(j) + refpos)
+                grid.append(sr[:,j] - ordpos[j] + refpos)
                 #data.append(sc[:,j])
                 normdata.append(sc[:,j]/np.sum(sc[:,j]))
                 #errors.append(np.sqrt(sc[:,j] + RON**2))
@@ -113,7 +126,7 @@ def determine_spatial_profiles_single_order(sc, sr, err_sc, ordpol, ordmask=None
                 #weights.append(1./((np.sqrt(sc[:,j] + RON**2)) / sc[:,j])**2)
                 if debug_level >= 2:
                     #plt.plot(sr[:,j] - ordpol(j),sc[:,j],'.')
-                    plt.plot(sr[:,j] - ordpol(j),sc[:,j]/np.sum(sc[:,j]),'.')
+                    plt.plot(sr[:,j] - ordpos[j],sc[:,j]/np.sum(sc[:,j]),'.')
                     #plt.xlim(-5,5)
                     plt.xlim(-sc.shape[0]/2,sc.shape[0]/2)
                 
@@ -245,6 +258,130 @@ def determine_spatial_profiles_single_order(sc, sr, err_sc, ordpol, ordmask=None
 
 
 
+def determine_spatial_profiles_single_order_batched(sc, sr, err_sc, ordpol, ordmask=None, sampling_size=50, return_stats=False, 
+                                                    chunksize=256, maxiter=200, ordpos=None, debug_level=0, timit=False):
+    """
+    Same as "determine_spatial_profiles_single_order" for model='gausslike', but instead of setting up an lmfit model for every 
+    pixel column, the stacked profiles of all pixel columns are fitted simultaneously with a batched Levenberg-Marquardt 
+    solver (vectorized residuals and analytic Jacobians, see "batched_lm_fit"). Every column converges independently. 
+    The stacking, weights, initial guesses and parameter bounds are the same as in "fit_stacked_single_fibre_profile", and 
+    the output has the same format as "determine_spatial_profiles_single_order".
+    
+    INPUT:
+    'sc'             : the flux in the extracted, flattened stripe
+    'sr'             : row-indices (ie in spatial direction) of the cutouts in 'sc'
+    'err_sc'         : the error in the extracted, flattened stripe
+    'ordpol'         : set of polynomial coefficients from P_id for that order (ie p = P_id[ord])
+    'ordmask'        : gives user the option to provide a mask (eg from "find_stripes")
+    'sampling_size'  : how many pixels (in dispersion direction) either side of current i-th pixel do you want to consider? 
+                       (ie stack profiles for a total of 2*sampling_size+1 pixels...)
+    'return_stats'   : boolean - do you want to return goodness-of-fit statistics (ie AIC, BIC, CHISQ and REDCHISQ)?
+    'chunksize'      : number of pixel columns that are fitted at a time (limits the memory usage)
+    'maxiter'        : maximum number of Levenberg-Marquardt iterations
+    'ordpos'         : the trace centres of that order for all pixel columns (eg from "make_trace_tables"); if not provided, 
+                       they are evaluated from 'ordpol'
+    'debug_level'    : for debugging...
+    'timit'          : boolean - do you want to measure execution run time?
+    
+    OUTPUT:
+    'colfits'        : dictionary containing lists of the best-fit parameters (and the pixel column numbers) 
+    """
+    
+    if timit:
+        start_time = time.time()
+    if debug_level >= 1:
+        print('Fitting fibre profiles for one order (batched)...')
+    
+    nrows, npix = sc.shape
+    xx = np.arange(npix)
+    if ordmask is None:
+        ordmask = np.ones(npix, dtype='bool')
+    
+    # trace positions and total counts for all columns
+    if ordpos is None:
+        ypos = np.polyval(ordpol, xx)
+    else:
+        ypos = np.asarray(ordpos)
+    colsum = np.sum(sc, axis=0)
+    
+    # check which cutouts fall fully onto the CCD
+    # NOTE: This also covers row numbers > ny, as in these cases 'sr' is set to zero in "flatten_single_stripe(_from_indices)"
+    checkprod = np.all(sr[1:,:] != 0, axis=0)    #exclude the first row number, as that can legitimately be zero
+    goodcols = np.logical_and(ordmask, checkprod)
+    if debug_level >= 1:
+        print('WARNING: ' + str(np.sum(~ordmask)) + ' pixel columns are masked out due to low signal!!!')
+        print('WARNING: ' + str(np.sum(ordmask & ~checkprod)) + ' cutouts lie (partially) outside the chip!!!')
+    
+    parnames = ['mu', 'sigma', 'amp', 'beta']
+    bestfit = -np.ones((npix, len(parnames)))
+    stats = -np.ones((npix, 4))
+    niter = np.zeros(npix, dtype='int')
+    offsets = np.arange(-sampling_size, sampling_size + 1)
+    
+    for chunk in np.array_split(xx[goodcols], max(1, int(np.ceil(np.sum(goodcols) / chunksize)))):
+        if len(chunk) == 0:
+            continue
+        # stack the neighbouring columns (columns falling off the chip are padded with zero weight)
+        jj = chunk[:,np.newaxis] + offsets
+        valid = np.logical_and(jj >= 0, jj < npix)
+        jj = np.clip(jj, 0, npix - 1)
+        grid = sr[:,jj].transpose(1,2,0) - ypos[jj][:,:,np.newaxis] + ypos[chunk][:,np.newaxis,np.newaxis]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # adjust to flux level in actual pixel position
+            normdata = sc[:,jj].transpose(1,2,0) / colsum[jj][:,:,np.newaxis] * colsum[chunk][:,np.newaxis,np.newaxis]
+            # using relative errors for weights in the fit
+            normerr = (err_sc[:,jj] / sc[:,jj]).transpose(1,2,0) / colsum[jj][:,:,np.newaxis]
+            weights = 1. / (normerr * normerr)
+        weights[~np.isfinite(weights)] = 0.
+        weights[~valid] = 0.
+        grid = grid.reshape(len(chunk), -1)
+        normdata = normdata.reshape(len(chunk), -1)
+        weights = weights.reshape(len(chunk), -1)
+        
+        # initial guesses and bounds (as in "fit_stacked_single_fibre_profile")
+        guess = np.zeros((len(chunk), 4))
+        guess[:,0] = ypos[chunk]
+        guess[:,1] = .7
+        guess[:,2] = np.max(np.where(weights > 0, normdata, -np.inf), axis=1)
+        guess[:,3] = 2.
+        lower = np.c_[guess[:,0] - 3, np.repeat(0.2, len(chunk)), np.zeros(len(chunk)), np.ones(len(chunk))]
+        upper = np.c_[guess[:,0] + 3, np.repeat(2., len(chunk)), np.repeat(np.inf, len(chunk)), np.repeat(4., len(chunk))]
+        
+        popt, chi2, conv, nit = batched_lm_fit(batched_fibmodel_with_amp, grid, normdata, guess, weights=weights, jac=batched_fibmodel_with_amp_jac, 
+                                               lower=lower, upper=upper, maxiter=maxiter, return_stats=True, debug_level=debug_level)
+        bestfit[chunk] = popt
+        niter[chunk] = nit
+        
+        # goodness-of-fit statistics (same definitions as in lmfit)
+        ndata = np.sum(valid, axis=1) * nrows
+        nvarys = len(parnames)
+        with np.errstate(divide='ignore'):
+            stats[chunk,0] = ndata * np.log(chi2 / ndata) + 2 * nvarys
+            stats[chunk,1] = ndata * np.log(chi2 / ndata) + np.log(ndata) * nvarys
+        stats[chunk,2] = chi2
+        stats[chunk,3] = chi2 / (ndata - nvarys)
+    
+    # fill output structure
+    colfits = {}
+    colfits['pixnum'] = list(xx)
+    for k,keyname in enumerate(parnames):
+        colfits[keyname] = list(bestfit[:,k])
+    if return_stats:
+        for k,keyname in enumerate(['aic', 'bic', 'chi2', 'chi2red']):
+            colfits[keyname] = list(stats[:,k])
+    
+    if debug_level >= 1:
+        print('Mean number of iterations per pixel column: ' + str(np.round(np.mean(niter[goodcols]),1)))
+    
+    if timit:
+        print('Elapsed time for fitting profiles to a single order: '+np.round(time.time() - start_time,2).astype(str)+' seconds...')
+    
+    return colfits
+
+
+
+
+
 def fit_stacked_single_fibre_profile(grid, data, weights=None, pos=None, model='gausslike', method='leastsq', fix_posns=False, offset=False, norm=False, nofit=False, timit=False, debug_level=0):
     """
     Fit a single fibre profile in spatial direction. Sub-pixel sampling is achieved by stacking the (input) data for multiple pixel columns.
@@ -592,7 +729,8 @@ def fit_profiles_single_order(stripe_rows, stripe_columns, ordpol, osf=1, method
 
 
 
-def fit_profiles(P_id, stripes, err_stripes, mask=None, stacking=True, slit_height=25, model='gausslike', return_stats=False, timit=False):
+def fit_profiles(P_id, stripes, err_stripes, mask=None, stacking=True, slit_height=25, model='gausslike', return_stats=False, nthreads=1, 
+                 use_processes=True, trace_tables=None, timit=False):
     """
     This routine determines the profiles of the fibres in spatial direction. This is an extremely crucial step, as the pre-defined profiles
     are then used during the optimal extraction, as well as during the determination of the relative fibre intensities!!!
@@ -606,6 +744,9 @@ def fit_profiles(P_id, stripes, err_stripes, mask=None, stacking=True, slit_heig
     'slit_height'   : height of the extraction slit (ie the pixel columns are 2*slit_height pixels long)
     'model'         : the name of the mathematical model used to describe the profile of an individual fibre profile
     'return_stats'  : boolean - do you want to include some goodness-of-fit statistics in the output (ie AIC, BIC, CHISQ and REDCHISQ)?
+    'nthreads'      : number of orders to process in parallel (default is 1, ie one order after the other)
+    'use_processes' : boolean - use a pool of processes rather than a pool of threads (only if 'nthreads' > 1)
+    'trace_tables'  : the trace centres for all orders and pixel columns from "make_trace_tables" (they are created here if not provided)
     'timit'         : boolean - do you want to measure execution run time?
     
     OUTPUT:
@@ -617,32 +758,26 @@ def fit_profiles(P_id, stripes, err_stripes, mask=None, stacking=True, slit_heig
     if timit:
         start_time = time.time()
     
-    #create "global" parameter dictionary for entire chip
-    fibre_profiles = {}
-    #loop over all orders
-    for ord in sorted(P_id.iterkeys()):
-        print('OK, now processing '+str(ord))
-        
-        ordpol = P_id[ord]
-        
-        # define stripe
-        stripe = stripes[ord]
-        err_stripe = err_stripes[ord]
-        # find the "order-box"
-        sc,sr = flatten_single_stripe(stripe, slit_height=slit_height, timit=False)
-        err_sc,err_sr = flatten_single_stripe(err_stripe, slit_height=slit_height, timit=False)
-        
-        npix = sc.shape[1]
-        if mask is None:
-            mask = {}
-            mask[ord] = np.ones(npix, dtype='bool')
-        
-        # fit profile for single order and save result in "global" parameter dictionary for entire chip
-        if stacking:
-            colfits = determine_spatial_profiles_single_order(sc, sr, err_sc, ordpol, ordmask=mask[ord], model=model, return_stats=return_stats, timit=timit)
-        else:
-            colfits = fit_profiles_single_order(sr,sc,ordpol,osf=1,silent=True,timit=timit)
-        fibre_profiles[ord] = colfits
+    kwargs = {'stacking':stacking, 'slit_height':slit_height, 'model':model, 'return_stats':return_stats}
+    
+    # evaluate the order traces only once for all orders and pixel columns
+    if trace_tables is None:
+        trace_tables = make_trace_tables(P_id, nx=stripes[sorted(P_id.keys())[0]].shape[1])
+    
+    if nthreads > 1:
+        # every order only needs its own stripes, so no need for shared memory here
+        args = {ord: (P_id[ord], stripes[ord], err_stripes[ord], None, None if mask is None else mask[ord], get_order_trace(trace_tables, ord)) 
+                for ord in P_id.keys()}
+        fibre_profiles = run_orders_in_parallel(fit_profiles_single_order_worker, args, kwargs=kwargs, nthreads=nthreads, use_processes=use_processes)
+    else:
+        #create "global" parameter dictionary for entire chip
+        fibre_profiles = {}
+        #loop over all orders
+        for ord in sorted(P_id.keys()):
+            print('OK, now processing '+str(ord))
+            # fit profile for single order and save result in "global" parameter dictionary for entire chip
+            fibre_profiles[ord] = fit_profiles_single_order_worker(P_id[ord], stripes[ord], err_stripes[ord], None, None if mask is None else mask[ord], 
+                                                                   get_order_trace(trace_tables, ord), timit=timit, **kwargs)
     
     if timit:
         print('Time elapsed: '+str(int(time.time() - start_time))+' seconds...')  
@@ -653,7 +788,8 @@ def fit_profiles(P_id, stripes, err_stripes, mask=None, stacking=True, slit_heig
 
 
 
-def fit_profiles_from_indices(P_id, img, err_img, stripe_indices, mask=None, stacking=True, slit_height=25, model='gausslike', return_stats=False, timit=False):
+def fit_profiles_from_indices(P_id, img, err_img, stripe_indices, mask=None, stacking=True, slit_height=25, model='gausslike', return_stats=False, 
+                              nthreads=1, use_processes=True, trace_tables=None, timit=False):
     """
     This routine determines the profiles of the fibres in spatial direction. This is an extremely crucial step, as the pre-defined profiles are then used during
     the optimal extraction, as well as during the determination of the relative fibre intensities!!!
@@ -669,6 +805,10 @@ def fit_profiles_from_indices(P_id, img, err_img, stripe_indices, mask=None, sta
     'slit_height'   : height of the extraction slit (ie the pixel columns are 2*slit_height pixels long)
     'model'         : the name of the mathematical model used to describe the profile of an individual fibre profile
     'return_stats'  : boolean - do you want to include some goodness-of-fit statistics in the output (ie AIC, BIC, CHISQ and REDCHISQ)?
+    'nthreads'      : number of orders to process in parallel (default is 1, ie one order after the other)
+    'use_processes' : boolean - use a pool of processes rather than a pool of threads (only if 'nthreads' > 1); the image and the error 
+                      image are then placed in shared memory, so that they are not copied to every worker
+    'trace_tables'  : the trace centres for all orders and pixel columns from "make_trace_tables" (they are created here if not provided)
     'timit'         : boolean - do you want to measure execution run time?
     
     OUTPUT:
@@ -680,32 +820,37 @@ def fit_profiles_from_indices(P_id, img, err_img, stripe_indices, mask=None, sta
     
     if timit:
         start_time = time.time()
-        
-    #create "global" parameter dictionary for entire chip
-    fibre_profiles = {}
-    #loop over all orders
-    for ord in sorted(P_id.iterkeys()):
-        print('OK, now processing '+str(ord))
-        
-        ordpol = P_id[ord]
-        
-        # define stripe
-        indices = stripe_indices[ord]
-        # find the "order-box"
-        sc,sr = flatten_single_stripe_from_indices(img, indices, slit_height=slit_height, timit=False)
-        err_sc,err_sr = flatten_single_stripe_from_indices(err_img, indices, slit_height=slit_height, timit=False)
-        
-        npix = sc.shape[1]
-        if mask is None:
-            mask = {}
-            mask[ord] = np.ones(npix, dtype='bool')
-        
-        # fit profile for single order and save result in "global" parameter dictionary for entire chip
-        if stacking:
-            colfits = determine_spatial_profiles_single_order(sc, sr, err_sc, ordpol, ordmask=mask[ord], model=model, return_stats=return_stats, timit=timit)
+    
+    kwargs = {'stacking':stacking, 'slit_height':slit_height, 'model':model, 'return_stats':return_stats}
+    
+    # evaluate the order traces only once for all orders and pixel columns
+    if trace_tables is None:
+        trace_tables = make_trace_tables(P_id, nx=img.shape[1])
+    
+    if nthreads > 1:
+        if use_processes:
+            img_shm, img_ref = share_array(img)
+            err_shm, err_ref = share_array(err_img)
         else:
-            colfits = fit_profiles_single_order(sr,sc,ordpol,osf=1,silent=True,timit=timit)
-        fibre_profiles[ord] = colfits
+            img_ref, err_ref = img, err_img
+        try:
+            args = {ord: (P_id[ord], img_ref, err_ref, stripe_indices[ord], None if mask is None else mask[ord], get_order_trace(trace_tables, ord)) 
+                    for ord in P_id.keys()}
+            fibre_profiles = run_orders_in_parallel(fit_profiles_single_order_worker, args, kwargs=kwargs, nthreads=nthreads, use_processes=use_processes)
+        finally:
+            if use_processes:
+                for shm in (img_shm, err_shm):
+                    shm.close()
+                    shm.unlink()
+    else:
+        #create "global" parameter dictionary for entire chip
+        fibre_profiles = {}
+        #loop over all orders
+        for ord in sorted(P_id.keys()):
+            print('OK, now processing '+str(ord))
+            # fit profile for single order and save result in "global" parameter dictionary for entire chip
+            fibre_profiles[ord] = fit_profiles_single_order_worker(P_id[ord], img, err_img, stripe_indices[ord], None if mask is None else mask[ord], 
+                                                                   get_order_trace(trace_tables, ord), timit=timit, **kwargs)
     
     if timit:
         print('Time elapsed: '+str(int(time.time() - start_time))+' seconds...')  
@@ -714,6 +859,53 @@ def fit_profiles_from_indices(P_id, img, err_img, stripe_indices, mask=None, sta
 
 
 
+def fit_profiles_single_order_worker(ordpol, img, err_img, indices=None, ordmask=None, ordpos=None, stacking=True, slit_height=25, model='gausslike', 
+                                     return_stats=False, timit=False):
+    """
+    Determines the fibre profiles for a single order. This is the unit of work of "fit_profiles(_from_indices)", both for the serial and 
+    the order-parallel processing.
+    
+    INPUT:
+    'ordpol'        : set of polynomial coefficients from P_id for that order (ie p = P_id[ord])
+    'img'           : either the stripe (if 'indices' is None) or the 2-dim input image, or a reference to the image in shared memory 
+                      (see "share_array")
+    'err_img'       : ditto for the errors
+    'indices'       : the stripe-indices for that order (if None, 'img' and 'err_img' are the stripes)
+    'ordmask'       : boolean mask from "find_stripes" for that order (masking out regions of very low signal)
+    'ordpos'        : the trace centres of that order for all pixel columns (eg from "make_trace_tables")
+    (all other keywords as in "fit_profiles")
+    
+    OUTPUT:
+    'colfits'       : the fitted profiles for that order (as returned by "determine_spatial_profiles_single_order")
+    """
+    
+    img_shm, img = attach_shared_array(img)
+    err_shm, err_img = attach_shared_array(err_img)
+    
+    # find the "order-box"
+    if indices is None:
+        sc,sr = flatten_single_stripe(img, slit_height=slit_height, timit=False)
+        err_sc,err_sr = flatten_single_stripe(err_img, slit_height=slit_height, timit=False)
+    else:
+        sc,sr = flatten_single_stripe_from_indices(img, indices, slit_height=slit_height, timit=False)
+        err_sc,err_sr = flatten_single_stripe_from_indices(err_img, indices, slit_height=slit_height, timit=False)
+    
+    # release the shared memory (the cutouts are copies)
+    del img, err_img
+    for shm in (img_shm, err_shm):
+        if shm is not None:
+            shm.close()
+    
+    if stacking:
+        colfits = determine_spatial_profiles_single_order(sc, sr, err_sc, ordpol, ordmask=ordmask, model=model, return_stats=return_stats, 
+                                                          ordpos=ordpos, timit=timit)
+    else:
+        colfits = fit_profiles_single_order(sr,sc,ordpol,osf=1,silent=True,timit=timit)
+    
+    return colfits
+
+
+
 
 
 def make_model_stripes_gausslike(fibre_profiles, flat, err_img, stripe_indices, mask, degpol=5, slit_height=10, return_fitpars=False, debug_level=0, timit=False):
@@ -754,7 +946,7 @@ def make_model_stripes_gausslike(fibre_profiles, flat, err_img, stripe_indices,
         fitpars = {}
     
     #loop over all orders
-    for ord in sorted(fibre_profiles.iterkeys()):
+    for ord in sorted(fibre_profiles.keys()):
         if debug_level >= 1:
             print('Creating model for ',ord)
             
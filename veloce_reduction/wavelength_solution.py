@@ -21,7 +21,7 @@ import glob
 
 from veloce_reduction.readcol import readcol
 from veloce_reduction.veloce_reduction.helper_functions import fibmodel_with_amp, CMB_pure_gaussian, multi_fibmodel_with_amp, CMB_multi_gaussian, offset_pseudo_gausslike
-from veloce_reduction.veloce_reduction.helper_functions import fit_poly_surface_2D, single_sigma_clip, find_nearest, gaussian_with_offset_and_slope, fibmodel_with_amp_and_offset
+from veloce_reduction.veloce_reduction.helper_functions import fit_poly_surface_2D, polyval2d_grid, single_sigma_clip, find_nearest, gaussian_with_offset_and_slope, fibmodel_with_amp_and_offset
 from veloce_reduction.utils.linelists import make_gaussmask_from_linelist
 from veloce_reduction.veloce_reduction.lfc_peaks import find_affine_transformation_matrix, divide_lfc_peaks_into_orders
 
@@ -822,8 +822,7 @@ def get_wavelength_solution_from_thorium(thflux, poly_deg=5, polytype='chebyshev
         xxn = (xx / ((len(xx)-1)/2.)) - 1.
         oo = np.arange(1,len(thflux))
         oon = ((oo-1) / ((len(thflux)-1)/2.)) - 1.   
-        X,O = np.meshgrid(xxn,oon)
-        p_wl = p(X,O)
+        p_wl = polyval2d_grid(xxn, oon, p)
 
     
     if timit:
@@ -862,10 +861,8 @@ def get_wl(p,xx,yy):
     print('WRONG!!!!!')
     xxn = np.linspace(-1, 1, len(xx))
     yyn = np.linspace(-1, 1, len(yy))
-    #make 2D grids of coordinates
-    X,Y = np.meshgrid(xxn,yyn)
     #actually calculate the wavelengths from the polynomial coefficients
-    p_wl = p(X,Y)
+    p_wl = polyval2d_grid(xxn, yyn, p)
     
     return p_wl
 
@@ -1043,8 +1040,7 @@ def get_wavelength_solution_labtests(thflux, thflux2, poly_deg=5, polytype='cheb
         oo = np.arange(1,len(thflux))
         oon = ((oo-1) / (38./2.)) - 1.        #TEMP, TODO, FUGANDA, PLEASE FIX ME!!!!!
         #oon = ((oo-1) / ((len(thflux)-1)/2.)) - 1.   
-        X,O = np.meshgrid(xxn,oon)
-        p_wl = p(X,O)
+        p_wl = polyval2d_grid(xxn, oon, p)
 
     
     if timit:
@@ -1344,9 +1340,8 @@ def get_arc_dispsol(thflux, satmask=None, polytype='chebyshev', lamptype=None, d
         xxn = (xx / ((len(xx)-1)/2.)) - 1.
         oo = np.arange(1,len(thflux)+1)
         oon = ((oo-1) / ((len(thflux)-1)/2.)) - 1.   
-        X,O = np.meshgrid(xxn,oon)
-        p_air_wl = p_air(X,O)
-        p_vac_wl = p_vac(X,O)
+        p_air_wl = polyval2d_grid(xxn, oon, p_air)
+        p_vac_wl = polyval2d_grid(xxn, oon, p_vac)
         return p_air_wl, p_vac_wl
     else:
         return p_air, p_vac
@@ -1758,9 +1753,8 @@ def get_dispsol_from_known_lines(thflux, pathdict=None, fibre=None, date=None, f
         xxn = (xx / ((len(xx)-1)/2.)) - 1.
         oo = np.arange(1,len(thflux)+1+1)     # note the double-adding of 1 is intentional in order to make a wl-solution for 40 orders!!!
         oon = ((oo-1) / ((40-1)/2.)) - 1.   
-        X,O = np.meshgrid(xxn,oon)
-        p_air_wl = p_air(X,O)
-        p_vac_wl = p_vac(X,O)
+        p_air_wl = polyval2d_grid(xxn, oon, p_air)
+        p_vac_wl = polyval2d_grid(xxn, oon, p_vac)
         return p_air_wl, p_vac_wl
     else:
         return p_air, p_vac
@@ -2060,8 +2054,7 @@ def old_get_dispsol_for_all_fibs(obsname, date=None, relto='LFC', twod=False, de
         xxn = (xx / ((len(xx)-1)/2.)) - 1.
         oo = np.arange(1,41)
         oon = ((oo-1) / ((40-1)/2.)) - 1.
-        X,O = np.meshgrid(xxn,oon)
-        wl_lfc = p_wl_lfc(X,O)
+        wl_lfc = polyval2d_grid(xxn, oon, p_wl_lfc)
 
         # loop over all orders
         for o in np.unique(lfc_ord)[:-1]:
@@ -2093,8 +2086,7 @@ def old_get_dispsol_for_all_fibs(obsname, date=None, relto='LFC', twod=False, de
             xxn = (xx / ((len(xx)-1)/2.)) - 1.
             oo = np.arange(1,41)
             oon = ((oo-1) / ((40-1)/2.)) - 1.
-            X,O = np.meshgrid(xxn,oon)
-            wl[:,i,:] = p_wl(X,O)
+            wl[:,i,:] = polyval2d_grid(xxn, oon, p_wl)
 
         for i,o in enumerate(np.unique(lfc_ord)[:-1]):
             ord = 'order_'+str(o+1).zfill(2)
@@ -2260,8 +2252,7 @@ def get_dispsol_for_all_fibs(obsname, date=None, relto='LFC', twod=False, degpol
         xxn = (xx / ((len(xx)-1)/2.)) - 1.
         oo = np.arange(1,41)
         oon = ((oo-1) / ((40-1)/2.)) - 1.
-        X,O = np.meshgrid(xxn,oon)
-        wl_lfc = p_wl_lfc(X,O)
+        wl_lfc = polyval2d_grid(xxn, oon, p_wl_lfc)
 
         # loop over all orders
         for o in np.unique(lfc_ord)[:-1]:
@@ -2293,8 +2284,7 @@ def get_dispsol_for_all_fibs(obsname, date=None, relto='LFC', twod=False, degpol
             xxn = (xx / ((len(xx)-1)/2.)) - 1.
             oo = np.arange(1,41)
             oon = ((oo-1) / ((40-1)/2.)) - 1.
-            X,O = np.meshgrid(xxn,oon)
-            wl[:,i,:] = p_wl(X,O)
+            wl[:,i,:] = polyval2d_grid(xxn, oon, p_wl)
 
         for i,o in enumerate(np.unique(lfc_ord)[:-1]):
             ord = 'order_'+str(o+1).zfill(2)